@@ -0,0 +1,181 @@
+#
+# assetcache.py
+#
+# Local, size-bounded disk cache for assets downloaded from S3.
+# Entries are keyed by bucket key and validated against the
+# object's ETag with a conditional GET, so a repeat download
+# costs either nothing (if recently validated) or a 304.
+#
+
+import logging
+import threading
+import hashlib
+import json
+import time
+import os
+import pathlib
+
+
+###################################################################
+#
+# AssetCache
+#
+# The cache directory holds one file per cached object (named by
+# a hash of its bucket key) and next to it a small .json file
+# with the entry's key, ETag, and when it was last validated.
+# Recency is the data file's modification time, bumped with
+# os.utime on every hit, so a hit writes no metadata. When a new
+# entry takes the total size over max_bytes, the directory is
+# scanned and the least recently used entries evicted. There is
+# no shared index, so several processes (e.g. the CLI and the
+# server) can use one cache directory without losing entries.
+#
+class AssetCache:
+  """
+  Size-bounded LRU disk cache of S3 objects
+
+  Parameters
+  ----------
+  directory : folder to keep cached objects in (created if need be),
+  max_bytes : maximum total size of cached objects,
+  revalidate_after : seconds during which a cached entry is trusted
+    without asking S3; after that a conditional GET is made
+  """
+
+  def __init__(self, directory, max_bytes, revalidate_after=0):
+    self.directory = pathlib.Path(directory)
+    self.max_bytes = max_bytes
+    self.revalidate_after = revalidate_after
+
+    self._lock = threading.Lock()
+    self.directory.mkdir(parents=True, exist_ok=True)
+
+  def _paths(self, key):
+    filename = hashlib.sha256(key.encode()).hexdigest()
+    return (self.directory / filename, self.directory / f"{filename}.json")
+
+  def _write(self, path, data):
+    # write-then-rename, so readers never see a partial file:
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+      f.write(data)
+    os.replace(tmp, path)
+
+  def _read_meta(self, meta_path):
+    try:
+      with open(meta_path) as f:
+        return json.load(f)
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      logging.warning("assetcache: ignoring unreadable entry %s: %s", meta_path.name, e)
+      return None
+
+  def _write_meta(self, meta_path, key, etag, validated):
+    entry = {'key': key, 'etag': etag, 'validated': validated}
+    self._write(meta_path, json.dumps(entry).encode())
+
+  def _evict(self):
+    #
+    # scan the data files (64 hex digit names) with their sizes
+    # and last use; cheap next to the download that precedes it:
+    #
+    entries = []
+    with os.scandir(self.directory) as it:
+      for item in it:
+        if len(item.name) == 64 and "." not in item.name:
+          try:
+            st = item.stat()
+          except FileNotFoundError:
+            continue  # evicted by another process meanwhile
+          entries.append((st.st_mtime, st.st_size, item.name))
+
+    total = sum(size for (_, size, _) in entries)
+    if total <= self.max_bytes:
+      return
+
+    for (_, size, name) in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      for path in [self.directory / name, self.directory / f"{name}.json"]:
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+      total -= size
+
+  def _store(self, key, etag, data):
+    (path, meta_path) = self._paths(key)
+
+    self._write(path, data)
+    self._write_meta(meta_path, key, etag, time.time())
+
+    with self._lock:
+      self._evict()
+
+  def _touch(self, path):
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      pass  # evicted meanwhile; the caller already has the data
+
+  def get(self, bucket, key):
+    """
+    Returns the contents of an S3 object, from the cache when the
+    cached copy is still current and from S3 otherwise (in which
+    case the cache is updated)
+
+    Parameters
+    ----------
+    bucket : S3 bucket the object lives in,
+    key : object's name in bucket
+
+    Returns
+    -------
+    object's contents as bytes or None upon an error
+    """
+
+    from botocore.exceptions import ClientError  # deferred: slow to import
+
+    try:
+      (path, meta_path) = self._paths(key)
+      entry = self._read_meta(meta_path)
+
+      data = None
+      if entry is not None and entry.get('key') == key:
+        try:
+          with open(path, "rb") as f:
+            data = f.read()
+        except FileNotFoundError:
+          entry = None
+      else:
+        entry = None
+
+      if entry is not None and \
+         time.time() - entry['validated'] < self.revalidate_after:
+        self._touch(path)
+        return data
+
+      request = {}
+      if entry is not None:
+        request['IfNoneMatch'] = entry['etag']
+
+      try:
+        response = bucket.Object(key).get(**request)
+      except ClientError as e:
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if entry is not None and \
+           (status == 304 or e.response.get('Error', {}).get('Code') in ('304', 'NotModified')):
+          self._write_meta(meta_path, key, entry['etag'], time.time())
+          self._touch(path)
+          return data
+        raise
+
+      data = response['Body'].read()
+      self._store(key, response['ETag'], data)
+      return data
+
+    except Exception as e:
+      logging.error("assetcache.get() failed:")
+      logging.error(e)
+      return None
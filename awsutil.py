@@ -8,10 +8,238 @@
 #   Northwestern University
 #
 
-import boto3
+import metrics  # per-operation latency / error counts
+
 import logging
 import uuid
 import pathlib
+import json
+import gzip
+import os
+import io
+import time
+import threading
+
+#
+# boto3 itself is imported lazily, in the functions that need
+# it, so programs that import this module but never touch S3
+# don't pay boto3's startup cost.
+#
+
+
+###################################################################
+#
+# get_transfer_config
+#
+# ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+#
+# Reads the transfer settings from a config file section, e.g.
+#
+#   [s3]
+#   multipart_threshold = 16MB
+#   multipart_chunksize = 16MB
+#   max_concurrency = 20
+#   use_threads = yes
+#   reuse_threads = yes
+#
+# Any setting not present keeps boto3's default.
+#
+def get_transfer_config(configur, section='s3'):
+  """
+  Builds a boto3 TransferConfig from a config file section
+
+  Parameters
+  ----------
+  configur : ConfigParser holding the config file,
+  section : name of the section with the transfer settings
+
+  Returns
+  -------
+  a TransferConfig object
+  """
+
+  from boto3.s3.transfer import TransferConfig
+
+  settings = {}
+
+  if configur.has_option(section, 'multipart_threshold'):
+    settings['multipart_threshold'] = parse_size(configur.get(section, 'multipart_threshold'))
+  if configur.has_option(section, 'multipart_chunksize'):
+    settings['multipart_chunksize'] = parse_size(configur.get(section, 'multipart_chunksize'))
+  if configur.has_option(section, 'max_concurrency'):
+    settings['max_concurrency'] = configur.getint(section, 'max_concurrency')
+  if configur.has_option(section, 'use_threads'):
+    settings['use_threads'] = configur.getboolean(section, 'use_threads')
+
+  return TransferConfig(**settings)
+
+
+###################################################################
+#
+# get_client_config
+#
+# ref: https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+#
+# Reads the S3 client (connection) settings from a config file
+# section, e.g.
+#
+#   [s3]
+#   max_pool_connections = 50
+#   retry_mode = adaptive
+#   max_attempts = 5
+#   tcp_keepalive = yes
+#   connect_timeout = 5
+#   read_timeout = 60
+#
+# botocore keeps at most 10 connections open per client by
+# default, so more than 10 concurrent transfers (bulk upload,
+# batch download, multipart parts, server threads) queue for a
+# connection; the default here is 50. Adaptive retries back off
+# client-side when S3 throttles (503 SlowDown); max_attempts
+# counts the first try.
+#
+def get_client_config(configur, section='s3'):
+  """
+  Builds a botocore Config from a config file section
+
+  Parameters
+  ----------
+  configur : ConfigParser holding the config file,
+  section : name of the section with the client settings
+
+  Returns
+  -------
+  a botocore Config object
+  """
+
+  from botocore.config import Config
+
+  return Config(
+    max_pool_connections=configur.getint(section, 'max_pool_connections', fallback=50),
+    retries={
+      'mode': configur.get(section, 'retry_mode', fallback='adaptive'),
+      'total_max_attempts': configur.getint(section, 'max_attempts', fallback=5)
+    },
+    tcp_keepalive=configur.getboolean(section, 'tcp_keepalive', fallback=True),
+    connect_timeout=configur.getfloat(section, 'connect_timeout', fallback=5),
+    read_timeout=configur.getfloat(section, 'read_timeout', fallback=60))
+
+
+###################################################################
+#
+# get_s3_resource
+#
+# One S3 resource (and so one client, one connection pool) per
+# process: every caller shares its connections instead of each
+# building its own with default settings. The first call creates
+# it from the config file; later calls return the same object,
+# and log a warning if they asked for different settings, since
+# those are not applied.
+#
+_s3_resource = None
+_s3_resource_settings = None
+_s3_resource_lock = threading.Lock()
+
+_CLIENT_OPTIONS = ['endpoint_url', 'max_pool_connections', 'retry_mode', 'max_attempts',
+                   'tcp_keepalive', 'connect_timeout', 'read_timeout']
+
+
+def get_s3_resource(configur, profile_name=None, section='s3'):
+  """
+  Returns the process-wide S3 resource, creating it on first use
+  with the client settings (see get_client_config) and optional
+  endpoint_url from the config file section
+
+  Parameters
+  ----------
+  configur : ConfigParser holding the config file,
+  profile_name : optional AWS credentials profile,
+  section : name of the section with the S3 settings
+
+  Returns
+  -------
+  a boto3 S3 ServiceResource; its .meta.client is the shared,
+  thread-safe low-level client
+  """
+
+  global _s3_resource, _s3_resource_settings
+
+  settings = (profile_name,
+              os.environ.get('AWS_SHARED_CREDENTIALS_FILE'),
+              tuple(configur.get(section, option, fallback=None) for option in _CLIENT_OPTIONS))
+
+  with _s3_resource_lock:
+    if _s3_resource is None:
+      import boto3  # deferred: slow to import
+
+      session = boto3.session.Session(profile_name=profile_name)
+      _s3_resource = session.resource('s3',
+                                      endpoint_url=configur.get(section, 'endpoint_url', fallback=None),
+                                      config=get_client_config(configur, section))
+      _s3_resource_settings = settings
+
+    elif settings != _s3_resource_settings:
+      logging.warning("awsutil.get_s3_resource(): S3 resource already created with other "
+                      "settings (profile, credentials file or [%s] client options); "
+                      "ignoring the new ones", section)
+
+    return _s3_resource
+
+
+###################################################################
+#
+# parse_size
+#
+def parse_size(text):
+  """
+  Converts a size such as "8388608", "512KB", "8MB" or "1GB"
+  to a # of bytes (units are powers of 1024)
+
+  Parameters
+  ----------
+  text : size as a string
+
+  Returns
+  -------
+  size in bytes (integer)
+  """
+
+  units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+  text = text.strip().upper()
+  for (suffix, multiplier) in units.items():
+    if text.endswith(suffix):
+      return int(float(text[:-len(suffix)]) * multiplier)
+
+  return int(text.rstrip('B'))
+
+
+###################################################################
+#
+# make_transfer
+#
+# boto3's bucket.upload_file creates (and tears down) a new
+# transfer manager and thread pool on every call; an S3Transfer
+# object keeps one alive so its threads are reused across
+# uploads.
+#
+def make_transfer(bucket, transfer_config):
+  """
+  Creates a reusable transfer manager for uploads to a bucket
+
+  Parameters
+  ----------
+  bucket : S3 bucket the transfers will target,
+  transfer_config : TransferConfig to use
+
+  Returns
+  -------
+  an S3Transfer object
+  """
+
+  from boto3.s3.transfer import S3Transfer
+
+  return S3Transfer(client=bucket.meta.client, config=transfer_config)
 
 
 ###################################################################
@@ -20,6 +248,8 @@ import pathlib
 #
 # ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/bucket/download_file.html
 #
+@metrics.timed("awsutil.download_file", failed=metrics.is_none,
+               nbytes=lambda filename, *args, **kwargs: os.path.getsize(filename))
 def download_file(bucket, key):
   """
   Downloads a file from an S3 bucket
@@ -54,22 +284,106 @@ def download_file(bucket, key):
     return None
 
 
+###################################################################
+#
+# download_fileobj
+#
+# ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/bucket/download_fileobj.html
+#
+def download_fileobj(bucket, key, fileobj):
+  """
+  Downloads an object from an S3 bucket into a writable binary
+  file-like object supplied by the caller (an open file, a
+  BytesIO buffer, a socket wrapper, ...)
+
+  Parameters
+  ----------
+  bucket : S3 bucket to download from, 
+  key : object's name in bucket,
+  fileobj : writable binary file-like object
+  
+  Returns
+  -------
+  key that was passed in or None upon an error
+  """
+
+  #
+  # the file object may not be able to tell its size (a socket),
+  # so the bytes are counted by the transfer's progress callback,
+  # which boto3 calls from its worker threads:
+  #
+  with metrics.measure("awsutil.download_fileobj") as observation:
+    lock = threading.Lock()
+
+    def transferred(nbytes):
+      with lock:
+        observation.add_bytes(nbytes)
+
+    try:
+      bucket.download_fileobj(key, fileobj, Callback=transferred)
+      return key
+
+    except Exception as e:
+      observation.fail()
+      logging.error("awss3.download_fileobj() failed:")
+      logging.error(e)
+      return None
+
+
+###################################################################
+#
+# download_bytes
+#
+@metrics.timed("awsutil.download_bytes", failed=metrics.is_none,
+               nbytes=lambda data, *args, **kwargs: len(data))
+def download_bytes(bucket, key):
+  """
+  Downloads an object from an S3 bucket into memory, without
+  touching the local disk
+
+  Parameters
+  ----------
+  bucket : S3 bucket to download from, 
+  key : object's name in bucket
+  
+  Returns
+  -------
+  object's contents as bytes or None upon an error
+  """
+
+  buffer = io.BytesIO()
+
+  if download_fileobj(bucket, key, buffer) is None:
+    return None
+
+  return buffer.getvalue()
+
+
 ###################################################################
 #
 # upload_file
 #
 # ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/bucket/upload_file.html
 #
-def upload_file(local_filename, bucket, key):
+@metrics.timed("awsutil.upload_file", failed=metrics.is_none,
+               nbytes=lambda key, local_filename, *args, **kwargs: os.path.getsize(local_filename))
+def upload_file(local_filename, bucket, key, config=None, transfer=None,
+                stats=None):
   """
   Uploads a file to an S3 bucket, setting the content type to "image/jpeg" if
-  a jpg file and the permissions to be publicly readable
+  a jpg file and the permissions to be publicly readable. Large files are
+  uploaded as parallel multipart uploads per the transfer config.
 
   Parameters
   ----------
   local_filename : name of local file to upload, 
   bucket : S3 Bucket to upload to,
-  key : object's name in the bucket after upload
+  key : object's name in the bucket after upload,
+  config : optional TransferConfig (see get_transfer_config),
+  transfer : optional S3Transfer to reuse (see make_transfer);
+    takes precedence over config,
+  stats : optional dictionary that is filled in with 'bytes',
+    'seconds' and 'MBps' (throughput) for this upload
   
   Returns
   -------
@@ -77,20 +391,431 @@ def upload_file(local_filename, bucket, key):
   """
 
   try:
-    if key.endswith('jpg'):  # image file
-      content_type = 'image/jpeg'
-    else:  # default:
-      content_type = 'application/octet-stream'
-
-    bucket.upload_file(local_filename,
-                       key,
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': content_type
-                       })
+    extra_args = {
+      'ACL': 'public-read',
+      'ContentType': content_type(key)
+    }
+
+    start = time.perf_counter()
+
+    if transfer is not None:
+      transfer.upload_file(local_filename, bucket.name, key,
+                           extra_args=extra_args)
+    else:
+      bucket.upload_file(local_filename,
+                         key,
+                         ExtraArgs=extra_args,
+                         Config=config)
+
+    if stats is not None:
+      elapsed = time.perf_counter() - start
+      nbytes = os.path.getsize(local_filename)
+      stats['bytes'] = nbytes
+      stats['seconds'] = elapsed
+      stats['MBps'] = (nbytes / (1024 * 1024)) / elapsed if elapsed > 0 else 0.0
+
     return key
 
   except Exception as e:
     logging.error("awss3.upload_file() failed:")
     logging.error(e)
     return None
+
+
+###################################################################
+#
+# upload_bytes
+#
+# ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/bucket/upload_fileobj.html
+#
+@metrics.timed("awsutil.upload_bytes", failed=metrics.is_none,
+               nbytes=lambda key, data, *args, **kwargs: len(data))
+def upload_bytes(data, bucket, key):
+  """
+  Uploads in-memory data to an S3 bucket, with the same content
+  type and permissions as upload_file
+
+  Parameters
+  ----------
+  data : bytes to upload, 
+  bucket : S3 Bucket to upload to,
+  key : object's name in the bucket after upload
+  
+  Returns
+  -------
+  key that was passed in or None upon an error
+  """
+
+  try:
+    bucket.upload_fileobj(io.BytesIO(data),
+                          key,
+                          ExtraArgs={
+                            'ACL': 'public-read',
+                            'ContentType': content_type(key)
+                          })
+    return key
+
+  except Exception as e:
+    logging.error("awss3.upload_bytes() failed:")
+    logging.error(e)
+    return None
+
+
+###################################################################
+#
+# iter_objects
+#
+# ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/paginator/ListObjectsV2.html
+#
+# Lists a bucket (or the part under a prefix) with the low-level
+# ListObjectsV2 paginator, 1,000 keys per request, yielding plain
+# tuples as each page arrives rather than building a resource
+# object per key, so memory use is constant however big the
+# bucket. Keys come back in ascending (UTF-8 binary) order.
+#
+def iter_objects(bucket, prefix=None):
+  """
+  Yields the objects in an S3 bucket, optionally only those whose
+  keys start with prefix
+
+  Parameters
+  ----------
+  bucket : S3 bucket to list,
+  prefix : optional key prefix, e.g. "<bucketfolder>/"
+
+  Yields
+  ------
+  (key, size in bytes, ETag) for each object, in key order;
+  errors are raised (a partial listing would silently give wrong
+  totals)
+  """
+
+  paginator = bucket.meta.client.get_paginator('list_objects_v2')
+
+  for page in paginator.paginate(Bucket=bucket.name, Prefix=prefix or ''):
+    for obj in page.get('Contents', []):
+      yield (obj['Key'], obj['Size'], obj['ETag'])
+
+
+###################################################################
+#
+# folder_totals
+#
+# Since keys are listed in order, all the keys of one folder
+# ("<folder>/...") arrive together; each folder's totals are
+# yielded as soon as the listing moves past it, so one streaming
+# pass with constant memory covers the whole bucket.
+#
+def folder_totals(bucket, prefix=None):
+  """
+  Yields the # of objects and total bytes under each top-level
+  folder of an S3 bucket, in one pass over the listing
+
+  Parameters
+  ----------
+  bucket : S3 bucket to list,
+  prefix : optional key prefix to restrict the listing to
+
+  Yields
+  ------
+  (folder, # of objects, total bytes) in the order of the
+  folders' "folder/" prefixes, i.e. listing order ("abc-x" comes
+  before "abc", as '-' < '/'); objects not in any folder are
+  totalled under folder "" (once per run of such keys, since they
+  sort in among the folders). Errors are raised, as by
+  iter_objects
+  """
+
+  folder = None
+  count = 0
+  nbytes = 0
+
+  for (key, size, _) in iter_objects(bucket, prefix):
+    this_folder = key.split('/', 1)[0] if '/' in key else ''
+    if this_folder != folder:
+      if folder is not None:
+        yield (folder, count, nbytes)
+      (folder, count, nbytes) = (this_folder, 0, 0)
+    count += 1
+    nbytes += size
+
+  if folder is not None:
+    yield (folder, count, nbytes)
+
+
+###################################################################
+#
+# count_objects
+#
+@metrics.timed("awsutil.count_objects", failed=metrics.is_negative)
+def count_objects(bucket):
+  """
+  Counts the objects in an S3 bucket by listing it. This pages
+  through the whole bucket (1,000 keys per request) but counts
+  as it goes, so memory use is constant
+
+  Parameters
+  ----------
+  bucket : S3 bucket to count
+  
+  Returns
+  -------
+  # of objects in the bucket or -1 upon an error
+  """
+
+  try:
+    return sum(1 for _ in iter_objects(bucket))
+
+  except Exception as e:
+    logging.error("awss3.count_objects() failed:")
+    logging.error(e)
+    return -1
+
+
+###################################################################
+#
+# count_inventory
+#
+# ref: https://docs.aws.amazon.com/AmazonS3/latest/userguide/storage-inventory-location.html
+#
+def count_inventory(manifest_filename):
+  """
+  Counts the objects listed in a local copy of an S3 Inventory
+  report (CSV format). The manifest.json is read and each data
+  file it lists is looked up next to the manifest, either at
+  the same relative path as its key, under data/, or by name
+
+  Parameters
+  ----------
+  manifest_filename : path to the inventory's manifest.json
+  
+  Returns
+  -------
+  # of objects in the inventory or -1 upon an error
+  """
+
+  try:
+    manifest_path = pathlib.Path(manifest_filename)
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+
+    if manifest.get('fileFormat', 'CSV').upper() != 'CSV':
+      raise ValueError(f"unsupported inventory format '{manifest['fileFormat']}', expected CSV")
+
+    total = 0
+    folder = manifest_path.parent
+
+    for entry in manifest['files']:
+      key = pathlib.PurePosixPath(entry['key'])
+      candidates = [folder / key, folder / 'data' / key.name, folder / key.name]
+      datafile = next((c for c in candidates if c.is_file()), None)
+      if datafile is None:
+        raise FileNotFoundError(f"inventory data file '{key}' not found under '{folder}'")
+
+      opener = gzip.open if datafile.suffix == '.gz' else open
+      with opener(datafile, 'rb') as f:
+        total += sum(1 for line in f if line.strip())
+
+    return total
+
+  except Exception as e:
+    logging.error("awss3.count_inventory() failed:")
+    logging.error(e)
+    return -1
+
+
+###################################################################
+#
+# inventory_timestamp
+#
+def inventory_timestamp(manifest_filename):
+  """
+  Returns when an S3 Inventory report was taken, from its
+  manifest.json alone (without reading the data files)
+
+  Parameters
+  ----------
+  manifest_filename : path to the inventory's manifest.json
+  
+  Returns
+  -------
+  the manifest's creationTimestamp, in milliseconds since the
+  epoch, or -1 upon an error
+  """
+
+  try:
+    with open(manifest_filename) as f:
+      manifest = json.load(f)
+
+    return int(manifest['creationTimestamp'])
+
+  except Exception as e:
+    logging.error("awss3.inventory_timestamp() failed:")
+    logging.error(e)
+    return -1
+
+
+###################################################################
+#
+# content_type
+#
+def content_type(key):
+  """
+  Content type stored for an object: "image/jpeg" if a jpg file,
+  otherwise "application/octet-stream"
+
+  Parameters
+  ----------
+  key : object's name in bucket
+
+  Returns
+  -------
+  the content type (string)
+  """
+
+  if key.endswith('jpg'):  # image file
+    return 'image/jpeg'
+  else:  # default:
+    return 'application/octet-stream'
+
+
+###################################################################
+#
+# presign_get
+#
+# ref: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-presigned-urls.html
+#
+def presign_get(bucket, key, ttl=3600):
+  """
+  Generates a presigned URL that lets anyone holding it download
+  an object directly from S3, without going through this host
+
+  Parameters
+  ----------
+  bucket : S3 bucket the object lives in,
+  key : object's name in bucket,
+  ttl : seconds until the URL expires
+
+  Returns
+  -------
+  the URL or None upon an error
+  """
+
+  try:
+    return bucket.meta.client.generate_presigned_url('get_object',
+                                                     Params={
+                                                       'Bucket': bucket.name,
+                                                       'Key': key
+                                                     },
+                                                     ExpiresIn=ttl)
+
+  except Exception as e:
+    logging.error("awss3.presign_get() failed:")
+    logging.error(e)
+    return None
+
+
+###################################################################
+#
+# presign_put
+#
+def presign_put(bucket, key, ttl=3600):
+  """
+  Generates a presigned URL that lets anyone holding it upload an
+  object directly to S3 with an HTTP PUT. The ACL and content type
+  are part of the signature, so the PUT must send the headers
+  "x-amz-acl: public-read" and "Content-Type: <content_type(key)>"
+
+  Parameters
+  ----------
+  bucket : S3 bucket to upload to,
+  key : object's name in the bucket after upload,
+  ttl : seconds until the URL expires
+
+  Returns
+  -------
+  the URL or None upon an error
+  """
+
+  try:
+    return bucket.meta.client.generate_presigned_url('put_object',
+                                                     Params={
+                                                       'Bucket': bucket.name,
+                                                       'Key': key,
+                                                       'ACL': 'public-read',
+                                                       'ContentType': content_type(key)
+                                                     },
+                                                     ExpiresIn=ttl)
+
+  except Exception as e:
+    logging.error("awss3.presign_put() failed:")
+    logging.error(e)
+    return None
+
+
+###################################################################
+#
+# presign_post
+#
+# ref: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/generate_presigned_post.html
+#
+def presign_post(bucket, key, ttl=3600, max_bytes=None):
+  """
+  Generates a presigned POST (URL plus form fields) that lets a
+  browser upload an object directly to S3 with an HTML form
+
+  Parameters
+  ----------
+  bucket : S3 bucket to upload to,
+  key : object's name in the bucket after upload,
+  ttl : seconds until the form expires,
+  max_bytes : optional upper limit on the upload's size
+
+  Returns
+  -------
+  dictionary with 'url' and 'fields' or None upon an error
+  """
+
+  try:
+    fields = {'acl': 'public-read', 'Content-Type': content_type(key)}
+    conditions = [{'acl': 'public-read'}, {'Content-Type': content_type(key)}]
+    if max_bytes is not None:
+      conditions.append(['content-length-range', 0, max_bytes])
+
+    return bucket.meta.client.generate_presigned_post(bucket.name,
+                                                      key,
+                                                      Fields=fields,
+                                                      Conditions=conditions,
+                                                      ExpiresIn=ttl)
+
+  except Exception as e:
+    logging.error("awss3.presign_post() failed:")
+    logging.error(e)
+    return None
+
+
+###################################################################
+#
+# get_object_size
+#
+def get_object_size(bucket, key):
+  """
+  Returns the size of an object, which also confirms it exists
+
+  Parameters
+  ----------
+  bucket : S3 bucket the object lives in,
+  key : object's name in bucket
+
+  Returns
+  -------
+  size in bytes or None if the object doesn't exist (or upon an error)
+  """
+
+  try:
+    return bucket.Object(key).content_length
+
+  except Exception as e:
+    logging.error("awss3.get_object_size() failed:")
+    logging.error(e)
+    return None
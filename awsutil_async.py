@@ -0,0 +1,216 @@
+#
+# awsutil_async.py
+#
+# Helper functions that interact with AWS S3 from asyncio code.
+# Mirrors awsutil.py, with the same return conventions (None
+# upon an error), but built on aiobotocore so many transfers
+# can be in flight at once from a single event loop. Since
+# aiobotocore has no resource objects, functions take an S3
+# client plus a bucket name rather than a bucket object. Local
+# file reads and writes, which block for as long as the disk
+# takes, run in worker threads (asyncio.to_thread) so a slow
+# disk doesn't stall every other coroutine on the event loop.
+#
+# Usage:
+#
+#   async with awsutil_async.create_client(endpoint_url=...) as s3:
+#     await awsutil_async.upload_file("x.jpg", s3, bucketname, key)
+#
+
+import aiobotocore.session
+import botocore.config
+import asyncio
+import logging
+import os
+import uuid
+import pathlib
+
+
+CHUNK_SIZE = 1024 * 1024  # bytes read from a response body at a time
+PART_SIZE = 8 * 1024 * 1024  # files larger than this are uploaded in parts of this size
+
+
+###################################################################
+#
+# create_client
+#
+def create_client(region_name=None, endpoint_url=None, max_pool_connections=100, config=None):
+  """
+  Creates an async S3 client; use as "async with create_client() as s3:".
+  Credentials come from the default boto3 chain (e.g. the
+  AWS_SHARED_CREDENTIALS_FILE / AWS_PROFILE environment variables)
+
+  Parameters
+  ----------
+  region_name : optional AWS region,
+  endpoint_url : optional URL of a local S3 stand-in (moto, MinIO),
+  max_pool_connections : # of HTTP connections kept open to S3,
+  config : optional botocore Config to use instead, e.g. the tuned
+    one from awsutil.get_client_config
+
+  Returns
+  -------
+  an async context manager yielding the S3 client
+  """
+
+  session = aiobotocore.session.get_session()
+  if config is None:
+    config = botocore.config.Config(max_pool_connections=max_pool_connections)
+
+  return session.create_client('s3',
+                               region_name=region_name,
+                               endpoint_url=endpoint_url,
+                               config=config)
+
+
+###################################################################
+#
+# download_file
+#
+async def download_file(s3, bucketname, key):
+  """
+  Downloads a file from an S3 bucket
+
+  Parameters
+  ----------
+  s3 : async S3 client,
+  bucketname : name of S3 bucket to download from,
+  key : object's name in bucket
+
+  Returns
+  -------
+  filename of downloaded file or None upon an error
+  """
+
+  try:
+    #
+    # generate a unique filename:
+    #
+    filename = str(uuid.uuid4())
+    extension = pathlib.Path(key).suffix
+    filename += extension
+    #
+    # download, streaming the body to disk:
+    #
+    response = await s3.get_object(Bucket=bucketname, Key=key)
+    async with response['Body'] as stream:
+      f = await asyncio.to_thread(open, filename, "wb")
+      try:
+        while True:
+          chunk = await stream.read(CHUNK_SIZE)
+          if not chunk:
+            break
+          await asyncio.to_thread(f.write, chunk)
+      finally:
+        await asyncio.to_thread(f.close)
+    #
+    return filename
+
+  except Exception as e:
+    logging.error("awsutil_async.download_file() failed:")
+    logging.error(e)
+    return None
+
+
+###################################################################
+#
+# download_bytes
+#
+async def download_bytes(s3, bucketname, key):
+  """
+  Downloads an object from an S3 bucket into memory
+
+  Parameters
+  ----------
+  s3 : async S3 client,
+  bucketname : name of S3 bucket to download from,
+  key : object's name in bucket
+
+  Returns
+  -------
+  object's contents as bytes or None upon an error
+  """
+
+  try:
+    response = await s3.get_object(Bucket=bucketname, Key=key)
+    async with response['Body'] as stream:
+      return await stream.read()
+
+  except Exception as e:
+    logging.error("awsutil_async.download_bytes() failed:")
+    logging.error(e)
+    return None
+
+
+###################################################################
+#
+# upload_file
+#
+async def upload_file(local_filename, s3, bucketname, key):
+  """
+  Uploads a file to an S3 bucket, setting the content type to "image/jpeg" if
+  a jpg file and the permissions to be publicly readable
+
+  Parameters
+  ----------
+  local_filename : name of local file to upload,
+  s3 : async S3 client,
+  bucketname : name of S3 bucket to upload to,
+  key : object's name in the bucket after upload
+
+  Returns
+  -------
+  key that was passed in or None upon an error
+  """
+
+  try:
+    if key.endswith('jpg'):  # image file
+      content_type = 'image/jpeg'
+    else:  # default:
+      content_type = 'application/octet-stream'
+
+    f = await asyncio.to_thread(open, local_filename, "rb")
+    try:
+      size = await asyncio.to_thread(os.fstat, f.fileno())
+
+      if size.st_size <= PART_SIZE:
+        data = await asyncio.to_thread(f.read)
+        await s3.put_object(Bucket=bucketname,
+                            Key=key,
+                            Body=data,
+                            ACL='public-read',
+                            ContentType=content_type)
+        return key
+
+      #
+      # larger files go up in parts, one part in memory at a time:
+      #
+      upload = await s3.create_multipart_upload(Bucket=bucketname,
+                                                Key=key,
+                                                ACL='public-read',
+                                                ContentType=content_type)
+      upload_id = upload['UploadId']
+      try:
+        parts = []
+        while True:
+          data = await asyncio.to_thread(f.read, PART_SIZE)
+          if not data:
+            break
+          part = await s3.upload_part(Bucket=bucketname, Key=key, UploadId=upload_id,
+                                      PartNumber=len(parts) + 1, Body=data)
+          parts.append({'PartNumber': len(parts) + 1, 'ETag': part['ETag']})
+
+        await s3.complete_multipart_upload(Bucket=bucketname, Key=key, UploadId=upload_id,
+                                           MultipartUpload={'Parts': parts})
+      except BaseException:
+        await s3.abort_multipart_upload(Bucket=bucketname, Key=key, UploadId=upload_id)
+        raise
+      return key
+
+    finally:
+      await asyncio.to_thread(f.close)
+
+  except Exception as e:
+    logging.error("awsutil_async.upload_file() failed:")
+    logging.error(e)
+    return None
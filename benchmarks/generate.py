@@ -0,0 +1,295 @@
+#
+# generate.py
+#
+# Synthetic dataset generator for load and capacity testing:
+# adds users and assets to the photoapp database, and (unless
+# --no-s3) a matching S3 object for every asset, stored under the
+# same {bucketfolder}/{uuid}.jpg key scheme as main.upload. The
+# rows go in with multi-row inserts, the objects with a pool of
+# concurrent uploads, a chunk of assets at a time so memory stays
+# flat at any scale. Object sizes follow a configurable
+# distribution, and assets are spread over users with a
+# long-tailed (Pareto) skew, as real photo libraries are. The
+# maintained counters (S3 object count, user and asset totals,
+# per-user stats) are kept in step, so stats stays accurate.
+#
+#   python benchmarks/generate.py --config photoapp-config.ini \
+#       --users 10000 --assets 1000000 --sizes lognormal --median-size 2MB
+#
+# Generated users have emails synthetic-<run>-<n>@example.com,
+# where <run> is printed at the start, so a run can be found and
+# removed later.
+#
+
+import argparse
+import concurrent.futures
+import hashlib
+import math
+import os
+import pathlib
+import random
+import sys
+import time
+import uuid
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+import datatier
+import awsutil
+import main as photoapp
+
+
+CHUNK = 10000  # assets generated, uploaded and inserted at a time
+
+
+###################################################################
+#
+# SizeDistribution
+#
+class SizeDistribution:
+  """
+  Draws object sizes in bytes
+
+  Parameters
+  ----------
+  kind : "lognormal" (median, sigma), "uniform" (min..max) or
+    "fixed" (median),
+  median : median (or fixed) size in bytes,
+  sigma : spread of the lognormal, in natural-log units,
+  min_size / max_size : sizes are clamped to this range
+  """
+
+  def __init__(self, kind, median, sigma, min_size, max_size):
+    self.kind = kind
+    self.median = median
+    self.sigma = sigma
+    self.min_size = min_size
+    self.max_size = max_size
+
+  def draw(self, rng):
+    if self.kind == "fixed":
+      size = self.median
+    elif self.kind == "uniform":
+      size = rng.randint(self.min_size, self.max_size)
+    else:
+      size = int(rng.lognormvariate(math.log(self.median), self.sigma))
+    return max(self.min_size, min(self.max_size, size))
+
+
+###################################################################
+#
+# ContentSource
+#
+# Produces distinct JPEG-looking contents of any size cheaply:
+# a real sample photo, then bytes from a shared random block,
+# then a unique id (JPEG decoders stop at the end-of-image marker
+# and ignore what follows). Distinct contents keep content-hash
+# deduplication from collapsing the dataset.
+#
+class ContentSource:
+  def __init__(self, max_size):
+    samples = sorted(REPO.glob("test0*.jpg"))
+    self.prefix = samples[0].read_bytes() if samples else b"\xff\xd8\xff\xd9"
+    self.block = os.urandom(min(max_size, 64 * 1024 * 1024))
+
+  def make(self, size):
+    tag = uuid.uuid4().bytes
+    body = size - len(tag)
+    if body <= len(self.prefix):
+      return self.prefix[:max(body, 0)] + tag
+
+    filler = body - len(self.prefix)
+    parts = [self.prefix]
+    while filler > 0:
+      n = min(filler, len(self.block))
+      parts.append(self.block[:n])
+      filler -= n
+    parts.append(tag)
+    return b"".join(parts)
+
+
+###################################################################
+#
+# add_users
+#
+def add_users(dbConn, run, num_users):
+  """
+  Inserts num_users synthetic users
+
+  Returns
+  -------
+  list of (userid, bucketfolder)
+  """
+  for start in range(0, num_users, CHUNK):
+    rows = [[f"synthetic-{run}-{i}@example.com", f"Last{i}", f"First{i}", str(uuid.uuid4())]
+            for i in range(start, min(start + CHUNK, num_users))]
+    if datatier.perform_batch(dbConn, """
+        INSERT INTO users (email, lastname, firstname, bucketfolder)
+        VALUES (%s, %s, %s, %s)
+        """, rows) == -1:
+      raise RuntimeError("failed to insert users")
+    photoapp.add_to_counter(dbConn, "users", len(rows))
+
+  return list(datatier.iter_rows(dbConn, """
+    SELECT userid, bucketfolder FROM users
+    WHERE email LIKE %s
+    ORDER BY userid;
+    """, [f"synthetic-{run}-%"]))
+
+
+###################################################################
+#
+# add_assets
+#
+def add_assets(dbConn, bucket, users, num_assets, sizes, skew, workers, rng, upload):
+  """
+  Generates num_assets assets in chunks: draws owners and sizes,
+  uploads the objects concurrently (if upload), then records the
+  chunk with one multi-row insert and updates the counters; bucket
+  is only used if upload (pass None otherwise)
+
+  Returns
+  -------
+  (# of assets recorded, # of bytes)
+  """
+  #
+  # user weights ~ Pareto, so a few users own many assets and
+  # most own a few:
+  #
+  weights = [rng.paretovariate(skew) for _ in users]
+  cum_weights = []
+  total = 0.0
+  for w in weights:
+    total += w
+    cum_weights.append(total)
+
+  source = ContentSource(sizes.max_size) if upload else None
+  recorded = 0
+  recorded_bytes = 0
+  start_time = time.perf_counter()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    for start in range(0, num_assets, CHUNK):
+      n = min(CHUNK, num_assets - start)
+      owners = rng.choices(users, cum_weights=cum_weights, k=n)
+
+      planned = []  # (userid, assetname, bucketkey, size)
+      for (i, (userid, folder)) in enumerate(owners):
+        planned.append((userid, f"IMG_{start + i:08d}.jpg",
+                        f"{folder}/{uuid.uuid4()}.jpg", sizes.draw(rng)))
+
+      def make_one(asset):
+        if not upload:
+          return (True, None)  # rows only: no contents, no hash
+        data = source.make(asset[3])
+        if awsutil.upload_bytes(data, bucket, asset[2]) is None:
+          return (False, None)
+        return (True, hashlib.sha256(data).hexdigest())
+
+      rows = []
+      per_user = {}
+      for (asset, (ok, digest)) in zip(planned, executor.map(make_one, planned)):
+        if not ok:
+          continue  # upload failed (already logged), leave it out
+        (userid, assetname, bucketkey, size) = asset
+        rows.append([userid, assetname, bucketkey, digest, size])
+        (count, nbytes) = per_user.get(userid, (0, 0))
+        per_user[userid] = (count + 1, nbytes + size)
+
+      if len(rows) == 0:
+        continue
+
+      #
+      # the rows and the aggregates they add to, in one transaction:
+      #
+      statements = [("""
+        INSERT INTO assets (userid, assetname, bucketkey, contenthash, bytes)
+        VALUES (%s, %s, %s, %s, %s)
+        """, rows)]
+      statements.append(("""
+        INSERT INTO userstats (userid, numassets, totalbytes)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE numassets = numassets + VALUES(numassets),
+                                totalbytes = totalbytes + VALUES(totalbytes);
+        """, [[userid, count, nbytes] for (userid, (count, nbytes)) in per_user.items()]))
+      statements.append(("""
+        UPDATE counters SET value = value + %s
+        WHERE name = %s;
+        """, [[len(rows), "assets"],
+              [sum(nbytes for (_, nbytes) in per_user.values()), "assetbytes"]]))
+      if upload:
+        statements += photoapp.object_count_statements(bucket.name, len(rows))
+
+      if datatier.perform_transaction(dbConn, statements) is None:
+        raise RuntimeError("failed to insert assets")
+
+      recorded += len(rows)
+      recorded_bytes += sum(nbytes for (_, nbytes) in per_user.values())
+
+      elapsed = time.perf_counter() - start_time
+      print(f"  {recorded:,} / {num_assets:,} assets, {recorded_bytes / 1024 ** 3:.2f} GB "
+            f"({recorded / elapsed:.0f} assets/s)")
+
+  return (recorded, recorded_bytes)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="photoapp synthetic dataset generator")
+  parser.add_argument("--config", default="photoapp-config.ini", help="photoapp config file")
+  parser.add_argument("--users", type=int, default=1000, help="# of users to add")
+  parser.add_argument("--assets", type=int, default=100000, help="# of assets to add")
+  parser.add_argument("--sizes", choices=["lognormal", "uniform", "fixed"], default="lognormal",
+                      help="object size distribution")
+  parser.add_argument("--median-size", default="2MB", help="median (or fixed) object size")
+  parser.add_argument("--sigma", type=float, default=0.8, help="lognormal spread")
+  parser.add_argument("--min-size", default="16KB", help="smallest object size")
+  parser.add_argument("--max-size", default="32MB", help="largest object size")
+  parser.add_argument("--skew", type=float, default=1.5,
+                      help="Pareto shape of assets per user (smaller = more skewed)")
+  parser.add_argument("--workers", type=int, default=32, help="concurrent uploads")
+  parser.add_argument("--no-s3", action="store_true", help="only add database rows (with their drawn sizes), no S3 objects")
+  parser.add_argument("--seed", type=int, help="random seed, for a reproducible dataset shape")
+  args = parser.parse_args()
+
+  if args.users < 1:
+    parser.error("--users must be at least 1 (the assets need owners)")
+  if args.assets < 0:
+    parser.error("--assets must not be negative")
+  if args.workers < 1:
+    parser.error("--workers must be at least 1")
+
+  if not pathlib.Path(args.config).is_file():
+    print(f"**ERROR: config file '{args.config}' does not exist, exiting")
+    return 1
+
+  sizes = SizeDistribution(args.sizes, awsutil.parse_size(args.median_size), args.sigma,
+                           awsutil.parse_size(args.min_size), awsutil.parse_size(args.max_size))
+  rng = random.Random(args.seed)
+  run = uuid.uuid4().hex[:8]
+
+  session = photoapp.Session(args.config)
+  dbConn = session.dbPool.checkout()
+  if dbConn is None:
+    print("**ERROR: unable to connect to database, exiting")
+    return 1
+
+  try:
+    print(f"run {run}: adding {args.users:,} users...")
+    users = add_users(dbConn, run, args.users)
+
+    print(f"adding {args.assets:,} assets{'' if args.no_s3 else ' and S3 objects'}...")
+    bucket = None if args.no_s3 else session.bucket  # --no-s3 never sets up S3
+    (num_assets, num_bytes) = add_assets(dbConn, bucket, users, args.assets, sizes,
+                                         args.skew, args.workers, rng, upload=not args.no_s3)
+
+    print(f"done: {len(users):,} users, {num_assets:,} assets, {num_bytes:,} bytes")
+    return 0
+
+  finally:
+    session.dbPool.checkin(dbConn)
+    session.close()
+
+
+if __name__ == "__main__":
+  sys.exit(main())
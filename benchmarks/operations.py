@@ -0,0 +1,591 @@
+#
+# operations.py
+#
+# Throughput / latency benchmark for the data tier, the S3
+# helpers and the main.py commands, run against local stand-ins:
+# a MySQL server (an existing one named in a config file, or a
+# throwaway mysql:8.0 docker container) seeded with the users /
+# assets schema at a chosen scale, and an in-process moto S3
+# server. Each operation is run --iterations times and reported
+# as ops/sec plus p50 / p99 latency, optionally as JSON so runs
+# of different versions can be diffed (see --compare).
+#
+#   python benchmarks/operations.py --mysql-docker --assets 100000 --json out.json
+#   python benchmarks/operations.py --config bench.ini --compare before.json
+#
+# With --config, the [rds] section names the MySQL server (the
+# database is created if need be) and, if it has an endpoint_url,
+# the [s3] section names an S3 stand-in (e.g. MinIO) to use
+# instead of moto. Seeded rows are kept between runs: seeding only
+# tops the tables up to the requested scale.
+#
+
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import os
+import pathlib
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+import datatier
+import awsutil
+import main as photoapp
+
+
+BENCH_BUCKET = "photoapp-bench"
+SEED_BATCH = 10000  # rows per multi-row INSERT when seeding
+
+#
+# base tables (the rest of the schema is schema-updates.sql):
+#
+BASE_SCHEMA = [
+  """
+  CREATE TABLE IF NOT EXISTS users
+  (
+      userid        INT NOT NULL AUTO_INCREMENT,
+      email         VARCHAR(128) NOT NULL,
+      lastname      VARCHAR(64) NOT NULL,
+      firstname     VARCHAR(64) NOT NULL,
+      bucketfolder  VARCHAR(48) NOT NULL,
+      PRIMARY KEY (userid),
+      UNIQUE (email),
+      UNIQUE (bucketfolder)
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS assets
+  (
+      assetid    INT NOT NULL AUTO_INCREMENT,
+      userid     INT NOT NULL,
+      assetname  VARCHAR(128) NOT NULL,
+      bucketkey  VARCHAR(128) NOT NULL,
+      PRIMARY KEY (assetid),
+      FOREIGN KEY (userid) REFERENCES users(userid)
+  );
+  """
+]
+
+
+###################################################################
+#
+# percentile
+#
+def percentile(samples, p):
+  """
+  Nearest-rank percentile of a list of numbers
+
+  Parameters
+  ----------
+  samples : non-empty list of numbers,
+  p : percentile (0..100)
+
+  Returns
+  -------
+  the sample at that rank
+  """
+  ordered = sorted(samples)
+  rank = max(1, min(len(ordered), round(p / 100 * len(ordered) + 0.5)))
+  return ordered[rank - 1]
+
+
+###################################################################
+#
+# measure
+#
+def measure(func, iterations, warmup=2):
+  """
+  Calls a function repeatedly and summarizes how long it took
+
+  Parameters
+  ----------
+  func : function of no arguments; returns False/None/-1 to flag
+    a failed call,
+  iterations : # of timed calls,
+  warmup : # of untimed calls made first
+
+  Returns
+  -------
+  dictionary of iterations, errors, ops_per_sec, mean_ms, p50_ms,
+  p99_ms and max_ms
+  """
+  for _ in range(warmup):
+    func()
+
+  latencies = []
+  errors = 0
+  start = time.perf_counter()
+  for _ in range(iterations):
+    t0 = time.perf_counter()
+    result = func()
+    latencies.append(time.perf_counter() - t0)
+    if result is None or result is False or (isinstance(result, int) and result < 0):
+      errors += 1
+  total = time.perf_counter() - start
+
+  return {
+    "iterations": iterations,
+    "errors": errors,
+    "ops_per_sec": iterations / total if total > 0 else None,
+    "mean_ms": statistics.mean(latencies) * 1000,
+    "p50_ms": percentile(latencies, 50) * 1000,
+    "p99_ms": percentile(latencies, 99) * 1000,
+    "max_ms": max(latencies) * 1000
+  }
+
+
+###################################################################
+#
+# start_mysql_docker
+#
+def start_mysql_docker(port, image="mysql:8.0", timeout=180):
+  """
+  Starts a throwaway MySQL container and waits until it accepts
+  connections
+
+  Parameters
+  ----------
+  port : local port to publish MySQL on,
+  image : docker image to run,
+  timeout : seconds to wait for the server to come up
+
+  Returns
+  -------
+  (container id, connection settings dictionary)
+  """
+  container = subprocess.run(["docker", "run", "-d", "--rm",
+                              "-e", "MYSQL_ROOT_PASSWORD=bench",
+                              "-e", "MYSQL_DATABASE=photoapp",
+                              "-p", f"127.0.0.1:{port}:3306",
+                              image],
+                             capture_output=True, text=True, check=True).stdout.strip()
+
+  settings = {"endpoint": "127.0.0.1", "portnum": port, "username": "root",
+              "pwd": "bench", "dbname": "photoapp"}
+
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      import pymysql
+      pymysql.connect(host="127.0.0.1", port=port, user="root",
+                      passwd="bench", database="photoapp").close()
+      return (container, settings)
+    except Exception:
+      time.sleep(2)
+
+  subprocess.run(["docker", "stop", container], capture_output=True)
+  raise RuntimeError(f"MySQL container did not come up within {timeout} secs")
+
+
+###################################################################
+#
+# mysql_settings_from_config
+#
+def mysql_settings_from_config(configur):
+  """
+  Reads the [rds] section of a photoapp config file, creating the
+  database if it doesn't exist yet
+
+  Returns
+  -------
+  connection settings dictionary
+  """
+  settings = {"endpoint": configur.get('rds', 'endpoint'),
+              "portnum": configur.getint('rds', 'port_number'),
+              "username": configur.get('rds', 'user_name'),
+              "pwd": configur.get('rds', 'user_pwd'),
+              "dbname": configur.get('rds', 'db_name')}
+
+  import pymysql
+  conn = pymysql.connect(host=settings["endpoint"], port=settings["portnum"],
+                         user=settings["username"], passwd=settings["pwd"])
+  try:
+    with conn.cursor() as cursor:
+      cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{settings['dbname']}`;")
+  finally:
+    conn.close()
+
+  return settings
+
+
+###################################################################
+#
+# ensure_schema
+#
+def ensure_schema(dbConn):
+  """
+  Creates the users / assets tables and applies schema-updates.sql
+  (statements that were already applied are skipped)
+  """
+  for sql in BASE_SCHEMA:
+    if datatier.perform_action(dbConn, sql) == -1:
+      raise RuntimeError("failed to create base tables")
+
+  text = (REPO / "schema-updates.sql").read_text()
+  lines = [line for line in text.splitlines() if not line.strip().startswith("--")]
+  for sql in "\n".join(lines).split(";"):
+    sql = sql.strip()
+    if sql == "" or sql.upper().startswith("USE "):
+      continue
+    dbCursor = dbConn.cursor()
+    try:
+      dbCursor.execute(sql)
+      dbConn.commit()
+    except Exception:
+      dbConn.rollback()  # e.g. column already added by an earlier run
+    finally:
+      dbCursor.close()
+
+
+###################################################################
+#
+# seed
+#
+def seed(dbConn, num_users, num_assets):
+  """
+  Tops the users and assets tables up to the requested # of rows
+  with multi-row inserts, keeping userstats and the counters in
+  step as the app does; assets are spread evenly over the users.
+  Neither table is loaded into memory: users are read a batch at
+  a time, and the benchmarks draw ids from the tables' id ranges
+
+  Returns
+  -------
+  ((# of users, first userid, last userid),
+   (# of assets, first assetid, last assetid))
+  """
+  row = datatier.retrieve_one_row(dbConn, "SELECT COUNT(*) FROM users;")
+  for start in range(row[0], num_users, SEED_BATCH):
+    rows = []
+    for i in range(start, min(start + SEED_BATCH, num_users)):
+      rows.append([f"bench{i}@example.com", f"Last{i}", f"First{i}", str(uuid.uuid4())])
+    if datatier.perform_transaction(dbConn, [
+        ("""
+        INSERT INTO users (email, lastname, firstname, bucketfolder)
+        VALUES (%s, %s, %s, %s)
+        """, rows),
+        ("""
+        UPDATE counters SET value = value + %s
+        WHERE name = 'users';
+        """, [len(rows)])]) is None:
+      raise RuntimeError("failed to seed users")
+
+  def owners():
+    # (userid, bucketfolder) of every user in turn, forever
+    last = 0
+    while True:
+      batch = datatier.retrieve_all_rows(dbConn, """
+        SELECT userid, bucketfolder FROM users
+        WHERE userid > %s ORDER BY userid LIMIT %s;
+        """, [last, SEED_BATCH])
+      if batch is None:
+        raise RuntimeError("failed to read users")
+      if len(batch) == 0:
+        if last == 0:
+          raise RuntimeError("no users to own the assets")
+        last = 0
+        continue
+      yield from batch
+      last = batch[-1][0]
+
+  owner = owners()
+
+  row = datatier.retrieve_one_row(dbConn, "SELECT COUNT(*) FROM assets;")
+  for start in range(row[0], num_assets, SEED_BATCH):
+    rows = []
+    per_user = {}
+    for i in range(start, min(start + SEED_BATCH, num_assets)):
+      (userid, folder) = next(owner)
+      rows.append([userid, f"photo{i}.jpg", f"{folder}/{uuid.uuid4()}.jpg"])
+      per_user[userid] = per_user.get(userid, 0) + 1
+    #
+    # seeded assets have no contents, so they add no bytes:
+    #
+    if datatier.perform_transaction(dbConn, [
+        ("""
+        INSERT INTO assets (userid, assetname, bucketkey, bytes)
+        VALUES (%s, %s, %s, 0)
+        """, rows),
+        ("""
+        INSERT INTO userstats (userid, numassets, totalbytes)
+        VALUES (%s, %s, 0)
+        ON DUPLICATE KEY UPDATE numassets = numassets + VALUES(numassets);
+        """, [[userid, count] for (userid, count) in per_user.items()]),
+        ("""
+        UPDATE counters SET value = value + %s
+        WHERE name = 'assets';
+        """, [len(rows)])]) is None:
+      raise RuntimeError("failed to seed assets")
+    print(f"  seeded {min(start + SEED_BATCH, num_assets):,} / {num_assets:,} assets", file=sys.stderr)
+
+  users = datatier.retrieve_one_row(dbConn, "SELECT COUNT(*), MIN(userid), MAX(userid) FROM users;")
+  assets = datatier.retrieve_one_row(dbConn, "SELECT COUNT(*), MIN(assetid), MAX(assetid) FROM assets;")
+  return (tuple(users), tuple(assets))
+
+
+###################################################################
+#
+# start_s3
+#
+def start_s3(configur):
+  """
+  Returns an S3 bucket object for the benchmark bucket, on the
+  config file's [s3] endpoint_url if given, otherwise on a moto
+  server started in-process (requires moto[server])
+
+  Returns
+  -------
+  (bucket, moto server to stop afterwards or None)
+  """
+  if configur is None:
+    configur = configparser.ConfigParser()
+  if not configur.has_section('s3'):
+    configur.add_section('s3')
+
+  endpoint_url = configur.get('s3', 'endpoint_url', fallback=None)
+  server = None
+
+  if endpoint_url is None:
+    from moto.server import ThreadedMotoServer
+    for (name, value) in [("AWS_ACCESS_KEY_ID", "bench"), ("AWS_SECRET_ACCESS_KEY", "bench"),
+                          ("AWS_DEFAULT_REGION", "us-east-1")]:
+      os.environ.setdefault(name, value)
+    import logging
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # no per-request log lines
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    (host, port) = server.get_host_and_port()
+    configur.set('s3', 'endpoint_url', f"http://{host}:{port}")
+
+  # the same tuned, shared S3 resource main.py uses:
+  bucket = awsutil.get_s3_resource(configur).Bucket(BENCH_BUCKET)
+  try:
+    bucket.create()
+  except Exception:
+    pass  # already exists
+
+  return (bucket, server)
+
+
+###################################################################
+#
+# run_benchmarks
+#
+def run_benchmarks(dbConn, bucket, users, assets, iterations, workdir):
+  """
+  Times each operation; users and assets are the (count, first id,
+  last id) of each table, as returned by seed
+
+  Returns
+  -------
+  dictionary of operation name => measure() results
+  """
+  results = {}
+  rng = random.Random(42)
+  any_userid = lambda: rng.randint(users[1], users[2])
+  any_assetid = lambda: rng.randint(assets[1], assets[2])
+  samples = sorted(REPO.glob("test0*.jpg"))
+  sample = str(samples[0])
+
+  def run(name, func):
+    print(f"  {name}...", file=sys.stderr)
+    results[name] = measure(func, iterations)
+
+  #
+  # data tier:
+  #
+  run("datatier.retrieve_one_row", lambda: datatier.retrieve_one_row(
+    dbConn, "SELECT * FROM assets WHERE assetid = %s;", [any_assetid()]))
+  run("datatier.retrieve_all_rows", lambda: datatier.retrieve_all_rows(
+    dbConn, "SELECT * FROM assets WHERE userid = %s;", [any_userid()]))
+  run("datatier.retrieve_page", lambda: datatier.retrieve_page(
+    dbConn, "assets", "assetid", any_assetid(), 25))
+  run("datatier.perform_action", lambda: datatier.perform_action(
+    dbConn, "UPDATE counters SET value = value + 1 WHERE name = %s;", ["bench"]))
+
+  #
+  # S3 helpers; the uploaded keys are reused by the downloads:
+  #
+  keys = []
+
+  def upload_one():
+    key = f"bench/{uuid.uuid4()}.jpg"
+    keys.append(key)
+    return awsutil.upload_file(sample, bucket, key)
+
+  def download_one():
+    filename = awsutil.download_file(bucket, rng.choice(keys))
+    if filename is not None:
+      os.remove(filename)
+    return filename
+
+  run("awsutil.upload_file", upload_one)
+  run("awsutil.download_file", download_one)
+  run("awsutil.download_bytes", lambda: awsutil.download_bytes(bucket, rng.choice(keys)))
+
+  #
+  # main.py commands, with their output discarded. upload skips
+  # content it has seen before, so each call gets a copy of the
+  # sample made unique by trailing bytes (which JPEG ignores):
+  #
+  userid = users[1]
+  data = pathlib.Path(sample).read_bytes()
+  copies = []
+  for i in range(iterations + 3):
+    copy = os.path.join(workdir, f"upload{i}.jpg")
+    with open(copy, "wb") as f:
+      f.write(data + uuid.uuid4().bytes)
+    copies.append(copy)
+
+  with contextlib.redirect_stdout(io.StringIO()):
+    photoapp.upload(dbConn, bucket, filename=copies.pop(), userid=userid)
+  row = datatier.retrieve_one_row(dbConn, "SELECT MAX(assetid) FROM assets WHERE userid = %s;", [userid])
+  real_assetid = row[0]
+
+  def command(func):
+    def call():
+      with contextlib.redirect_stdout(io.StringIO()):
+        return func()
+    return call
+
+  run("main.stats", command(lambda: photoapp.stats(BENCH_BUCKET, lambda: bucket, "bench", dbConn)))
+  run("main.users", command(lambda: photoapp.users(dbConn, page_size=25)))
+  run("main.assets", command(lambda: photoapp.assets(dbConn, page_size=25)))
+  run("main.download", command(lambda: photoapp.download(dbConn, bucket, assetid=real_assetid)))
+  run("main.upload", command(lambda: photoapp.upload(dbConn, bucket, filename=copies.pop(), userid=userid)))
+  run("main.add_user", command(lambda: photoapp.add_user(
+    dbConn, f"bench-{uuid.uuid4()}@example.com", "Bench", "Mark")))
+
+  for filename in os.listdir(workdir):  # upload copies, main.download's files
+    os.remove(os.path.join(workdir, filename))
+
+  return results
+
+
+###################################################################
+#
+# compare
+#
+def compare(before, after):
+  """
+  Prints how each operation's latency changed between two runs
+  """
+  print(f"{'operation':<28} {'p50 ms':>18} {'p99 ms':>18}")
+  for (name, now) in after["results"].items():
+    then = before.get("results", {}).get(name)
+    if then is None:
+      print(f"{name:<28} {'(new)':>18}")
+      continue
+    cells = []
+    for stat in ["p50_ms", "p99_ms"]:
+      change = (now[stat] - then[stat]) / then[stat] * 100 if then[stat] else 0.0
+      cells.append(f"{now[stat]:8.2f} ({change:+5.0f}%)")
+    print(f"{name:<28} {cells[0]:>18} {cells[1]:>18}")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="photoapp data tier / S3 / command benchmark")
+  where = parser.add_mutually_exclusive_group(required=True)
+  where.add_argument("--config", help="photoapp config file naming the MySQL server ([rds]) "
+                                      "and optionally an S3 endpoint_url ([s3])")
+  where.add_argument("--mysql-docker", action="store_true", help="run MySQL in a throwaway docker container")
+  parser.add_argument("--mysql-port", type=int, default=13306, help="local port for --mysql-docker")
+  parser.add_argument("--users", type=int, default=1000, help="# of users to seed")
+  parser.add_argument("--assets", type=int, default=10000, help="# of assets to seed (10k - 10M)")
+  parser.add_argument("--iterations", type=int, default=200, help="timed calls per operation")
+  parser.add_argument("--json", metavar="FILE", help="write results as JSON ('-' for stdout)")
+  parser.add_argument("--compare", metavar="FILE", help="JSON results of an earlier run to compare against")
+  args = parser.parse_args()
+
+  # the benchmark runs in a scratch directory, so pin paths first:
+  if args.json and args.json != "-":
+    args.json = os.path.abspath(args.json)
+  if args.compare:
+    args.compare = os.path.abspath(args.compare)
+
+  container = None
+  server = None
+  configur = None
+
+  try:
+    if args.mysql_docker:
+      print("starting MySQL container...", file=sys.stderr)
+      (container, settings) = start_mysql_docker(args.mysql_port)
+    else:
+      configur = configparser.ConfigParser()
+      configur.read(args.config)
+      settings = mysql_settings_from_config(configur)
+
+    dbConn = datatier.get_dbConn(settings["endpoint"], settings["portnum"], settings["username"],
+                                 settings["pwd"], settings["dbname"])
+    if dbConn is None:
+      print("**ERROR: unable to connect to MySQL", file=sys.stderr)
+      return 1
+
+    ensure_schema(dbConn)
+    photoapp.set_counter(dbConn, "bench", 0)
+    print(f"seeding to {args.users:,} users / {args.assets:,} assets...", file=sys.stderr)
+    (users, assets) = seed(dbConn, args.users, args.assets)
+
+    (bucket, server) = start_s3(configur)
+
+    workdir = tempfile.mkdtemp(prefix="photoapp-bench-")
+    os.chdir(workdir)  # downloads land in the current directory
+
+    print("benchmarking...", file=sys.stderr)
+    results = run_benchmarks(dbConn, bucket, users, assets, args.iterations, workdir)
+    dbConn.close()
+
+    try:
+      commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+      commit = None
+
+    report = {
+      "meta": {
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "users": users[0],
+        "assets": assets[0],
+        "iterations": args.iterations
+      },
+      "results": results
+    }
+
+    if args.json == "-":
+      print(json.dumps(report, indent=2))
+    elif args.json:
+      with open(args.json, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+      with open(args.compare) as f:
+        compare(json.load(f), report)
+    elif args.json != "-":
+      for (name, r) in results.items():
+        print(f"{name:<28} {r['ops_per_sec']:10.1f} ops/s  p50 {r['p50_ms']:8.2f} ms  "
+              f"p99 {r['p99_ms']:8.2f} ms  errors {r['errors']}")
+
+    return 0
+
+  finally:
+    if server is not None:
+      server.stop()
+    if container is not None:
+      subprocess.run(["docker", "stop", container], capture_output=True)
+
+
+if __name__ == "__main__":
+  sys.exit(main())
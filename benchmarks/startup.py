@@ -0,0 +1,136 @@
+#
+# startup.py
+#
+# Startup-time benchmark for photoapp: measures how long it
+# takes to import main.py (via "python -X importtime") and to
+# run "main.py --help" end to end, and lists the slowest
+# imports. Run from anywhere:
+#
+#   python benchmarks/startup.py [--runs N] [--top N] [--json]
+#
+
+import argparse
+import json
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+
+
+###################################################################
+#
+# import_times
+#
+def import_times(module):
+  """
+  Imports a module in a fresh interpreter with -X importtime and
+  parses the report
+
+  Parameters
+  ----------
+  module : name of the module to import
+
+  Returns
+  -------
+  list of (module name, self microseconds, cumulative microseconds),
+  in import order
+  """
+
+  result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=REPO, capture_output=True, text=True, check=True)
+
+  times = []
+  for line in result.stderr.splitlines():
+    # "import time:   self [us] | cumulative | imported package"
+    if not line.startswith("import time:") or "[us]" in line:
+      continue
+    (self_us, cumulative_us, name) = line[len("import time:"):].split("|")
+    times.append((name.strip(), int(self_us), int(cumulative_us)))
+
+  return times
+
+
+###################################################################
+#
+# wall_time
+#
+def wall_time(args, runs):
+  """
+  Runs a command in a fresh interpreter several times
+
+  Parameters
+  ----------
+  args : arguments to pass to python,
+  runs : # of times to run it
+
+  Returns
+  -------
+  list of wall-clock times in seconds
+  """
+
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=REPO, capture_output=True, check=True)
+    times.append(time.perf_counter() - start)
+  return times
+
+
+def main():
+  parser = argparse.ArgumentParser(description="photoapp startup-time benchmark")
+  parser.add_argument("--runs", type=int, default=5, help="runs per measurement")
+  parser.add_argument("--top", type=int, default=10, help="# of slowest imports to list")
+  parser.add_argument("--json", action="store_true", help="print results as JSON")
+  args = parser.parse_args()
+
+  results = {"python": sys.version.split()[0]}
+
+  #
+  # import cost of main and of the heavy optional modules, each
+  # in a fresh interpreter so nothing is already cached:
+  #
+  for module in ["main", "boto3", "matplotlib.pyplot"]:
+    samples = []
+    for _ in range(args.runs):
+      try:
+        times = import_times(module)
+      except subprocess.CalledProcessError:
+        break  # module not installed
+      samples.append(times)
+    if not samples:
+      results[f"import {module}"] = None
+      continue
+
+    totals = [t[-1][2] / 1e6 for t in samples]  # last line is the module itself
+    results[f"import {module}"] = {"median_secs": statistics.median(totals)}
+
+    if module == "main":
+      top = sorted(samples[-1], key=lambda t: t[1], reverse=True)[:args.top]
+      results["slowest imports (self secs)"] = {name: us / 1e6 for (name, us, _) in top}
+      loaded = {name for (name, _, _) in samples[-1]}
+      results["main loads boto3"] = "boto3" in loaded
+      results["main loads matplotlib"] = "matplotlib" in loaded
+
+  help_times = wall_time([str(REPO / "main.py"), "--help"], args.runs)
+  results["main.py --help"] = {"median_secs": statistics.median(help_times),
+                               "min_secs": min(help_times)}
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+    return
+
+  for (name, value) in results.items():
+    if isinstance(value, dict):
+      print(f"{name}:")
+      for (k, v) in value.items():
+        print(f"  {k}: {v:.4f}" if isinstance(v, float) else f"  {k}: {v}")
+    else:
+      print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+  main()
@@ -8,8 +8,17 @@
 #   Northwestern University
 #
 
+import metrics  # per-operation latency / error counts
+
 import pymysql
 import logging
+import threading
+import time
+import contextlib
+import collections
+import random
+import re
+import sys
 
 
 ###################################################################
@@ -19,6 +28,7 @@ import logging
 # Opens and returns a connection object for interacting with a
 # MySQL database.
 #
+@metrics.timed("datatier.get_dbConn", failed=metrics.is_none)
 def get_dbConn(endpoint, portnum, username, pwd, dbname):
   """
   Opens and returns a connection object for interacting 
@@ -37,13 +47,11 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
   a connection object or None upon an error
   """
   try:
-    dbConn = pymysql.connect(host=endpoint,
-                             port=portnum,
-                             user=username,
-                             passwd=pwd,
-                             database=dbname)
-
-    return dbConn
+    return _with_retry(None, "get_dbConn", lambda: pymysql.connect(host=endpoint,
+                                                                  port=portnum,
+                                                                  user=username,
+                                                                  passwd=pwd,
+                                                                  database=dbname))
 
   except Exception as e:
     logging.error("datatier.get_dbConn() failed:")
@@ -51,6 +59,538 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
     return None
 
 
+###################################################################
+#
+# Pool:
+#
+# A bounded pool of MySQL connections. Connections are opened
+# on demand up to max_size, handed out one at a time, and
+# returned to the pool when the caller is done; connections
+# that sit idle longer than idle_timeout seconds are closed.
+# A borrowed connection is a regular pymysql connection, so
+# it can be passed to retrieve_one_row, retrieve_all_rows and
+# perform_action as-is.
+#
+class Pool:
+  """
+  A bounded pool of MySQL database connections
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of server (string),
+  portnum : server port # (integer),
+  username : user name for login (string),
+  pwd : user password for login (string),
+  dbname : database name (string),
+  min_size : # of connections opened up front and kept open,
+  max_size : maximum # of connections open at once,
+  idle_timeout : seconds an idle connection is kept before closing,
+  checkout_timeout : seconds to wait for a free connection
+  """
+
+  def __init__(self, endpoint, portnum, username, pwd, dbname,
+               min_size=1, max_size=10, idle_timeout=300,
+               checkout_timeout=30):
+    if min_size < 0 or max_size < 1 or min_size > max_size:
+      raise ValueError("Pool requires 0 <= min_size <= max_size and max_size >= 1")
+
+    self.endpoint = endpoint
+    self.portnum = portnum
+    self.username = username
+    self.pwd = pwd
+    self.dbname = dbname
+    self.min_size = min_size
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self.checkout_timeout = checkout_timeout
+
+    self._idle = []  # (dbConn, time returned to pool), most recent last
+    self._num_open = 0
+    self._closed = False
+    self._cond = threading.Condition()
+
+    for _ in range(min_size):
+      with self._cond:
+        self._num_open += 1
+      dbConn = self._open()
+      if dbConn is None:
+        break
+      self._idle.append((dbConn, time.monotonic()))
+
+  def _open(self):
+    #
+    # the caller has already reserved a slot (self._num_open += 1
+    # under self._cond), so concurrent checkouts can't together
+    # open more than max_size; give it back if connecting fails:
+    #
+    dbConn = get_dbConn(self.endpoint, self.portnum, self.username,
+                        self.pwd, self.dbname)
+    if dbConn is None:
+      with self._cond:
+        self._num_open -= 1
+        self._cond.notify()
+    return dbConn
+
+  def _discard(self, dbConn):
+    try:
+      dbConn.close()
+    except Exception:
+      pass  # already closed / broken
+    with self._cond:
+      self._num_open -= 1
+      self._cond.notify()
+
+  def _healthy(self, dbConn):
+    #
+    # health check on checkout: a cheap round trip that fails
+    # with OperationalError if the server dropped us:
+    #
+    try:
+      dbConn.ping(reconnect=False)
+      return True
+    except Exception:
+      return False
+
+  def _expire_idle(self):
+    # caller holds self._cond
+    now = time.monotonic()
+    expired = []
+    keep = []
+    for (dbConn, since) in self._idle:
+      if now - since > self.idle_timeout and \
+         self._num_open - len(expired) > self.min_size:
+        expired.append(dbConn)
+      else:
+        keep.append((dbConn, since))
+    self._idle = keep
+    return expired
+
+  def checkout(self):
+    """
+    Borrows a connection from the pool, opening a new one if
+    none are idle and the pool is below max_size; otherwise
+    waits up to checkout_timeout seconds for one to be returned
+
+    Returns
+    -------
+    a connection object or None upon an error / timeout
+    """
+    deadline = time.monotonic() + self.checkout_timeout
+
+    while True:
+      dbConn = None
+      expired = []
+      open_new = False
+
+      with self._cond:
+        while True:
+          if self._closed:
+            logging.error("datatier.Pool.checkout() failed: pool is closed")
+            return None
+          expired = self._expire_idle()
+          if self._idle:
+            dbConn = self._idle.pop()[0]
+            break
+          if self._num_open < self.max_size:
+            self._num_open += 1  # reserve the slot before connecting
+            open_new = True
+            break
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            logging.error("datatier.Pool.checkout() failed: timed out waiting for a connection")
+            return None
+          self._cond.wait(remaining)
+
+      for old in expired:
+        self._discard(old)
+
+      if open_new:
+        return self._open()
+
+      if self._healthy(dbConn):
+        return dbConn
+
+      #
+      # stale connection (server restart, failover, wait_timeout);
+      # throw it away and reconnect in its place:
+      #
+      logging.warning("datatier.Pool: discarding dead connection, reconnecting")
+      self._discard(dbConn)
+
+  def checkin(self, dbConn, broken=False):
+    """
+    Returns a borrowed connection to the pool
+
+    Parameters
+    ----------
+    dbConn : connection previously returned by checkout(),
+    broken : True if the connection should be closed rather
+      than reused (e.g. after an OperationalError)
+    """
+    if dbConn is None:
+      return
+
+    if broken or self._closed:
+      self._discard(dbConn)
+      return
+
+    try:
+      dbConn.rollback()  # don't leak an open transaction to the next borrower
+    except Exception:
+      self._discard(dbConn)
+      return
+
+    with self._cond:
+      self._idle.append((dbConn, time.monotonic()))
+      self._cond.notify()
+
+  @contextlib.contextmanager
+  def connection(self):
+    """
+    Context manager that borrows a connection for the duration
+    of a with block:
+
+      with pool.connection() as dbConn:
+        row = datatier.retrieve_one_row(dbConn, sql)
+
+    The connection is None if one could not be obtained. If the
+    block raises OperationalError the connection is discarded
+    rather than returned to the pool.
+    """
+    dbConn = self.checkout()
+    try:
+      yield dbConn
+    except pymysql.err.OperationalError:
+      self.checkin(dbConn, broken=True)
+      dbConn = None
+      raise
+    finally:
+      if dbConn is not None:
+        self.checkin(dbConn)
+
+  def close(self):
+    """
+    Closes all idle connections; connections still checked out
+    are closed as they are returned
+    """
+    with self._cond:
+      self._closed = True
+      idle = self._idle
+      self._idle = []
+      self._cond.notify_all()
+
+    for (dbConn, _) in idle:
+      self._discard(dbConn)
+
+
+###################################################################
+#
+# QueryCache:
+#
+# Optional in-process cache of SELECT results, so identical
+# queries issued again within ttl seconds (e.g. a dashboard
+# polling stats) are answered without a round trip. Entries are
+# keyed by the query text (whitespace normalized) plus its
+# parameters, bounded in total (estimated) size, and evicted
+# least recently used first. Writes made through this module
+# (perform_action, insert_returning_id, perform_batch,
+# perform_transaction) drop the
+# cached results of every query that reads the written table;
+# writes made by other processes are only seen once the ttl
+# runs out, so keep it short. Install a cache with
+# set_query_cache(); by default there is none. A query whose
+# tables can't be told from its text is never cached.
+#
+_TABLE = r"`?\w+`?(?:\s+(?:AS\s+)?`?\w+`?)?"  # table [[AS] alias]
+_TABLE_PATTERN = re.compile(
+  rf"\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+({_TABLE}(?:\s*,\s*{_TABLE})*)", re.IGNORECASE)
+
+
+def _tables_of(sql):
+  # every table named after FROM, JOIN, ..., including each one
+  # of a comma-separated list (FROM users u, assets a)
+  tables = set()
+  for names in _TABLE_PATTERN.findall(sql):
+    for name in names.split(","):
+      tables.add(name.split()[0].strip("`").lower())
+  return tables
+
+
+def _size_of(result):
+  # rough size in bytes: the containers plus their values
+  if isinstance(result, (tuple, list)):
+    return sys.getsizeof(result) + sum(_size_of(value) for value in result)
+  return sys.getsizeof(result)
+
+
+class QueryCache:
+  """
+  A TTL + LRU cache of query results
+
+  Parameters
+  ----------
+  ttl : seconds a cached result is served before re-querying,
+  max_bytes : upper bound on the (estimated) total size of
+    cached results
+  """
+
+  def __init__(self, ttl, max_bytes):
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+
+    self._entries = collections.OrderedDict()  # key => (expires, tables, size, result)
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, sql, parameters):
+    """
+    Returns the cache key of a query, or None if it can't be
+    cached (e.g. unhashable parameters)
+    """
+    try:
+      key = (" ".join(sql.split()).rstrip(";").rstrip(), tuple(parameters))
+      hash(key)
+      return key
+    except TypeError:
+      return None
+
+  def get(self, key):
+    """
+    Returns (True, result) if the key has a live entry, otherwise
+    (False, None)
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] <= time.monotonic():
+        if entry is not None:
+          self._remove(key)
+        self.misses += 1
+        return (False, None)
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return (True, entry[3])
+
+  def put(self, key, sql, result):
+    tables = _tables_of(sql)
+    if len(tables) == 0:  # no write could invalidate it
+      return
+
+    size = _size_of(result)
+    if size > self.max_bytes:
+      return
+
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = (time.monotonic() + self.ttl, tables, size, result)
+      self._bytes += size
+      while self._bytes > self.max_bytes:
+        self._remove(next(iter(self._entries)))
+
+  def invalidate(self, sql):
+    """
+    Drops cached results that read a table the given action
+    query writes (everything, if its table can't be told)
+    """
+    tables = _tables_of(sql)
+    with self._lock:
+      if len(tables) == 0:
+        self._entries.clear()
+        self._bytes = 0
+        return
+      stale = [key for (key, entry) in self._entries.items() if entry[1] & tables]
+      for key in stale:
+        self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def _remove(self, key):
+    # caller holds self._lock
+    entry = self._entries.pop(key)
+    self._bytes -= entry[2]
+
+
+_query_cache = None
+
+
+def set_query_cache(cache):
+  """
+  Installs the QueryCache used by retrieve_one_row and
+  retrieve_all_rows, or turns caching off if cache is None
+
+  Parameters
+  ----------
+  cache : a QueryCache or None
+  """
+  global _query_cache
+  _query_cache = cache
+
+
+def _cached(sql, parameters, run):
+  cache = _query_cache
+  if cache is None:
+    return run()
+
+  key = cache.key(sql, parameters)
+  if key is None:
+    return run()
+
+  (found, result) = cache.get(key)
+  if found:
+    return result
+
+  result = run()
+  if result is not None:  # errors aren't cached
+    cache.put(key, sql, result)
+  return result
+
+
+def _invalidate(sql):
+  cache = _query_cache
+  if cache is not None:
+    cache.invalidate(sql)
+
+
+###################################################################
+#
+# RetryPolicy:
+#
+# Transient failures (a lost or refused connection during an RDS
+# failover, a deadlock, a lock wait timeout) are retried with
+# exponential backoff and full jitter, so a brief outage doesn't
+# surface as an error and many clients don't all reconnect at
+# the same instant. Lost connections are reopened in place
+# (dbConn.ping(reconnect=True)), so pooled connections stay
+# usable. Permanent failures (SQL errors, constraint violations)
+# are never retried.
+#
+# Reads are always safe to retry. A write is only retried if it
+# cannot have been applied: the connection was refused or already
+# gone before the statement was sent, or the server rolled the
+# transaction back (deadlock / lock wait timeout). A connection
+# lost while waiting for a write's reply leaves the outcome
+# unknown, so that is retried only if the caller says the write
+# is idempotent.
+#
+# Retries, reconnects and give-ups are counted as metrics events
+# (datatier.retry, datatier.reconnect, datatier.retry_exhausted).
+#
+_CONNECTION_REFUSED = {1040, 1053, 2003}  # too many connections, shutting down, can't connect
+_CONNECTION_GONE = {2006, 4031}           # gone away, disconnected while idle: nothing sent
+_CONNECTION_LOST = {2013, 2055}           # lost during the query: outcome unknown
+_ROLLED_BACK = {1205, 1213}               # lock wait timeout, deadlock
+
+
+def _error_code(e):
+  if isinstance(e, pymysql.err.InterfaceError):
+    return 0  # connection already closed, nothing sent
+  if isinstance(e, pymysql.err.OperationalError) and e.args and isinstance(e.args[0], int):
+    return e.args[0]
+  return None
+
+
+def _needs_reconnect(e):
+  code = _error_code(e)
+  return code == 0 or code in _CONNECTION_REFUSED | _CONNECTION_GONE | _CONNECTION_LOST
+
+
+def _retry_safe(e, write, idempotent):
+  code = _error_code(e)
+  if code is None:
+    return False  # permanent
+  if code == 0 or code in _CONNECTION_REFUSED | _CONNECTION_GONE | _ROLLED_BACK:
+    return True
+  if code in _CONNECTION_LOST:
+    return not write or idempotent
+  return False
+
+
+class RetryPolicy:
+  """
+  How often, and how patiently, transient failures are retried
+
+  Parameters
+  ----------
+  max_attempts : total tries per call (1 turns retrying off),
+  base_delay : seconds to wait (at most) before the first retry;
+    doubles with each further retry,
+  max_delay : cap on the wait between tries
+  """
+
+  def __init__(self, max_attempts=3, base_delay=0.1, max_delay=2.0):
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+
+  def delay(self, attempt):
+    """
+    Seconds to wait after the given failed attempt (1, 2, ...):
+    uniformly random up to the exponential backoff ("full jitter")
+    """
+    return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+_retry_policy = RetryPolicy()
+
+
+def set_retry_policy(policy):
+  """
+  Installs the RetryPolicy used by this module's functions, or
+  turns retrying off if policy is None
+
+  Parameters
+  ----------
+  policy : a RetryPolicy or None
+  """
+  global _retry_policy
+  _retry_policy = policy
+
+
+def _with_retry(dbConn, name, attempt, write=False, idempotent=False):
+  #
+  # calls attempt() until it succeeds, the error is permanent or
+  # unsafe to retry, or the policy's attempts are used up; the
+  # last error is raised:
+  #
+  policy = _retry_policy
+  tries = 0
+
+  while True:
+    tries += 1
+    try:
+      return attempt()
+    except Exception as e:
+      if policy is None or not _retry_safe(e, write, idempotent):
+        raise
+      if tries >= policy.max_attempts:
+        metrics.increment("datatier.retry_exhausted")
+        raise
+
+      delay = policy.delay(tries)
+      logging.warning("datatier.%s() failed (%s), retrying in %.2f secs", name, e, delay)
+      metrics.increment("datatier.retry")
+      time.sleep(delay)
+
+      if dbConn is not None and _needs_reconnect(e):
+        try:
+          dbConn.ping(reconnect=True)
+          metrics.increment("datatier.reconnect")
+        except Exception:
+          pass  # still down; the next attempt fails and backs off again
+
+
+def _rollback(dbConn):
+  try:
+    dbConn.rollback()
+  except Exception:
+    pass  # connection is gone, and the transaction with it
+
+
 ##################################################################
 #
 # retrieve_one_row:
@@ -60,8 +600,11 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
 # the first row (tuple) retrieved by the query (the tuple
 # can be empty if the SELECT retrieved no data). The query
 # can be parameterized using %s, in which case pass the
-# values as a list [value1, value2, ...]
+# values as a list [value1, value2, ...]. If a QueryCache is
+# installed the result may come from the cache.
 #
+@metrics.timed("datatier.retrieve_one_row", failed=metrics.is_none,
+               rows=lambda row, *args, **kwargs: 0 if row == () else 1)
 def retrieve_one_row(dbConn, sql, parameters=[]):
   """
   Executes an sql SELECT query against the database connection
@@ -79,24 +622,30 @@ def retrieve_one_row(dbConn, sql, parameters=[]):
   or None upon an error
   """
 
-  dbCursor = dbConn.cursor()
+  return _cached(sql, parameters, lambda: _retrieve_one_row(dbConn, sql, parameters))
+
+
+def _retrieve_one_row(dbConn, sql, parameters):
+  def attempt():
+    dbCursor = dbConn.cursor()
+    try:
+      dbCursor.execute(sql, parameters)
+      row = dbCursor.fetchone()
+      if row is None:  # executed successfully, but no data was retrieved
+        return ()
+      else:
+        return row
+    finally:
+      dbCursor.close()
 
   try:
-    dbCursor.execute(sql, parameters)
-    row = dbCursor.fetchone()
-    if row is None:  # executed successfully, but no data was retrieved
-      return ()
-    else:
-      return row
+    return _with_retry(dbConn, "retrieve_one_row", attempt)
 
   except Exception as e:
     logging.error("datatier.retrieve_one_row() failed:")
     logging.error(e)
     return None
 
-  finally:
-    dbCursor.close()
-
 
 ##################################################################
 #
@@ -107,8 +656,11 @@ def retrieve_one_row(dbConn, sql, parameters=[]):
 # a list of rows (tuples) retrieved by the query. If the
 # query retrieves no data, the empty list [] is returned.
 # The query can be parameterized using %s, in which case
-# pass the values as a list [value1, value2, ...]
+# pass the values as a list [value1, value2, ...]. If a
+# QueryCache is installed the result may come from the cache.
 #
+@metrics.timed("datatier.retrieve_all_rows", failed=metrics.is_none,
+               rows=lambda rows, *args, **kwargs: len(rows))
 def retrieve_all_rows(dbConn, sql, parameters=[]):
   """
   Executes an sql SELECT query against the database connection
@@ -126,25 +678,128 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
   data) or None upon an error
   """
 
-  dbCursor = dbConn.cursor()
+  return _cached(sql, parameters, lambda: _retrieve_all_rows(dbConn, sql, parameters))
+
+
+def _retrieve_all_rows(dbConn, sql, parameters):
+  def attempt():
+    dbCursor = dbConn.cursor()
+    try:
+      dbCursor.execute(sql, parameters)
+      rows = dbCursor.fetchall()
+      if rows is None:  # executed successfully, but no data was retrieved
+        return []
+      else:
+        return rows
+    finally:
+      dbCursor.close()
 
   try:
-    dbCursor.execute(sql, parameters)
-    rows = dbCursor.fetchall()
-    if rows is None:  # executed successfully, but no data was retrieved
-      return []
-    else:
-      return rows
+    return _with_retry(dbConn, "retrieve_all_rows", attempt)
 
   except Exception as e:
     logging.error("datatier.retrieve_all_rows() failed:")
     logging.error(e)
     return None
 
+
+##################################################################
+#
+# iter_rows:
+#
+# Given a database connection and an SQL Select query,
+# executes this query using an unbuffered (server-side)
+# cursor and yields the rows (tuples) one at a time, fetching
+# them from the server batch_size rows at a time. Unlike
+# retrieve_all_rows, memory use stays flat no matter how many
+# rows the query returns. The connection cannot be used for
+# another query until the generator is exhausted or closed.
+# The query can be parameterized using %s, in which case
+# pass the values as a list [value1, value2, ...]
+#
+def iter_rows(dbConn, sql, parameters=[], batch_size=1000):
+  """
+  Executes an sql SELECT query against the database connection
+  and yields the rows as tuples, streaming them from the server
+  in batches
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized,
+  batch_size: # of rows fetched from the server per round trip
+
+  Yields
+  ______
+  Each row as a tuple; upon an error the error is logged and
+  raised, so a failed query can't pass for a short result
+  """
+
+  dbCursor = dbConn.cursor(pymysql.cursors.SSCursor)
+
+  try:
+    dbCursor.execute(sql, parameters)
+    while True:
+      rows = dbCursor.fetchmany(batch_size)
+      if not rows:
+        break
+      yield from rows
+
+  except Exception as e:
+    logging.error("datatier.iter_rows() failed:")
+    logging.error(e)
+    raise
+
   finally:
+    # closing an SSCursor drains any unread rows so the
+    # connection is usable again:
     dbCursor.close()
 
 
+##################################################################
+#
+# retrieve_page:
+#
+# Keyset (a.k.a. seek) pagination over a table in descending
+# key order. Returns up to page_size rows whose key column is
+# strictly less than last_key, or the first page if last_key
+# is None. Each page is an index range scan on the key, so
+# fetching page N costs the same as fetching page 1. To get
+# the next page pass the key of the last row returned. Note
+# that table and keycol are SQL identifiers supplied by the
+# program, not user input, and are not parameterized.
+#
+def retrieve_page(dbConn, table, keycol, last_key=None, page_size=25):
+  """
+  Retrieves one page of rows from a table in descending order
+  of a key column, starting after last_key
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  table : name of the table to page through,
+  keycol : name of the (indexed, unique) key column to order by,
+  last_key : key of the last row of the previous page, or None
+    for the first page,
+  page_size : maximum # of rows to return
+
+  Returns
+  _______
+  The page as a list of tuples (empty if there are no more
+  rows) or None upon an error
+  """
+
+  if last_key is None:
+    sql = f"SELECT * FROM {table} ORDER BY {keycol} DESC LIMIT %s;"
+    parameters = [page_size]
+  else:
+    sql = f"SELECT * FROM {table} WHERE {keycol} < %s ORDER BY {keycol} DESC LIMIT %s;"
+    parameters = [last_key, page_size]
+
+  return retrieve_all_rows(dbConn, sql, parameters)
+
+
 ###############################################################
 #
 # perform_action:
@@ -157,7 +812,9 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
 # using %s, in which case pass the values as a list
 # [value1, value2, ...]
 #
-def perform_action(dbConn, sql, parameters=[]):
+@metrics.timed("datatier.perform_action", failed=metrics.is_negative,
+               rows=lambda rowcount, *args, **kwargs: rowcount)
+def perform_action(dbConn, sql, parameters=[], idempotent=False):
   """
   Executes an sql ACTION query against the database connection
   and returns number of rows modified
@@ -166,7 +823,10 @@ def perform_action(dbConn, sql, parameters=[]):
   __________
   dbConn : the database connection, 
   sql : the SQL SELECT query (can be parameterized with %s),
-  parameters: optional list of values if parameterized
+  parameters: optional list of values if parameterized,
+  idempotent: True if running the query twice has the same
+    effect as once, so it may be retried even if the connection
+    was lost before the outcome was known
 
   Returns
   _______
@@ -174,21 +834,212 @@ def perform_action(dbConn, sql, parameters=[]):
   error but implies the query made no modifications)
   """
 
-  dbCursor = dbConn.cursor()
+  def attempt():
+    dbCursor = dbConn.cursor()
+    try:
+      # try to execute, and if successful commit the changes
+      # and return the # of rows modified by the query:
+      dbCursor.execute(sql, parameters)
+      dbConn.commit()
+      return dbCursor.rowcount
+    except Exception:
+      # failed, rollback any possible changes:
+      _rollback(dbConn)
+      raise
+    finally:
+      dbCursor.close()
 
   try:
-    # try to execute, and if successful commit the changes
-    # and return the # of rows modified by the query:
-    dbCursor.execute(sql, parameters)
-    dbConn.commit()
-    return dbCursor.rowcount
+    rowcount = _with_retry(dbConn, "perform_action", attempt, write=True, idempotent=idempotent)
+    _invalidate(sql)
+    return rowcount
 
   except Exception as e:
-    # failed, rollback any possible changes and log error:
-    dbConn.rollback()
     logging.error("datatier.perform_action() failed:")
     logging.error(e)
     return -1
 
-  finally:
-    dbCursor.close()
+
+###############################################################
+#
+# insert_returning_id:
+#
+# Given a database connection and an SQL INSERT query for a
+# table with an AUTO_INCREMENT key, executes the query and
+# returns the key generated for the new row. The id comes
+# back in the same response as the INSERT (cursor.lastrowid),
+# so no follow-up "SELECT LAST_INSERT_ID()" round trip is
+# needed, and it is correct even if the connection is later
+# handed to someone else. The query can be parameterized
+# using %s, in which case pass the values as a list
+# [value1, value2, ...]
+#
+@metrics.timed("datatier.insert_returning_id", failed=metrics.is_negative,
+               rows=lambda id, *args, **kwargs: 1)
+def insert_returning_id(dbConn, sql, parameters=[]):
+  """
+  Executes an sql INSERT query against the database connection
+  and returns the auto-generated id of the inserted row
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL INSERT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  the generated id or -1 upon an error
+  """
+
+  def attempt():
+    dbCursor = dbConn.cursor()
+    try:
+      dbCursor.execute(sql, parameters)
+      dbConn.commit()
+      return dbCursor.lastrowid
+    except Exception:
+      # failed, rollback any possible changes:
+      _rollback(dbConn)
+      raise
+    finally:
+      dbCursor.close()
+
+  try:
+    lastrowid = _with_retry(dbConn, "insert_returning_id", attempt, write=True)
+    _invalidate(sql)
+    return lastrowid
+
+  except Exception as e:
+    logging.error("datatier.insert_returning_id() failed:")
+    logging.error(e)
+    return -1
+
+
+###############################################################
+#
+# perform_batch:
+#
+# Given a database connection and an SQL action query,
+# executes the query once per set of parameters as a single
+# transaction: either every row is applied and committed, or
+# none are. For "INSERT ... VALUES (%s, ...)" queries pymysql
+# sends the rows as multi-row INSERT statements, so thousands
+# of rows cost a handful of round trips rather than one each.
+# Pass the parameters as a list of lists
+# [[value1, value2, ...], [value1, value2, ...], ...]
+#
+@metrics.timed("datatier.perform_batch", failed=metrics.is_negative,
+               rows=lambda rowcount, *args, **kwargs: rowcount)
+def perform_batch(dbConn, sql, rows_of_parameters, idempotent=False):
+  """
+  Executes an sql ACTION query against the database connection
+  for each set of parameters, in one transaction, and returns
+  number of rows modified
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL ACTION query (parameterized with %s),
+  rows_of_parameters: list of parameter lists, one per row,
+  idempotent: True if applying the batch twice has the same
+    effect as once (see perform_action)
+
+  Returns
+  _______
+  number of rows modified or -1 upon an error (in which case
+  no rows were modified)
+  """
+
+  if len(rows_of_parameters) == 0:
+    return 0
+
+  def attempt():
+    dbCursor = dbConn.cursor()
+    try:
+      dbCursor.executemany(sql, rows_of_parameters)
+      dbConn.commit()
+      return dbCursor.rowcount
+    except Exception:
+      # failed, rollback the whole batch:
+      _rollback(dbConn)
+      raise
+    finally:
+      dbCursor.close()
+
+  try:
+    rowcount = _with_retry(dbConn, "perform_batch", attempt, write=True, idempotent=idempotent)
+    _invalidate(sql)
+    return rowcount
+
+  except Exception as e:
+    logging.error("datatier.perform_batch() failed:")
+    logging.error(e)
+    return -1
+
+
+###############################################################
+#
+# perform_transaction:
+#
+# Given a database connection and a list of SQL action queries,
+# executes them all as a single transaction: either every one
+# is applied and committed, or none are. Use it to keep derived
+# data (counters, aggregates) in step with the rows they are
+# derived from. Pass the queries as a list of (sql, parameters)
+# pairs; parameters is a list of values [value1, value2, ...],
+# or a list of lists to execute the query once per row as
+# perform_batch does.
+#
+@metrics.timed("datatier.perform_transaction", failed=metrics.is_none,
+               rows=lambda results, *args, **kwargs: sum(rowcount for (rowcount, _) in results))
+def perform_transaction(dbConn, statements, idempotent=False):
+  """
+  Executes sql ACTION queries against the database connection in
+  one transaction
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  statements : list of (sql, parameters) pairs, executed in order;
+    parameters is a list of values, or a list of lists of values
+    (one per row),
+  idempotent: True if applying the transaction twice has the same
+    effect as once (see perform_action)
+
+  Returns
+  _______
+  list of (# of rows modified, auto-generated id or None), one per
+  query, or None upon an error (in which case nothing was
+  modified)
+  """
+
+  def attempt():
+    dbCursor = dbConn.cursor()
+    try:
+      results = []
+      for (sql, parameters) in statements:
+        if len(parameters) > 0 and isinstance(parameters[0], (list, tuple)):
+          dbCursor.executemany(sql, parameters)
+        else:
+          dbCursor.execute(sql, parameters)
+        results.append((dbCursor.rowcount, dbCursor.lastrowid or None))
+      dbConn.commit()
+      return results
+    except Exception:
+      # failed, rollback the whole transaction:
+      _rollback(dbConn)
+      raise
+    finally:
+      dbCursor.close()
+
+  try:
+    results = _with_retry(dbConn, "perform_transaction", attempt, write=True, idempotent=idempotent)
+    for (sql, _) in statements:
+      _invalidate(sql)
+    return results
+
+  except Exception as e:
+    logging.error("datatier.perform_transaction() failed:")
+    logging.error(e)
+    return None
@@ -0,0 +1,328 @@
+#
+# datatier_async.py
+#
+# Executes SQL queries against a MySQL database from asyncio
+# code. Mirrors datatier.py function-for-function, with the
+# same return conventions (None / () / -1 upon an error), but
+# built on aiomysql so queries don't block the event loop.
+#
+# Usage:
+#
+#   pool = await datatier_async.create_pool(endpoint, portnum, ...)
+#   async with pool.acquire() as dbConn:
+#     row = await datatier_async.retrieve_one_row(dbConn, sql, [x])
+#
+
+import aiomysql
+import logging
+
+
+###################################################################
+#
+# get_dbConn:
+#
+# Opens and returns a connection object for interacting with a
+# MySQL database.
+#
+async def get_dbConn(endpoint, portnum, username, pwd, dbname):
+  """
+  Opens and returns a connection object for interacting
+  with a MySQL database
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of server (string),
+  portnum : server port # (integer),
+  username : user name for login (string),
+  pwd : user password for login (string),
+  dbname : database name (string)
+
+  Returns
+  -------
+  a connection object or None upon an error
+  """
+  try:
+    dbConn = await aiomysql.connect(host=endpoint,
+                                    port=portnum,
+                                    user=username,
+                                    password=pwd,
+                                    db=dbname)
+
+    return dbConn
+
+  except Exception as e:
+    logging.error("datatier_async.get_dbConn() failed:")
+    logging.error(e)
+    return None
+
+
+###################################################################
+#
+# create_pool:
+#
+# Opens and returns a pool of connections; borrow one with
+# "async with pool.acquire() as dbConn:". Close the pool with
+# pool.close() followed by "await pool.wait_closed()".
+#
+async def create_pool(endpoint, portnum, username, pwd, dbname,
+                      min_size=1, max_size=10, idle_timeout=300):
+  """
+  Opens and returns a pool of connections to a MySQL database
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of server (string),
+  portnum : server port # (integer),
+  username : user name for login (string),
+  pwd : user password for login (string),
+  dbname : database name (string),
+  min_size : # of connections opened up front,
+  max_size : maximum # of connections open at once,
+  idle_timeout : seconds after which an idle connection is recycled
+
+  Returns
+  -------
+  an aiomysql pool or None upon an error
+  """
+  try:
+    pool = await aiomysql.create_pool(host=endpoint,
+                                      port=portnum,
+                                      user=username,
+                                      password=pwd,
+                                      db=dbname,
+                                      minsize=min_size,
+                                      maxsize=max_size,
+                                      pool_recycle=idle_timeout)
+
+    return pool
+
+  except Exception as e:
+    logging.error("datatier_async.create_pool() failed:")
+    logging.error(e)
+    return None
+
+
+async def _rollback(dbConn):
+  try:
+    await dbConn.rollback()
+  except Exception:
+    pass  # connection is gone, and the transaction with it
+
+
+##################################################################
+#
+# retrieve_one_row:
+#
+# Given a database connection and an SQL Select query,
+# executes this query against the database and returns
+# the first row (tuple) retrieved by the query (the tuple
+# can be empty if the SELECT retrieved no data).
+#
+async def retrieve_one_row(dbConn, sql, parameters=[]):
+  """
+  Executes an sql SELECT query against the database connection
+  and returns the first row as a tuple
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  First row as a tuple (empty if SELECT retrieves no data)
+  or None upon an error
+  """
+
+  dbCursor = await dbConn.cursor()
+
+  try:
+    await dbCursor.execute(sql, parameters)
+    row = await dbCursor.fetchone()
+    if row is None:  # executed successfully, but no data was retrieved
+      return ()
+    else:
+      return row
+
+  except Exception as e:
+    logging.error("datatier_async.retrieve_one_row() failed:")
+    logging.error(e)
+    return None
+
+  finally:
+    await dbCursor.close()
+
+
+##################################################################
+#
+# retrieve_all_rows:
+#
+# Given a database connection and an SQL Select query,
+# executes this query against the database and returns
+# a list of rows (tuples) retrieved by the query.
+#
+async def retrieve_all_rows(dbConn, sql, parameters=[]):
+  """
+  Executes an sql SELECT query against the database connection
+  and returns all rows as a list of tuples
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  All rows as a list of tuples (empty if SELECT retrieves no
+  data) or None upon an error
+  """
+
+  dbCursor = await dbConn.cursor()
+
+  try:
+    await dbCursor.execute(sql, parameters)
+    rows = await dbCursor.fetchall()
+    if rows is None:  # executed successfully, but no data was retrieved
+      return []
+    else:
+      return list(rows)
+
+  except Exception as e:
+    logging.error("datatier_async.retrieve_all_rows() failed:")
+    logging.error(e)
+    return None
+
+  finally:
+    await dbCursor.close()
+
+
+###############################################################
+#
+# perform_action:
+#
+# Given a database connection and an SQL action query,
+# executes an ACTION query and returns the number of rows
+# modified; a return value of 0 means no rows were
+# modified.
+#
+async def perform_action(dbConn, sql, parameters=[]):
+  """
+  Executes an sql ACTION query against the database connection
+  and returns number of rows modified
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL ACTION query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  number of rows modified or -1 upon an error (0 is not an
+  error but implies the query made no modifications)
+  """
+
+  dbCursor = await dbConn.cursor()
+
+  try:
+    await dbCursor.execute(sql, parameters)
+    await dbConn.commit()
+    return dbCursor.rowcount
+
+  except Exception as e:
+    await _rollback(dbConn)
+    logging.error("datatier_async.perform_action() failed:")
+    logging.error(e)
+    return -1
+
+  finally:
+    await dbCursor.close()
+
+
+###############################################################
+#
+# insert_returning_id:
+#
+# Given a database connection and an SQL INSERT query for a
+# table with an AUTO_INCREMENT key, executes the query and
+# returns the key generated for the new row.
+#
+async def insert_returning_id(dbConn, sql, parameters=[]):
+  """
+  Executes an sql INSERT query against the database connection
+  and returns the auto-generated id of the inserted row
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL INSERT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  the generated id or -1 upon an error
+  """
+
+  dbCursor = await dbConn.cursor()
+
+  try:
+    await dbCursor.execute(sql, parameters)
+    await dbConn.commit()
+    return dbCursor.lastrowid
+
+  except Exception as e:
+    await _rollback(dbConn)
+    logging.error("datatier_async.insert_returning_id() failed:")
+    logging.error(e)
+    return -1
+
+  finally:
+    await dbCursor.close()
+
+
+###############################################################
+#
+# perform_batch:
+#
+# Given a database connection and an SQL action query,
+# executes the query once per set of parameters as a single
+# transaction.
+#
+async def perform_batch(dbConn, sql, rows_of_parameters):
+  """
+  Executes an sql ACTION query against the database connection
+  for each set of parameters, in one transaction, and returns
+  number of rows modified
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL ACTION query (parameterized with %s),
+  rows_of_parameters: list of parameter lists, one per row
+
+  Returns
+  _______
+  number of rows modified or -1 upon an error (in which case
+  no rows were modified)
+  """
+
+  if len(rows_of_parameters) == 0:
+    return 0
+
+  dbCursor = await dbConn.cursor()
+
+  try:
+    await dbCursor.executemany(sql, rows_of_parameters)
+    await dbConn.commit()
+    return dbCursor.rowcount
+
+  except Exception as e:
+    await _rollback(dbConn)
+    logging.error("datatier_async.perform_batch() failed:")
+    logging.error(e)
+    return -1
+
+  finally:
+    await dbCursor.close()
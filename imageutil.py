@@ -0,0 +1,98 @@
+#
+# imageutil.py
+#
+# Helper functions for generating downscaled renditions
+# (thumbnails / previews) of uploaded photos.
+#
+
+import logging
+import io
+import pathlib
+
+
+DEFAULT_SIZES = [128, 512, 1600]
+
+
+###################################################################
+#
+# rendition_key
+#
+def rendition_key(bucketkey, size):
+  """
+  Returns the S3 key a rendition is stored under, next to the
+  original: "folder/file.jpg" => "folder/file_512.jpg"
+
+  Parameters
+  ----------
+  bucketkey : key of the original in the bucket,
+  size : rendition's size (longest side, in pixels)
+
+  Returns
+  -------
+  the rendition's key (string)
+  """
+
+  path = pathlib.PurePosixPath(bucketkey)
+  return str(path.with_name(f"{path.stem}_{size}.jpg"))
+
+
+###################################################################
+#
+# make_renditions
+#
+# ref: https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.thumbnail
+#
+def make_renditions(local_filename, sizes=DEFAULT_SIZES, quality=85):
+  """
+  Generates JPEG renditions of an image whose longest side is at
+  most each of the given sizes. Sizes at least as large as the
+  original are skipped, since the original serves just as well.
+  The image is decoded once, then downscaled from largest to
+  smallest so each step starts from the previous, smaller image.
+
+  Parameters
+  ----------
+  local_filename : name of local image file (or a binary file
+    object positioned at the image's start),
+  sizes : list of sizes (longest side, in pixels),
+  quality : JPEG quality of the renditions
+
+  Returns
+  -------
+  list of (size, JPEG bytes), empty if the file isn't an image
+  Pillow can read (or Pillow isn't installed)
+  """
+
+  try:
+    from PIL import Image, ImageOps  # deferred: only needed at upload
+
+    with Image.open(local_filename) as original:
+      largest = max(original.size)
+      wanted = sorted([size for size in sizes if size < largest], reverse=True)
+      if len(wanted) == 0:
+        return []
+
+      #
+      # draft() lets the JPEG decoder scale down while decoding,
+      # which is much faster than decoding at full size:
+      #
+      original.draft("RGB", (wanted[0], wanted[0]))
+
+      image = ImageOps.exif_transpose(original)
+      if image.mode != "RGB":
+        image = image.convert("RGB")
+
+      renditions = []
+
+      for size in wanted:
+        image.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality, optimize=True)
+        renditions.append((size, buffer.getvalue()))
+
+    return sorted(renditions)
+
+  except Exception as e:
+    logging.error("imageutil.make_renditions() failed:")
+    logging.error(e)
+    return []
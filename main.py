@@ -11,18 +11,34 @@
 
 import datatier  # MySQL database access
 import awsutil  # helper functions for AWS
-import boto3  # Amazon AWS
+import assetcache  # local cache of downloaded assets
+import imageutil  # thumbnails / previews
+import metrics  # per-operation latency / error counts
 
 import uuid
 import pathlib
 import logging
 import sys
 import os
+import io
+import glob
+import time
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+import argparse
+import shlex
 
 from configparser import ConfigParser
 
-import matplotlib.pyplot as plt
-import matplotlib.image as img
+#
+# boto3 (Amazon AWS) and matplotlib are slow to import, so they
+# are imported on first use: boto3 when a command first touches
+# S3 (see Session.bucket), matplotlib only when displaying an
+# image. Commands such as users and assets never load either.
+# Run benchmarks/startup.py to measure.
+#
 
 
 ###################################################################
@@ -53,6 +69,12 @@ def prompt():
     print("   5 => download and display")
     print("   6 => upload")
     print("   7 => add user")
+    print("   8 => stats (exact S3 count)")
+    print("   9 => bulk upload")
+    print("  10 => batch download")
+    print("  11 => download URL")
+    print("  12 => upload URL")
+    print("  13 => view (preview)")
 
     cmd = int(input())
     return cmd
@@ -65,243 +87,1705 @@ def prompt():
 
 ###################################################################
 #
-# stats
+# prompt_page_size
 #
-def stats(bucketname, bucket, endpoint, dbConn):
+def prompt_page_size():
   """
-  Prints out S3 and RDS info: bucket name, # of assets, RDS 
-  endpoint, and # of users and assets in the database
+  Prompts the user for how many rows to show per page
+  
+  Parameters
+  ----------
+  None
+  
+  Returns
+  -------
+  page size (> 0), or 0 meaning show all rows without paging
+  """
+
+  print("Enter page size (ENTER for all)>")
+  s = input().strip()
+
+  if s == "":
+    return 0
+
+  try:
+    page_size = int(s)
+  except ValueError:
+    print("** Invalid page size, showing all rows...")
+    return 0
+
+  return max(page_size, 0)
+
+
+###################################################################
+#
+# paged_rows
+#
+def paged_rows(dbConn, table, keycol, page_size, after=None, interactive=True):
+  """
+  Yields the rows of a table page by page in descending key
+  order using keyset pagination, asking the user before
+  fetching each next page. The key column must be the first
+  column of the table. When not interactive, yields a single
+  page and then prints the key to continue after.
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  table: table name,
+  keycol: name of key column to page on,
+  page_size: # of rows per page,
+  after: key of the last row of the previous page, or None,
+  interactive: whether to prompt for the next page
+  
+  Returns
+  -------
+  generator of rows (tuples); raises RuntimeError if a page
+  can't be retrieved
+  """
+
+  last_key = after
+
+  while True:
+    rows = datatier.retrieve_page(dbConn, table, keycol, last_key, page_size)
+
+    if rows is None:
+      raise RuntimeError(f"failed to retrieve {table} rows")
+
+    yield from rows
+
+    if len(rows) < page_size:  # last page
+      return
+
+    last_key = rows[-1][0]
+
+    if not interactive:
+      print(f"** more rows, continue with --after {last_key}")
+      return
+
+    print("Press ENTER for next page, or q to stop>")
+    if input().strip().lower() == 'q':
+      return
+
+
+###################################################################
+#
+# get_counter / set_counter / add_to_counter
+#
+# Maintained counters live in the counters table (see
+# schema-updates.sql), one row per counter name.
+#
+def get_counter(dbConn, name):
+  """
+  Returns the value of a maintained counter
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  name: counter name
+  
+  Returns
+  -------
+  counter value, or None if the counter doesn't exist (or upon
+  an error)
+  """
+
+  sql = """
+  SELECT value FROM counters
+  WHERE name = %s;
+  """
+
+  row = datatier.retrieve_one_row(dbConn, sql, [name])
+
+  if row is None or row == ():
+    return None
+  return row[0]
+
+
+def set_counter(dbConn, name, value):
+  """
+  Sets a maintained counter to the given value, creating it if
+  need be
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  name: counter name,
+  value: new value
+  
+  Returns
+  -------
+  # of rows modified or -1 upon an error
+  """
+
+  sql = """
+  INSERT INTO counters (name, value)
+  VALUES (%s, %s)
+  ON DUPLICATE KEY UPDATE value = VALUES(value);
+  """
+
+  return datatier.perform_action(dbConn, sql, [name, value], idempotent=True)
+
+
+def add_to_counter(dbConn, name, delta):
+  """
+  Atomically adds delta to a maintained counter, but only if
+  the counter already exists: a counter that was never
+  initialized stays missing so stats knows to recompute it
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  name: counter name,
+  delta: amount to add
+  
+  Returns
+  -------
+  # of rows modified or -1 upon an error
+  """
+
+  sql = """
+  UPDATE counters SET value = value + %s
+  WHERE name = %s;
+  """
+
+  return datatier.perform_action(dbConn, sql, [delta, name])
+
+
+###################################################################
+#
+# add_to_object_count / reconcile_object_count / reconcile_inventory
+#
+# The S3 object count ("s3objects:<bucket>") is kept in step by
+# the paths that store objects; every such change is also logged
+# with its time in counterlog, so a count taken at some earlier
+# moment (an S3 Inventory report) can be brought up to date by
+# adding what was logged since. "s3counted:<bucket>" records when
+# the count was last reconciled (ms since the epoch), so an
+# inventory is applied once, and only if it is newer.
+#
+def add_to_object_count(dbConn, bucketname, delta):
+  """
+  Adds delta to a bucket's maintained S3 object count and logs
+  the change
   
   Parameters
   ----------
+  dbConn: open connection to MySQL server,
   bucketname: S3 bucket name,
-  bucket: S3 boto bucket object,
-  endpoint: RDS machine name,
-  dbConn: open connection to MySQL server
+  delta: # of objects added
   
   Returns
   -------
-  nothing
+  # of rows modified or -1 upon an error
   """
-  #
-  # bucket info:
-  #
-  try: 
-    print("S3 bucket name:", bucketname)
 
-    assets = bucket.objects.all()
-    print("S3 assets:", len(list(assets)))
+  results = datatier.perform_transaction(dbConn, object_count_statements(bucketname, delta))
 
-    #
-    # MySQL info:
-    #
-    print("RDS MySQL endpoint:", endpoint)
+  if results is None:
+    return -1
+  return results[-1][0]
 
-    #Retrive number of users in users table
-    sql_users_info = """
-    SELECT COUNT(*) 
-    FROM users; 
-    """
 
-    row_users = datatier.retrieve_one_row(dbConn, sql_users_info)
-    if row_users is None: 
-      print("Failed to retrieve any user rows")
-    else: 
-      print("# of users: ", row_users[0]) 
-    
+def object_count_statements(bucketname, delta):
+  """
+  Builds the statements that add delta to a bucket's maintained S3
+  object count and log the change, for datatier.perform_transaction,
+  so they can be applied together with the writes they account for
+  
+  Parameters
+  ----------
+  bucketname: S3 bucket name,
+  delta: # of objects added
+  
+  Returns
+  -------
+  list of (sql, parameters)
+  """
 
-    #Retrive number of assets in assets table
-    sql_assets_info = """
-    SELECT COUNT(*) 
-    FROM assets; 
-    """
+  counter_name = f"s3objects:{bucketname}"
 
-    row_assets = datatier.retrieve_one_row(dbConn, sql_assets_info)
-    if row_assets is None: 
-      print("Failed to retrieve any user rows")
-    else: 
-      print("# of assets: ", row_assets[0]) 
+  sql_log = """
+  INSERT INTO counterlog (name, delta)
+  VALUES (%s, %s);
+  """
 
-  except Exception as e:
-    print("ERROR")
-    print("ERROR: an exception was raised and caught")
-    print("ERROR")
-    print("MESSAGE:", str(e))
+  sql_count = """
+  UPDATE counters SET value = value + %s
+  WHERE name = %s;
+  """
+
+  return [(sql_log, [counter_name, delta]),
+          (sql_count, [delta, counter_name])]
+
+
+def reconcile_object_count(dbConn, bucketname, num_objects, taken=None, since=0):
+  """
+  Sets a bucket's maintained S3 object count from a count taken
+  at a given time, and drops the log entries it accounts for
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  bucketname: S3 bucket name,
+  num_objects: # of objects counted,
+  taken: when they were counted, in ms since the epoch
+    (default: now),
+  since: # of objects logged as added after that time
+  
+  Returns
+  -------
+  # of rows modified or -1 upon an error
+  """
+
+  if taken is None:
+    taken = int(time.time() * 1000)
+
+  sql = """
+  DELETE FROM counterlog
+  WHERE name = %s AND at <= FROM_UNIXTIME(%s);
+  """
+
+  datatier.perform_action(dbConn, sql, [f"s3objects:{bucketname}", taken / 1000], idempotent=True)
+  set_counter(dbConn, f"s3counted:{bucketname}", taken)
+
+  return set_counter(dbConn, f"s3objects:{bucketname}", num_objects + since)
+
+
+def reconcile_inventory(dbConn, bucketname, manifest):
+  """
+  Reconciles a bucket's maintained S3 object count to a local S3
+  Inventory report, if the report is newer than the count's last
+  reconciliation: the count becomes the inventory's count plus
+  the objects logged as added since the inventory was taken.
+  Otherwise the inventory isn't read at all.
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  bucketname: S3 bucket name,
+  manifest: path to the inventory's manifest.json
+  
+  Returns
+  -------
+  True if reconciled, False if the inventory is not newer, None
+  upon an error
+  """
+
+  taken = awsutil.inventory_timestamp(manifest)
+  if taken < 0:
+    return None
+
+  counted = get_counter(dbConn, f"s3counted:{bucketname}")
+  if counted is not None and counted >= taken:
+    return False
+
+  num_objects = awsutil.count_inventory(manifest)
+  if num_objects < 0:
+    return None
+
+  sql = """
+  SELECT COALESCE(SUM(delta), 0) FROM counterlog
+  WHERE name = %s AND at > FROM_UNIXTIME(%s);
+  """
+
+  row = datatier.retrieve_one_row(dbConn, sql, [f"s3objects:{bucketname}", taken / 1000])
+  if row is None or row == ():
+    return None
+
+  if reconcile_object_count(dbConn, bucketname, num_objects, taken, int(row[0])) < 0:
+    return None
+  return True
 
 
 ###################################################################
 #
-# users
+# add_to_userstats / retrieve_stats
+#
+# Per-user aggregates live in the userstats table (see
+# schema-updates.sql), one row per user with assets, and the
+# totals in the "users", "assets" and "assetbytes" counters,
+# all kept in step by every path that records users or assets
+# (in the same transaction as the rows they count, see
+# userstats_statements), so stats never has to scan a table to
+# report them; recount_stats rebuilds them from the tables.
 #
-def users(dbConn): 
+def add_to_userstats(dbConn, userid, numassets, nbytes):
+  """
+  Atomically adds to a user's maintained asset count and total
+  bytes, creating the user's row if need be, and to the overall
+  asset count and bytes
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  userid: user the assets belong to,
+  numassets: # of assets added,
+  nbytes: total size of those assets
+  
+  Returns
+  -------
+  # of rows modified or -1 upon an error
+  """
+
+  results = datatier.perform_transaction(dbConn, userstats_statements(userid, numassets, nbytes))
+
+  if results is None:
+    return -1
+  return results[-1][0]
+
+
+def userstats_statements(userid, numassets, nbytes):
+  """
+  Builds the statements that add to a user's maintained asset count
+  and total bytes and to the overall ones, for
+  datatier.perform_transaction, so they can be applied in the same
+  transaction as the asset rows they count
+  
+  Parameters
+  ----------
+  userid: user the assets belong to,
+  numassets: # of assets added,
+  nbytes: total size of those assets
+  
+  Returns
+  -------
+  list of (sql, parameters)
+  """
+
+  sql_counter = """
+  UPDATE counters SET value = value + %s
+  WHERE name = %s;
+  """
+
+  sql_user = """
+  INSERT INTO userstats (userid, numassets, totalbytes)
+  VALUES (%s, %s, %s)
+  ON DUPLICATE KEY UPDATE numassets = numassets + VALUES(numassets),
+                          totalbytes = totalbytes + VALUES(totalbytes);
   """
-  Retrieves and outputs user information from the user table: userid, 
-  email, name, and folder 
 
+  return [(sql_counter, [numassets, "assets"]),
+          (sql_counter, [nbytes, "assetbytes"]),
+          (sql_user, [userid, numassets, nbytes])]
+
+
+def recount_stats(dbConn):
+  """
+  Rebuilds userstats and the "users", "assets" and "assetbytes"
+  counters from the users and assets tables, in one transaction,
+  e.g. the first time stats runs against a database without them,
+  or to repair them (stats --exact)
+  
   Parameters
   ----------
   dbConn: open connection to MySQL server
   
   Returns
   -------
-  nothing
+  (# of users, # of assets, total bytes of assets), or None upon
+  an error
   """
 
-  try: 
+  sql_clear = """
+  DELETE FROM userstats;
+  """
 
-    #Retrive all columns and in descending order by userid 
-    sql_users_output = """
-    SELECT * 
-    FROM users 
-    ORDER BY userid DESC; 
-    """
+  sql_userstats = """
+  INSERT INTO userstats (userid, numassets, totalbytes)
+  SELECT userid, COUNT(*), COALESCE(SUM(bytes), 0)
+  FROM assets
+  GROUP BY userid;
+  """
 
-    #We want all the rows 
-    rows = datatier.retrieve_all_rows(dbConn, sql_users_output)
-    if rows is None: 
-      print("Failed to retrieve any user rows")
-    else: 
-      for row in rows: 
-        print("User id:", row[0], "\n  Email:", row[1], "\n  Name:", row[2]+" , "+row[3], "\n  Folder:", row[4])
+  sql_count = """
+  INSERT INTO counters (name, value)
+  SELECT %s, COUNT(*) FROM {table}
+  ON DUPLICATE KEY UPDATE value = VALUES(value);
+  """
 
-  except Exception as e: 
-    print("ERROR")
-    print("ERROR: an exception was raised and caught")
-    print("ERROR")
-    print("MESSAGE:", str(e))
+  sql_bytes = """
+  INSERT INTO counters (name, value)
+  SELECT %s, COALESCE(SUM(bytes), 0) FROM assets
+  ON DUPLICATE KEY UPDATE value = VALUES(value);
+  """
+
+  statements = [(sql_clear, []),
+                (sql_userstats, []),
+                (sql_count.format(table="users"), ["users"]),
+                (sql_count.format(table="assets"), ["assets"]),
+                (sql_bytes, ["assetbytes"])]
+
+  if datatier.perform_transaction(dbConn, statements) is None:
+    return None
+
+  sql_totals = """
+  SELECT (SELECT value FROM counters WHERE name = 'users'),
+         (SELECT value FROM counters WHERE name = 'assets'),
+         (SELECT value FROM counters WHERE name = 'assetbytes');
+  """
+
+  row = datatier.retrieve_one_row(dbConn, sql_totals)
+
+  if row is None or row == ():
+    return None
+  return tuple(row)
+
+
+def retrieve_stats(dbConn, bucketname):
+  """
+  Retrieves the database-side stats in one round trip, from the
+  maintained counters (recounted if they don't exist yet)
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  bucketname: S3 bucket whose maintained object count to return
+  
+  Returns
+  -------
+  (# of users, # of assets, # of S3 objects or None if never
+  counted, total bytes of assets), or None upon an error
+  """
+
+  sql = """
+  SELECT (SELECT value FROM counters WHERE name = 'users'),
+         (SELECT value FROM counters WHERE name = 'assets'),
+         (SELECT value FROM counters WHERE name = %s),
+         (SELECT value FROM counters WHERE name = 'assetbytes');
+  """
+
+  row = datatier.retrieve_one_row(dbConn, sql, [f"s3objects:{bucketname}"])
+
+  if row is None or row == ():
+    return None
+
+  if row[0] is None or row[1] is None or row[3] is None:
+    counts = recount_stats(dbConn)
+    if counts is None:
+      return None
+    return (counts[0], counts[1], row[2], counts[2])
+
+  return tuple(row)
+
+
+###################################################################
+#
+# hash_file
+#
+def hash_file(filename):
+  """
+  Computes the SHA-256 of a file's contents, reading it in 1MB
+  chunks so memory use is constant
+  
+  Parameters
+  ----------
+  filename: local file name
+  
+  Returns
+  -------
+  the hash as 64 hex digits (string)
+  """
+
+  sha = hashlib.sha256()
+
+  with open(filename, "rb") as f:
+    while True:
+      chunk = f.read(1024 * 1024)
+      if not chunk:
+        break
+      sha.update(chunk)
+
+  return sha.hexdigest()
+
+
+###################################################################
+#
+# find_content
+#
+def find_content(dbConn, userid, content_hash):
+  """
+  Looks for one of the user's assets with the given contents, so
+  an upload of them can reuse its S3 object
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  userid: user uploading,
+  content_hash: SHA-256 (hex) of the contents
+  
+  Returns
+  -------
+  (bucketkey,) of the existing object, () if the user has no such
+  contents, or None upon an error
+  """
+
+  sql = """
+  SELECT bucketkey FROM assets
+  WHERE userid = %s AND contenthash = %s
+  LIMIT 1;
+  """
+
+  return datatier.retrieve_one_row(dbConn, sql, [userid, content_hash])
+
+
+###################################################################
+#
+# store_renditions
+#
+def store_renditions(dbConn, bucket, new_assets, sizes, max_workers=8):
+  """
+  Generates downscaled renditions of newly uploaded assets, uploads
+  them to S3 next to the originals, and records them in the
+  renditions table with one multi-row insert
+  
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  bucket: S3 boto bucket object,
+  new_assets: list of (assetid, bucketkey, local filename or
+    binary file object),
+  sizes: list of rendition sizes (longest side, in pixels),
+  max_workers: # of images to process at once
+  
+  Returns
+  -------
+  # of renditions stored, or -1 upon an error
+  """
+
+  if len(sizes) == 0 or len(new_assets) == 0:
+    return 0
+
+  def render_one(asset):
+    (assetid, bucketkey, filename) = asset
+    rows = []
+    for (size, data) in imageutil.make_renditions(filename, sizes):
+      key = imageutil.rendition_key(bucketkey, size)
+      if awsutil.upload_bytes(data, bucket, key) is not None:
+        rows.append([assetid, size, key, len(data)])
+    return rows
+
+  new_renditions = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    for rows in executor.map(render_one, new_assets):
+      new_renditions.extend(rows)
+
+  if len(new_renditions) == 0:
+    return 0
+
+  sql = """
+  INSERT INTO renditions (assetid, size, bucketkey, bytes)
+  VALUES (%s, %s, %s, %s)
+  """
+
+  statements = [(sql, new_renditions)]
+  statements += object_count_statements(bucket.name, len(new_renditions))
+
+  if datatier.perform_transaction(dbConn, statements) is None:
+    return -1
+  return len(new_renditions)
+
+
+###################################################################
+#
+# download_to_file
+#
+def download_to_file(bucket, bucketkey, filename):
+  """
+  Streams an S3 object into a temporary file next to filename,
+  and renames it into place only once the download succeeds, so
+  a failed or interrupted download leaves any existing file with
+  that name untouched
+  
+  Parameters
+  ----------
+  bucket: S3 boto bucket object,
+  bucketkey: key of the object to download,
+  filename: local file to save it as
+  
+  Returns
+  -------
+  True if successful, False if not
+  """
+
+  f = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename) or ".", delete=False)
+  ok = False
+
+  try:
+    with f:
+      ok = awsutil.download_fileobj(bucket, bucketkey, f) is not None
+    if ok:
+      os.replace(f.name, filename)
+    return ok
+
+  finally:
+    if not ok:
+      os.remove(f.name)  # failed or interrupted: drop the partial copy
+
+
+###################################################################
+#
+# print_folder_totals
+#
+# The bucket is listed in key order, so each user folder's totals
+# come out of awsutil.folder_totals in folder order; the users are
+# streamed in the same (binary) order and merge-joined against
+# them, so neither the listing nor the users are held in memory.
+#
+def print_folder_totals(dbConn, bucket):
+  """
+  Lists the bucket once, printing the # of objects and total
+  bytes under each user folder along with the folder's owner
+
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  bucket: S3 boto bucket object
+  
+  Returns
+  -------
+  total # of objects in the bucket, or -1 upon an error
+  """
+
+  #
+  # the listing is in key order, so a folder comes where its
+  # "folder/" prefix sorts (after "abc-x/", not before: '-' < '/'),
+  # and the owners are merged in by that same order:
+  #
+  sql = """
+  SELECT bucketfolder, userid, email FROM users
+  ORDER BY CAST(CONCAT(bucketfolder, '/') AS BINARY);
+  """
+
+  owners = datatier.iter_rows(dbConn, sql)
+  total = 0
+
+  try:
+    owner = next(owners, None)
+
+    for (folder, count, nbytes) in awsutil.folder_totals(bucket):
+      while folder != "" and owner is not None and owner[0] + "/" < folder + "/":
+        owner = next(owners, None)
+
+      if folder == "":
+        who = "(top level)"
+      elif owner is not None and owner[0] == folder:
+        who = f"User {owner[1]} ({owner[2]})"
+      else:
+        who = "(no user)"
+
+      print(f"  {folder or '-'} {who}: {count} objects, {nbytes:,} bytes")
+      total += count
+
+    return total
+
+  except Exception as e:
+    logging.error("main.print_folder_totals() failed:")
+    logging.error(e)
+    return -1
+
+  finally:
+    owners.close()
+
+
+###################################################################
+#
+# stats
+#
+@metrics.timed("main.stats", failed=metrics.is_false)
+def stats(bucketname, get_bucket, endpoint, dbConn, exact=False, manifest=None, per_user=False,
+          per_folder=False):
+  """
+  Prints out S3 and RDS info: bucket name, # of assets, RDS 
+  endpoint, # of users and assets in the database, and total
+  bytes of assets; optionally each user's # of assets and bytes,
+  or each user folder's # of objects and bytes in S3.
+
+  The database counts and the # of S3 assets (a counter
+  maintained in RDS by upload) come back from one query. If a
+  local S3 Inventory manifest is given and is newer than the
+  counter's last reconciliation, the counter is first reconciled
+  to the inventory's count plus the objects added since the
+  inventory's date (see reconcile_inventory). If exact is True, or the counter was never
+  initialized, the bucket is listed and the counter reset to the
+  result; exact also rebuilds userstats and the database counters
+  from the tables (see recount_stats). Per-user figures come from the maintained userstats
+  table, not from scanning assets. Per-folder figures come from
+  one streaming pass over the bucket listing, which also gives
+  the exact count.
+  
+  Parameters
+  ----------
+  bucketname: S3 bucket name,
+  get_bucket: function returning the S3 boto bucket object, only
+    called if the bucket has to be listed (so the counter-only
+    path never sets up S3),
+  endpoint: RDS machine name,
+  dbConn: open connection to MySQL server,
+  exact: list the bucket to get an exact count, and recount the
+    database figures,
+  manifest: optional path to a local S3 Inventory manifest.json,
+  per_user: also print each user's # of assets and total bytes,
+  per_folder: also list the bucket and print each user folder's
+    # of objects and total bytes
+  
+  Returns
+  -------
+  True if successful, False if not
+  """
+  try: 
+    print("S3 bucket name:", bucketname)
+
+    ok = True
+
+    if not exact and manifest:
+      if reconcile_inventory(dbConn, bucketname, manifest) is None:
+        print("Failed to read S3 inventory, using maintained count")
+
+    row = retrieve_stats(dbConn, bucketname)
+    if row is None:
+      print("Failed to retrieve database stats")
+      return False
+
+    (num_users, num_assets, num_objects, total_bytes) = row
+
+    if exact:  # rebuild the database-side figures from the tables too
+      counts = recount_stats(dbConn)
+      if counts is None:
+        print("Failed to recount database stats")
+        return False
+      (num_users, num_assets, total_bytes) = counts
+
+    if per_folder:
+      num_objects = print_folder_totals(dbConn, get_bucket())
+      if num_objects >= 0:
+        reconcile_object_count(dbConn, bucketname, num_objects)
+
+    elif exact or num_objects is None:  # exact count requested or no counter yet
+      num_objects = awsutil.count_objects(get_bucket())
+      if num_objects >= 0:
+        reconcile_object_count(dbConn, bucketname, num_objects)
+
+    if num_objects < 0:
+      print("Failed to count S3 assets")
+      ok = False
+    else:
+      print("S3 assets:", num_objects)
+
+    #
+    # MySQL info:
+    #
+    print("RDS MySQL endpoint:", endpoint)
+    print("# of users: ", num_users) 
+    print("# of assets: ", num_assets) 
+    print(f"Total bytes of assets:  {int(total_bytes):,}")
+
+    if per_user:
+      sql_per_user = """
+      SELECT users.userid, users.email, 
+             COALESCE(userstats.numassets, 0), COALESCE(userstats.totalbytes, 0) 
+      FROM users 
+      LEFT JOIN userstats ON userstats.userid = users.userid 
+      ORDER BY users.userid; 
+      """
+
+      for (userid, email, numassets, totalbytes) in datatier.iter_rows(dbConn, sql_per_user):
+        print(f"  User {userid} ({email}): {numassets} assets, {int(totalbytes):,} bytes")
+
+    return ok
+
+  except Exception as e:
+    print("ERROR")
+    print("ERROR: an exception was raised and caught")
+    print("ERROR")
+    print("MESSAGE:", str(e))
+    return False
+
+
+###################################################################
+#
+# users
+#
+@metrics.timed("main.users", failed=metrics.is_false)
+def users(dbConn, page_size=None, after=None): 
+  """
+  Retrieves and outputs user information from the user table: userid, 
+  email, name, and folder 
+
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  page_size: rows per page (0 for all rows), or None to ask the user,
+  after: when paging non-interactively, show the page of rows whose
+    key is less than this one (None for the first page)
+  
+  Returns
+  -------
+  True if successful, False if not
+  """
+
+  try: 
+    if page_size is None:
+      page_size = prompt_page_size()
+      interactive = True
+    else:
+      interactive = False
+
+    #Retrive all columns and in descending order by userid 
+    sql_users_output = """
+    SELECT * 
+    FROM users 
+    ORDER BY userid DESC; 
+    """
+
+    #Either page through by userid, or stream every row so memory
+    #stays flat regardless of table size
+    if page_size > 0:
+      rows = paged_rows(dbConn, "users", "userid", page_size, after, interactive)
+    else:
+      rows = datatier.iter_rows(dbConn, sql_users_output)
+
+    try:
+      for row in rows:
+        print("User id:", row[0], "\n  Email:", row[1], "\n  Name:", row[2]+" , "+row[3], "\n  Folder:", row[4])
+    except Exception:
+      print("Failed to retrieve any user rows")  # the error itself is logged
+      return False
+
+    return True
+
+  except Exception as e: 
+    print("ERROR")
+    print("ERROR: an exception was raised and caught")
+    print("ERROR")
+    print("MESSAGE:", str(e))
+    return False
+
+###################################################################
+#
+# assets
+#
+@metrics.timed("main.assets", failed=metrics.is_false)
+def assets(dbConn, page_size=None, after=None): 
+  """
+  Retrieves and outputs asset information from the asset table: assetid, 
+  userid, original name, and key name 
+
+  Parameters
+  ----------
+  dbConn: open connection to MySQL server,
+  page_size: rows per page (0 for all rows), or None to ask the user,
+  after: when paging non-interactively, show the page of rows whose
+    key is less than this one (None for the first page)
+  
+  Returns
+  -------
+  True if successful, False if not
+  """
+
+  try: 
+    if page_size is None:
+      page_size = prompt_page_size()
+      interactive = True
+    else:
+      interactive = False
+
+    #Retrive all columns and in descending order by assetid
+    sql_asset_output = """
+    SELECT * 
+    FROM assets 
+    ORDER BY assetid DESC; 
+    """
+
+    #Either page through by assetid, or stream every row so memory
+    #stays flat regardless of table size
+    if page_size > 0:
+      rows = paged_rows(dbConn, "assets", "assetid", page_size, after, interactive)
+    else:
+      rows = datatier.iter_rows(dbConn, sql_asset_output)
+
+    try:
+      for row in rows:
+        print("Asset id:", row[0], "\n  User id:", row[1], "\n  Original name:", row[2], "\n  Key name:", row[3])
+    except Exception:
+      print("Failed to retrieve any asset rows")  # the error itself is logged
+      return False
+
+    return True
+  except Exception as e: 
+    print("ERROR")
+    print("ERROR: an exception was raised and caught")
+    print("ERROR")
+    print("MESSAGE:", str(e))
+    return False
+    
+###################################################################
+#
+# download
+#
+@metrics.timed("main.download", failed=metrics.is_false)
+def download(dbConn, bucket, display=False, cache=None, assetid=None): 
+    """
+    Retrieves asset file by assetid in the asset table and downloads it
+    straight into a local file with its original name. Shows image if user
+    inputs 5 (display boolean will be passed as True), in which case the
+    image is downloaded into memory and decoded from there. If a local
+    asset cache is given, the asset is served from it when current.
+  
+    Parameters
+    ----------
+    dbConn: open connection to MySQL server
+    bucket: S3 boto bucket object,
+    display: boolean-controls whether to show downloaded image,
+    cache: optional assetcache.AssetCache,
+    assetid: asset to download, or None to ask the user
+  
+    Returns
+    -------
+    True if successful, False if not
+    """
+    try: 
+        if assetid is None:
+            print("Enter asset id>")
+            assetid = input()
+
+        #Query the database for assetname and bucketkey based on assetid
+        sql_download_input_name = """
+        SELECT assetname, bucketkey 
+        FROM assets 
+        WHERE assetid = %s; 
+        """
+
+        row = datatier.retrieve_one_row(dbConn, sql_download_input_name, [assetid]) 
+
+        if row is None or row==(): 
+            print("No such asset...")
+            return False
+
+        #Retrieve the assetname (original name) and bucketkey (S3 key)
+        assetname = row[0]   
+        bucketkey = row[1]
+
+        if display or cache is not None:
+            # Download into memory (or fetch from the local cache), save
+            # a copy, and decode the image from the in-memory bytes rather
+            # than reading the file back
+            if cache is not None:
+                data = cache.get(bucket, bucketkey)
+            else:
+                data = awsutil.download_bytes(bucket, bucketkey)
+
+            if data is None:
+                print(f"Error: Failed to download file from S3 with key {bucketkey}")
+                return False
+
+            with open(assetname, "wb") as f:
+                f.write(data)
+            print(f"Downloaded from S3 and saved as ' {assetname} '")
+
+            if display:
+                import matplotlib.pyplot as plt
+                import matplotlib.image as img
+
+                extension = pathlib.Path(assetname).suffix.lstrip(".") or None
+                image = img.imread(io.BytesIO(data), format=extension)
+                plt.imshow(image)
+                plt.show()
+
+            return True
+        else:
+            if not download_to_file(bucket, bucketkey, assetname):
+                print(f"Error: Failed to download file from S3 with key {bucketkey}")
+                return False
+            else:
+                print(f"Downloaded from S3 and saved as ' {assetname} '")
+                return True
+
+    except Exception as e:
+        print("ERROR")
+        print("ERROR: an exception was raised and caught")
+        print("MESSAGE:", str(e))
+        return False
+
+
+###################################################################
+#
+# view
+#
+@metrics.timed("main.view", failed=metrics.is_false)
+def view(dbConn, bucket, assetid=None, size=512, cache=None): 
+    """
+    Displays an asset without saving it, using the smallest preview
+    rendition at least size pixels on its longest side, so a quick look
+    transfers and decodes a few KB instead of the full original. Falls
+    back to the original if there is no such rendition. Renditions are
+    recorded against the first asset stored under an S3 key, so assets
+    deduplicated onto that object share them.
+  
+    Parameters
+    ----------
+    dbConn: open connection to MySQL server,
+    bucket: S3 boto bucket object,
+    assetid: asset to view, or None to ask the user,
+    size: smallest acceptable longest side, in pixels,
+    cache: optional assetcache.AssetCache
+  
+    Returns
+    -------
+    True if successful, False if not
+    """
+    try: 
+        if assetid is None:
+            print("Enter asset id>")
+            assetid = input()
+
+        sql_view = """
+        SELECT assets.assetname, 
+               COALESCE(
+                 (SELECT renditions.bucketkey 
+                  FROM renditions 
+                  WHERE renditions.assetid = 
+                          (SELECT MIN(owner.assetid) FROM assets AS owner 
+                           WHERE owner.bucketkey = assets.bucketkey) 
+                    AND renditions.size >= %s 
+                  ORDER BY renditions.size 
+                  LIMIT 1),
+                 assets.bucketkey) 
+        FROM assets 
+        WHERE assets.assetid = %s; 
+        """
+
+        row = datatier.retrieve_one_row(dbConn, sql_view, [size, assetid]) 
+
+        if row is None or row==(): 
+            print("No such asset...")
+            return False
+
+        assetname = row[0]
+        bucketkey = row[1]
+
+        if cache is not None:
+            data = cache.get(bucket, bucketkey)
+        else:
+            data = awsutil.download_bytes(bucket, bucketkey)
+
+        if data is None:
+            print(f"Error: Failed to download file from S3 with key {bucketkey}")
+            return False
+
+        print(f"Viewing ' {assetname} ' ({len(data):,} bytes from '{bucketkey}')")
+
+        import matplotlib.pyplot as plt
+        import matplotlib.image as img
+
+        image = img.imread(io.BytesIO(data), format="jpg")
+        plt.imshow(image)
+        plt.show()
+        return True
+
+    except Exception as e:
+        print("ERROR")
+        print("ERROR: an exception was raised and caught")
+        print("MESSAGE:", str(e))
+        return False
+
+
+###################################################################
+#
+# parse_asset_ids
+#
+MAX_ID_RANGES = 1000  # ids / ranges in one batch, bounding the query's size
+
+
+def parse_asset_ids(text):
+  """
+  Parses a list of asset ids and id ranges such as "1 2 5-9,12".
+  Ranges are kept as ranges, never expanded, so "1-100000000"
+  costs no more than "1-2"
+  
+  Parameters
+  ----------
+  text: the ids, separated by spaces and/or commas
+  
+  Returns
+  -------
+  sorted list of disjoint (first, last) id ranges, overlapping
+  and adjacent ones merged (a single id n is (n, n)); raises
+  ValueError if the text is not a valid list, has a range whose
+  first id is greater than its last, or has more than
+  MAX_ID_RANGES ids / ranges
+  """
+
+  ranges = []
+
+  for part in text.replace(",", " ").split():
+    if "-" in part:
+      (first, last) = part.split("-", 1)
+      (first, last) = (int(first), int(last))
+    else:
+      first = last = int(part)
+
+    if first < 0 or last < 0:
+      raise ValueError(f"asset ids can't be negative: '{part}'")
+    if first > last:
+      raise ValueError(f"range '{part}' is backwards")
+    ranges.append((first, last))
+
+  if len(ranges) > MAX_ID_RANGES:
+    raise ValueError(f"at most {MAX_ID_RANGES} ids / ranges at a time")
+
+  merged = []
+  for (first, last) in sorted(ranges):
+    if merged and first <= merged[-1][1] + 1:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+    else:
+      merged.append((first, last))
+
+  return merged
+
+
+###################################################################
+#
+# batch_download
+#
+@metrics.timed("main.batch_download", failed=metrics.is_false)
+def batch_download(dbConn, bucket, cache=None, max_workers=16, ids=None, folder=None): 
+    """
+    Inputs a list / range of asset ids, or a user id meaning all of that
+    user's assets, looks up all of them with one query, and downloads them
+    concurrently using a pool of threads. Each asset is saved in the
+    chosen directory as <assetid>_<original name>, so assets that share an
+    original name don't overwrite each other.
+  
+    Parameters
+    ----------
+    dbConn: open connection to MySQL server,
+    bucket: S3 boto bucket object,
+    cache: optional assetcache.AssetCache,
+    max_workers: # of assets to download at once,
+    ids: asset ids / ranges / u<userid> as text, or None to ask the user,
+    folder: directory to save into, or None to ask the user
+  
+    Returns
+    -------
+    True if successful, False if not
+    """
+    try: 
+        if ids is None:
+            print("Enter asset ids (e.g. 1 2 5-9), or u<userid> for all of a user's assets>")
+            ids = input()
+        cmd = ids.strip()
+
+        if cmd.lower().startswith("u"):
+            sql = """
+            SELECT assetid, assetname, bucketkey 
+            FROM assets 
+            WHERE userid = %s
+            ORDER BY assetid; 
+            """
+            parameters = [cmd[1:].strip()]
+        else:
+            try:
+                id_ranges = parse_asset_ids(cmd)
+            except ValueError as e:
+                print(f"Invalid asset id list: {e}")
+                return False
+
+            if len(id_ranges) == 0:
+                print("No asset ids given...")
+                return False
+
+            #One indexed range predicate per id / range, however many
+            #ids a range covers
+            predicates = " OR ".join(["assetid BETWEEN %s AND %s"] * len(id_ranges))
+            sql = f"""
+            SELECT assetid, assetname, bucketkey 
+            FROM assets 
+            WHERE {predicates}
+            ORDER BY assetid; 
+            """
+            parameters = [bound for id_range in id_ranges for bound in id_range]
+
+        rows = datatier.retrieve_all_rows(dbConn, sql, parameters)
+
+        if rows is None:
+            print("Failed to retrieve asset rows")
+            return False
+        if len(rows) == 0:
+            print("No such assets...")
+            return False
+
+        if folder is None:
+            print("Enter local directory to save into (ENTER for current)>")
+            folder = input().strip()
+        folder = folder or "."
+        os.makedirs(folder, exist_ok=True)
+
+        def download_one(row):
+            (assetid, assetname, bucketkey) = row
+            filename = os.path.join(folder, f"{assetid}_{os.path.basename(assetname)}")
+
+            if cache is not None:
+                data = cache.get(bucket, bucketkey)
+                if data is None:
+                    return (assetid, None, 0)
+                with open(filename, "wb") as f:
+                    f.write(data)
+                return (assetid, filename, len(data))
+
+            if not download_to_file(bucket, bucketkey, filename):
+                return (assetid, None, 0)
+            return (assetid, filename, os.path.getsize(filename))
+
+        print(f"Downloading {len(rows)} assets...")
+        start = time.perf_counter()
+
+        num_done = 0
+        num_failed = 0
+        total_bytes = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download_one, row) for row in rows]
+            for future in concurrent.futures.as_completed(futures):
+                (assetid, filename, nbytes) = future.result()
+                num_done += 1
+                if filename is None:
+                    num_failed += 1
+                    print(f"  [{num_done}/{len(rows)}] asset {assetid}: download failed")
+                else:
+                    total_bytes += nbytes
+                    print(f"  [{num_done}/{len(rows)}] asset {assetid}: saved as '{filename}'")
+
+        elapsed = time.perf_counter() - start
+        mbps = (total_bytes / (1024 * 1024)) / elapsed if elapsed > 0 else 0.0
+        print(f"Downloaded {len(rows) - num_failed} of {len(rows)} assets")
+        print(f"  {total_bytes:,} bytes in {elapsed:.2f} secs ({mbps:.2f} MB/s)")
+
+        return num_failed == 0
+
+    except Exception as e:
+        print("ERROR")
+        print("ERROR: an exception was raised and caught")
+        print("MESSAGE:", str(e))
+        return False
+
+
+###################################################################
+#
+# upload
+#
+@metrics.timed("main.upload", failed=metrics.is_false)
+def upload(dbConn, bucket, transfer_config=None, transfer=None, filename=None, userid=None,
+           rendition_sizes=None): 
+    """
+    Inputs a local file, a user id, and uploads this file to the user's folder
+    in S3 (file is given a unique uuid name). Also inputs all asset information into the 
+    asset table as a row. If the user already has a file with identical
+    contents (same SHA-256) in S3, the upload is skipped and the new asset
+    row points at that object. Contents are never shared across users, so
+    each user's objects stay in their own folder.
+  
+    Parameters
+    ----------
+    dbConn: open connection to MySQL server,
+    bucket: S3 boto bucket object,
+    transfer_config: optional boto3 TransferConfig for the upload,
+    transfer: optional reusable S3Transfer for the upload,
+    filename: local file to upload, or None to ask the user,
+    userid: user to upload for, or None to ask the user,
+    rendition_sizes: sizes of the preview renditions to generate
+      (None for none)
+  
+    Returns
+    -------
+    True if successful, False if not
+    """
+    if rendition_sizes is None:
+        rendition_sizes = []
+
+    try: 
+        # Local filename + error handling 
+        if filename is None:
+            print("Enter local filename>")
+            filename = input()
+        cmd_filename = filename
+
+        if not os.path.isfile(cmd_filename): 
+            print(f"Local file '{cmd_filename}' does not exist...")
+            return False
+
+        if userid is None:
+            print("Enter user id>")
+            userid = input()
+        cmd_userid = userid
+
+        # Check if this query does not come up empty, which indicates the user exists
+        sql_check_user = """
+        SELECT bucketfolder FROM users
+        WHERE userid = %s;
+        """
+
+        row = datatier.retrieve_one_row(dbConn, sql_check_user, [cmd_userid])
+
+        if row is None or row == (): 
+            print("No such user...")
+            return False
+
+        folder_id = row[0]
+
+        #Is this exact content already stored for this user?
+        content_hash = hash_file(cmd_filename)
+
+        row = find_content(dbConn, cmd_userid, content_hash)
+
+        if row is None:
+            print("Error looking up content hash")
+            return False
+
+        if row != ():
+            uploaded_key = row[0]
+            print(f"Identical content already stored in S3 as '{uploaded_key}', skipping upload")
+        else:
+            #Construct uuid-based bucket key name
+            file_id = str(uuid.uuid4())
+            bucket_key = f"{folder_id}/{file_id}.jpg"
+
+            upload_stats = {}
+            uploaded_key = awsutil.upload_file(cmd_filename, bucket, bucket_key,
+                                               config=transfer_config,
+                                               transfer=transfer,
+                                               stats=upload_stats)
+
+            if uploaded_key is None:
+                print(f"Error uploading file to S3 as '{bucket_key}'")
+                return False
+            else:
+                print(f"Uploaded and stored in S3 as '{uploaded_key}'")
+                print(f"  {upload_stats['bytes']:,} bytes in {upload_stats['seconds']:.2f} secs ({upload_stats['MBps']:.2f} MB/s)")
+
+        #Insert row containing new asset info into the assets table,
+        #keeping the maintained stats in step in the same transaction
+        sql_insert_asset = """
+        INSERT INTO assets (userid, assetname, bucketkey, contenthash, bytes)
+        VALUES (%s, %s, %s, %s, %s)
+        """
+
+        nbytes = os.path.getsize(cmd_filename)
+
+        statements = [(sql_insert_asset, [cmd_userid, cmd_filename, uploaded_key, content_hash, nbytes])]
+        statements += userstats_statements(cmd_userid, 1, nbytes)
+        if row == ():  # new object in S3
+            statements += object_count_statements(bucket.name, 1)
+
+        results = datatier.perform_transaction(dbConn, statements)
+
+        if results is None: 
+            print("Error inserting asset into assets table")
+            return False
+
+        #The auto-generated asset id comes back with the insert itself
+        last_asset_id = results[0][1]
+        
+        print(f"Recorded in RDS under asset id {last_asset_id}")
+
+        if row != ():  # existing object already has its renditions
+            return True
+
+        num_renditions = store_renditions(dbConn, bucket, [(last_asset_id, uploaded_key, cmd_filename)], rendition_sizes)
+        if num_renditions == -1:
+            print("Error recording renditions")
+        elif num_renditions > 0:
+            print(f"Stored {num_renditions} preview renditions")
+
+        return True
+
+    except Exception as e:
+        print("ERROR")
+        print("ERROR: an exception was raised and caught")
+        print("MESSAGE:", str(e))
+        return False
+
+
+###################################################################
+#
+# download_url
+#
+@metrics.timed("main.download_url", failed=metrics.is_false)
+def download_url(dbConn, bucket, assetid=None, ttl=3600): 
+    """
+    Retrieves an asset by assetid and prints a presigned URL from which
+    the client can download it directly from S3, keeping this host out
+    of the data path
+  
+    Parameters
+    ----------
+    dbConn: open connection to MySQL server,
+    bucket: S3 boto bucket object,
+    assetid: asset to download, or None to ask the user,
+    ttl: seconds the URL stays valid
+  
+    Returns
+    -------
+    True if successful, False if not
+    """
+    try: 
+        if assetid is None:
+            print("Enter asset id>")
+            assetid = input()
+
+        sql_download_input_name = """
+        SELECT assetname, bucketkey 
+        FROM assets 
+        WHERE assetid = %s; 
+        """
+
+        row = datatier.retrieve_one_row(dbConn, sql_download_input_name, [assetid]) 
+
+        if row is None or row==(): 
+            print("No such asset...")
+            return False
+
+        assetname = row[0]   
+        bucketkey = row[1]
+
+        url = awsutil.presign_get(bucket, bucketkey, ttl)
+
+        if url is None:
+            print(f"Error: Failed to create download URL for key {bucketkey}")
+            return False
+
+        print(f"Download URL for ' {assetname} ' (valid {ttl} secs):")
+        print(url)
+        return True
+
+    except Exception as e:
+        print("ERROR")
+        print("ERROR: an exception was raised and caught")
+        print("MESSAGE:", str(e))
+        return False
+
+
+###################################################################
+#
+# upload_url
+#
+@metrics.timed("main.upload_url", failed=metrics.is_false)
+def upload_url(dbConn, bucket, userid=None, filename=None, ttl=3600, wait=True): 
+    """
+    Creates a new uuid key in the user's S3 folder and prints a presigned
+    URL to which the client can PUT the file directly. If wait is True,
+    waits for the user to confirm the upload finished, then records the
+    asset; otherwise prints the key to pass to record_upload later.
+  
+    Parameters
+    ----------
+    dbConn: open connection to MySQL server,
+    bucket: S3 boto bucket object,
+    userid: user to upload for, or None to ask the user,
+    filename: original filename of the asset, or None to ask the user,
+    ttl: seconds the URL stays valid,
+    wait: whether to wait and record the asset once uploaded
+  
+    Returns
+    -------
+    True if successful, False if not
+    """
+    try: 
+        if userid is None:
+            print("Enter user id>")
+            userid = input()
+
+        if filename is None:
+            print("Enter original filename>")
+            filename = input()
+
+        sql_check_user = """
+        SELECT bucketfolder FROM users
+        WHERE userid = %s;
+        """
+
+        row = datatier.retrieve_one_row(dbConn, sql_check_user, [userid])
+
+        if row is None or row == (): 
+            print("No such user...")
+            return False
+
+        folder_id = row[0]
+        bucket_key = f"{folder_id}/{uuid.uuid4()}.jpg"
+
+        url = awsutil.presign_put(bucket, bucket_key, ttl)
+
+        if url is None:
+            print(f"Error: Failed to create upload URL for key {bucket_key}")
+            return False
+
+        print(f"Upload URL for '{filename}' (valid {ttl} secs), PUT the file with e.g.")
+        print(f"  curl -X PUT -H 'x-amz-acl: public-read' -H 'Content-Type: {awsutil.content_type(bucket_key)}' --upload-file {shlex.quote(filename)} '{url}'")
+        print(f"S3 key: {bucket_key}")
 
-###################################################################
-#
-# assets
-#
-def assets(dbConn): 
-  """
-  Retrieves and outputs asset information from the asset table: assetid, 
-  userid, original name, and key name 
+        if not wait:
+            return True
 
-  Parameters
-  ----------
-  dbConn: open connection to MySQL server
-  
-  Returns
-  -------
-  nothing
-  """
+        print("Press ENTER once the upload has finished>")
+        input()
+
+        return record_upload(dbConn, bucket, userid, filename, bucket_key)
+
+    except Exception as e:
+        print("ERROR")
+        print("ERROR: an exception was raised and caught")
+        print("MESSAGE:", str(e))
+        return False
 
-  try: 
-    #Retrive all columns and in descending order by assetid
-    sql_asset_output = """
-    SELECT * 
-    FROM assets 
-    ORDER BY assetid DESC; 
-    """
 
-    #We want all the rows 
-    rows = datatier.retrieve_all_rows(dbConn, sql_asset_output)
-    if rows is None: 
-      print("Failed to retrieve any asset rows")
-    else: 
-      for row in rows: 
-        print("Asset id:", row[0], "\n  User id:", row[1], "\n  Original name:", row[2], "\n  Key name:", row[3])
-  except Exception as e: 
-    print("ERROR")
-    print("ERROR: an exception was raised and caught")
-    print("ERROR")
-    print("MESSAGE:", str(e))
-    
 ###################################################################
 #
-# download
+# record_upload
 #
-def download(dbConn, bucket, display=False): 
+@metrics.timed("main.record_upload", failed=metrics.is_false)
+def record_upload(dbConn, bucket, userid, filename, bucket_key): 
     """
-    Retrieves asset file by assetid in the asset table, downloads file, 
-    and then renames it based on original name. Shows image if user inputs
-    5 (display boolean will be passed as True)
+    Records an asset that a client uploaded directly to S3 (see
+    upload_url), after checking the key is in the user's folder and
+    not yet recorded, and that the object really is there
   
     Parameters
     ----------
-    dbConn: open connection to MySQL server
-    display: boolean-controls whether to show downloaded image
+    dbConn: open connection to MySQL server,
+    bucket: S3 boto bucket object,
+    userid: user the asset belongs to,
+    filename: original filename of the asset,
+    bucket_key: S3 key the asset was uploaded to
   
     Returns
     -------
-    nothing
+    True if successful, False if not
     """
     try: 
-        print("Enter asset id>")
-        cmd = input()
+        #The key must be in the user's folder, and not recorded yet
+        #(it would be counted twice)
+        sql_check_user = """
+        SELECT bucketfolder FROM users
+        WHERE userid = %s;
+        """
 
-        #Query the database for assetname and bucketkey based on assetid
-        sql_download_input_name = """
-        SELECT assetname, bucketkey 
-        FROM assets 
-        WHERE assetid = %s; 
+        row = datatier.retrieve_one_row(dbConn, sql_check_user, [userid])
+
+        if row is None or row == (): 
+            print("No such user...")
+            return False
+
+        if not bucket_key.startswith(row[0] + "/"):
+            print(f"'{bucket_key}' is not in the user's folder, upload not recorded")
+            return False
+
+        sql_check_key = """
+        SELECT assetid FROM assets
+        WHERE bucketkey = %s
+        LIMIT 1;
         """
 
-        row = datatier.retrieve_one_row(dbConn, sql_download_input_name, [cmd]) 
+        row = datatier.retrieve_one_row(dbConn, sql_check_key, [bucket_key])
 
-        if row is None or row==(): 
-            print("No such asset...")
-            return
+        if row is None:
+            print("Error looking up bucket key")
+            return False
 
-        #Retrieve the assetname (original name) and bucketkey (S3 key)
-        assetname = row[0]   
-        bucketkey = row[1]
+        if row != ():
+            print(f"'{bucket_key}' is already recorded as asset {row[0]}, upload not recorded")
+            return False
 
-        # Use the helper function to download the file
-        downloaded_filename = awsutil.download_file(bucket, bucketkey)
+        nbytes = awsutil.get_object_size(bucket, bucket_key)
 
-        if downloaded_filename is None:
-            print(f"Error: Failed to download file from S3 with key {bucketkey}")
-        else:
-            #Rename the downloaded file to the original asset name
-            os.rename(downloaded_filename, assetname)
-            print(f"Downloaded from S3 and saved as ' {assetname} '")
+        if nbytes is None:
+            print(f"No object in S3 under '{bucket_key}', upload not recorded")
+            return False
 
-            # If display=True, trigger image to pop up
-            if display: 
-                image = img.imread(assetname)
-                plt.imshow(image)
-                plt.show()
+        print(f"Found {nbytes:,} bytes in S3 under '{bucket_key}'")
+
+        #Insert the asset row, keeping the maintained stats in step in
+        #the same transaction
+        sql_insert_asset = """
+        INSERT INTO assets (userid, assetname, bucketkey, bytes)
+        VALUES (%s, %s, %s, %s)
+        """
+
+        statements = [(sql_insert_asset, [userid, filename, bucket_key, nbytes])]
+        statements += userstats_statements(userid, 1, nbytes)
+        statements += object_count_statements(bucket.name, 1)
+
+        results = datatier.perform_transaction(dbConn, statements)
+
+        if results is None: 
+            print("Error inserting asset into assets table")
+            return False
+        
+        print(f"Recorded in RDS under asset id {results[0][1]}")
+        return True
 
     except Exception as e:
         print("ERROR")
         print("ERROR: an exception was raised and caught")
         print("MESSAGE:", str(e))
+        return False
 
 
 ###################################################################
 #
-# upload
+# bulk_upload
 #
-def upload(dbConn, bucket): 
+@metrics.timed("main.bulk_upload", failed=metrics.is_false)
+def bulk_upload(dbConn, bucket, transfer_config=None, max_workers=16, pattern=None, userid=None,
+                rendition_sizes=None): 
     """
-    Inputs a local file, a user id, and uploads this file to the user's folder
-    in S3 (file is given a unique uuid name). Also inputs all asset information into the 
-    asset table as a row 
+    Inputs a local directory (or glob pattern) and a user id, uploads
+    every matching file to the user's folder in S3 using a pool of
+    threads (each file is given a unique uuid name), then records all
+    the new assets in the asset table with one multi-row insert. Files
+    whose contents (SHA-256) the user already has in S3, or that duplicate
+    another file in the batch, are not uploaded again; their asset rows
+    point at the existing object.
   
     Parameters
     ----------
-    dbConn: open connection to MySQL server
+    dbConn: open connection to MySQL server,
+    bucket: S3 boto bucket object,
+    transfer_config: optional boto3 TransferConfig for the uploads,
+    max_workers: # of files to upload at once,
+    pattern: local directory or glob pattern, or None to ask the user,
+    userid: user to upload for, or None to ask the user,
+    rendition_sizes: sizes of the preview renditions to generate
+      (None for none)
   
     Returns
     -------
-    nothing
+    True if successful, False if not
     """
+    if rendition_sizes is None:
+        rendition_sizes = []
+
     try: 
-        # Local filename + error handling 
-        print("Enter local filename>")
-        cmd_filename = input()
+        if pattern is None:
+            print("Enter local directory or glob pattern>")
+            pattern = input()
+        cmd_pattern = pattern
 
-        if not os.path.isfile(cmd_filename): 
-            print(f"Local file '{cmd_filename}' does not exist...")
-            return  
+        if os.path.isdir(cmd_pattern):
+            filenames = [os.path.join(cmd_pattern, name) for name in sorted(os.listdir(cmd_pattern))]
+        else:
+            filenames = sorted(glob.glob(cmd_pattern))
 
-        print("Enter user id>")
-        cmd_userid = input()
+        filenames = [name for name in filenames if os.path.isfile(name)]
+
+        if len(filenames) == 0:
+            print(f"No local files match '{cmd_pattern}'...")
+            return False
+
+        if userid is None:
+            print("Enter user id>")
+            userid = input()
+        cmd_userid = userid
 
-        # Check if this query does not come up empty, which indicates the user exists
         sql_check_user = """
         SELECT bucketfolder FROM users
         WHERE userid = %s;
@@ -309,78 +1793,168 @@ def upload(dbConn, bucket):
 
         row = datatier.retrieve_one_row(dbConn, sql_check_user, [cmd_userid])
 
-        if row is None: 
+        if row is None or row == (): 
             print("No such user...")
-            return 
+            return False
 
-        #Construct uuid-based bucket key name
         folder_id = row[0]
-        file_id = str(uuid.uuid4())
-        bucket_key = f"{folder_id}/{file_id}.jpg"
 
-        uploaded_key = awsutil.upload_file(cmd_filename, bucket, bucket_key)
-
-        if uploaded_key is None:
-            print(f"Error uploading file to S3 as '{bucket_key}'")
-            return 
-        else:
-            print(f"Uploaded and stored in S3 as '{uploaded_key}'")
-
-        #Insert row containing new asset info into the assets table
-        sql_insert_asset = """
-        INSERT INTO assets (userid, assetname, bucketkey)
-        VALUES (%s, %s, %s)
+        #Hash every file, then find which contents this user already
+        #has stored with one query
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = list(executor.map(hash_file, filenames))
+
+        unique_hashes = sorted(set(hashes))
+        placeholders = ", ".join(["%s"] * len(unique_hashes))
+        sql_find_content = f"""
+        SELECT contenthash, MIN(bucketkey) FROM assets
+        WHERE userid = %s AND contenthash IN ({placeholders})
+        GROUP BY contenthash;
         """
 
-        rows = datatier.perform_action(dbConn, sql_insert_asset, [cmd_userid, cmd_filename, uploaded_key])
-
-        if rows == -1: 
-            print("Error inserting asset into assets table")
-            return
-        
-        #Output the auto-generated asset id from the inputted row
-        sql_last_insert = """
-        SELECT LAST_INSERT_ID()
+        existing_rows = datatier.retrieve_all_rows(dbConn, sql_find_content, [cmd_userid] + unique_hashes)
+
+        if existing_rows is None:
+            print("Error looking up content hashes")
+            return False
+
+        key_of_hash = dict(existing_rows)
+
+        #Upload one file per new content hash
+        to_upload = {}
+        for (filename, content_hash) in zip(filenames, hashes):
+            if content_hash not in key_of_hash and content_hash not in to_upload:
+                to_upload[content_hash] = filename
+
+        def upload_one(filename):
+            bucket_key = f"{folder_id}/{uuid.uuid4()}.jpg"
+            upload_stats = {}
+            uploaded_key = awsutil.upload_file(filename, bucket, bucket_key,
+                                               config=transfer_config,
+                                               stats=upload_stats)
+            return (filename, uploaded_key, upload_stats.get('bytes', 0))
+
+        print(f"Uploading {len(to_upload)} files ({len(filenames) - len(to_upload)} with contents already stored)...")
+        start = time.perf_counter()
+
+        uploaded = []  # (bucket key, filename) of objects new to S3
+        total_bytes = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for (content_hash, (filename, uploaded_key, nbytes)) in \
+                zip(to_upload.keys(), executor.map(upload_one, to_upload.values())):
+                if uploaded_key is None:
+                    print(f"Error uploading '{filename}', skipping")
+                    continue
+                key_of_hash[content_hash] = uploaded_key
+                uploaded.append((uploaded_key, filename))
+                total_bytes += nbytes
+
+        elapsed = time.perf_counter() - start
+        mbps = (total_bytes / (1024 * 1024)) / elapsed if elapsed > 0 else 0.0
+        print(f"Uploaded {len(uploaded)} of {len(to_upload)} files to S3")
+        print(f"  {total_bytes:,} bytes in {elapsed:.2f} secs ({mbps:.2f} MB/s)")
+
+        new_assets = [[cmd_userid, filename, key_of_hash[content_hash], content_hash,
+                       os.path.getsize(filename)]
+                      for (filename, content_hash) in zip(filenames, hashes)
+                      if content_hash in key_of_hash]
+
+        if len(new_assets) == 0:
+            return False
+
+        #Insert all the new asset rows in one transaction, together
+        #with the maintained stats they add to
+        sql_insert_asset = """
+        INSERT INTO assets (userid, assetname, bucketkey, contenthash, bytes)
+        VALUES (%s, %s, %s, %s, %s)
         """
 
-        row = datatier.retrieve_one_row(dbConn, sql_last_insert)
-        last_asset_id = row[0]
-        print(f"Recorded in RDS under asset id {last_asset_id}")
+        statements = [(sql_insert_asset, new_assets)]
+        statements += userstats_statements(cmd_userid, len(new_assets),
+                                           sum(asset[4] for asset in new_assets))
+        if len(uploaded) > 0:
+            statements += object_count_statements(bucket.name, len(uploaded))
+
+        results = datatier.perform_transaction(dbConn, statements)
+
+        if results is None: 
+            print("Error inserting assets into assets table")
+            return False
+
+        print(f"Recorded {results[0][0]} assets in RDS")
+
+        if len(rendition_sizes) > 0 and len(uploaded) > 0:
+            #Look up the generated asset ids by bucket key in one query;
+            #renditions belong to the first asset stored under each key
+            placeholders = ", ".join(["%s"] * len(uploaded))
+            sql_new_ids = f"""
+            SELECT MIN(assetid), bucketkey FROM assets
+            WHERE bucketkey IN ({placeholders})
+            GROUP BY bucketkey;
+            """
+            id_rows = datatier.retrieve_all_rows(dbConn, sql_new_ids, [key for (key, _) in uploaded])
+
+            if id_rows is None:
+                print("Error recording renditions")
+                return False
+
+            filename_of_key = dict(uploaded)
+            num_renditions = store_renditions(dbConn, bucket,
+                                              [(assetid, key, filename_of_key[key]) for (assetid, key) in id_rows],
+                                              rendition_sizes, max_workers)
+            if num_renditions == -1:
+                print("Error recording renditions")
+                return False
+            print(f"Stored {num_renditions} preview renditions")
+
+        return len(new_assets) == len(filenames)
 
     except Exception as e:
         print("ERROR")
         print("ERROR: an exception was raised and caught")
         print("MESSAGE:", str(e))
+        return False
 
 
 ###################################################################
 #
 # add_user 
 #
-def add_user(dbConn): 
+@metrics.timed("main.add_user", failed=metrics.is_false)
+def add_user(dbConn, email=None, lastname=None, firstname=None): 
     """
-    Retrieves asset file by assetid in the asset table, downloads file, 
-    and then renames it based on original name. Shows image if user inputted
-    5 (display boolean will be passed as True)
+    Inputs a new user's email, last name and first name, and inserts
+    the user into the users table with a new uuid bucket folder
   
     Parameters
     ----------
-    dbConn: open connection to MySQL server
+    dbConn: open connection to MySQL server,
+    email: user's email, or None to ask,
+    lastname: user's last name, or None to ask,
+    firstname: user's first name, or None to ask
   
     Returns
     -------
-    nothing
+    True if successful, False if not
     """
     try: 
       #Retrive email, lastname, and firstname from input 
-      print("Enter user's email>")
-      cmd_user_email = input()
+      if email is None:
+        print("Enter user's email>")
+        email = input()
 
-      print("Enter user's last (family) name>")
-      cmd_last_name = input()
+      if lastname is None:
+        print("Enter user's last (family) name>")
+        lastname = input()
 
-      print("Enter user's first (family) name>")
-      cmd_first_name = input()
+      if firstname is None:
+        print("Enter user's first (family) name>")
+        firstname = input()
+
+      cmd_user_email = email
+      cmd_last_name = lastname
+      cmd_first_name = firstname
 
       #Create uuid folder_name
       folder_name=str(uuid.uuid4())
@@ -391,109 +1965,268 @@ def add_user(dbConn):
       VALUES (%s, %s, %s, %s)
       """
 
-      rows = datatier.perform_action(dbConn, sql_insert_user, [cmd_user_email, cmd_last_name, cmd_first_name, folder_name])
+      #The auto-generated user id comes back with the insert itself
+      last_user_id = datatier.insert_returning_id(dbConn, sql_insert_user, [cmd_user_email, cmd_last_name, cmd_first_name, folder_name])
 
-      if rows == -1: 
+      if last_user_id == -1: 
         print("Error inserting user into users table")
-      
-      #Lastly, output the auto-generated user id from the inputted row
-      sql_last_insert = """
-      SELECT LAST_INSERT_ID()
-      """
+        return False
 
-      row = datatier.retrieve_one_row(dbConn, sql_last_insert)
-      last_user_id = row[0]
+      add_to_counter(dbConn, "users", 1)
+      
       print(f"Recorded in RDS under {last_user_id}")
-  
+      return True
 
     except Exception as e:
         print("ERROR")
         print("ERROR: an exception was raised and caught")
         print("MESSAGE:", str(e))
+        return False
 
 
-#########################################################################
-# main
+###################################################################
 #
-print('** Welcome to PhotoApp **')
-print()
-
-# eliminate traceback so we just get error message:
-sys.tracebacklimit = 0
-
+# Session
 #
-# what config file should we use for this session?
+# Everything a run of the program sets up once from the config
+# file and then shares across commands: the S3 bucket, upload
+# settings, the local asset cache, and the database pool. The
+# S3 side is set up on first use, so commands that only touch
+# the database never import boto3.
 #
-config_file = 'photoapp-config.ini'
+class Session:
+  """
+  S3 and RDS state for one run of the program
+
+  Parameters
+  ----------
+  config_file: name of the config file to read
+  """
 
-print("What config file to use for this session?")
-print("Press ENTER to use default (photoapp-config.ini),")
-print("otherwise enter name of config file>")
-s = input()
+  def __init__(self, config_file):
+    self.config_file = config_file
 
-if s == "":  # use default
-  pass  # already set
-else:
-  config_file = s
+    configur = ConfigParser()
+    configur.read(config_file)
+    self.configur = configur
+    self.bucketname = configur.get('s3', 'bucket_name')
+    self.inventory_manifest = configur.get('s3', 'inventory_manifest', fallback=None)
 
-#
-# does config file exist?
-#
-if not pathlib.Path(config_file).is_file():
-  print("**ERROR: config file '", config_file, "' does not exist, exiting")
-  sys.exit(0)
+    #
+    # S3 credentials come from the config file's [s3readwrite]
+    # profile; set once here, not on (possibly concurrent) first
+    # use of the bucket:
+    #
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
 
-#
-# gain access to our S3 bucket:
-#
-s3_profile = 's3readwrite'
+    self._bucket = None
+    self._transfer_config = None
+    self._transfer = None
+    self._s3_lock = threading.RLock()  # guards the lazily created S3 objects
+
+    self.bulk_upload_workers = configur.getint('s3', 'bulk_upload_workers', fallback=16)
+    self.batch_download_workers = configur.getint('s3', 'batch_download_workers', fallback=16)
+    self.presign_ttl = configur.getint('s3', 'presign_ttl', fallback=3600)
 
-os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+    #
+    # preview renditions generated at upload, e.g.
+    #   [renditions]
+    #   sizes = 128, 512, 1600
+    #   view_size = 512
+    # (an empty sizes list turns them off):
+    #
+    sizes = configur.get('renditions', 'sizes', fallback=None)
+    if sizes is None:
+      self.rendition_sizes = imageutil.DEFAULT_SIZES
+    else:
+      self.rendition_sizes = [int(size) for size in sizes.replace(",", " ").split()]
+    self.view_size = configur.getint('renditions', 'view_size', fallback=512)
+
+    #
+    # optional local cache of downloaded assets, e.g.
+    #   [cache]
+    #   directory = .photoapp-cache
+    #   max_size = 1GB
+    #   revalidate_after = 60
+    #
+    if configur.has_section('cache'):
+      self.cache = assetcache.AssetCache(configur.get('cache', 'directory', fallback='.photoapp-cache'),
+                                         awsutil.parse_size(configur.get('cache', 'max_size', fallback='1GB')),
+                                         configur.getint('cache', 'revalidate_after', fallback=0))
+    else:
+      self.cache = None
+
+    #
+    # optional metrics export on exit, e.g.
+    #   [metrics]
+    #   summary = yes
+    #   prometheus_file = /var/lib/node_exporter/photoapp.prom
+    #
+    self.metrics_summary = configur.getboolean('metrics', 'summary', fallback=False)
+    self.metrics_file = configur.get('metrics', 'prometheus_file', fallback=None)
 
-boto3.setup_default_session(profile_name=s3_profile)
+    #
+    # now let's connect to our RDS MySQL server:
+    #
+    self.endpoint = configur.get('rds', 'endpoint')
+    portnum = int(configur.get('rds', 'port_number'))
+    username = configur.get('rds', 'user_name')
+    pwd = configur.get('rds', 'user_pwd')
+    dbname = configur.get('rds', 'db_name')
 
-configur = ConfigParser()
-configur.read(config_file)
-bucketname = configur.get('s3', 'bucket_name')
+    #
+    # optional pool sizing, e.g.
+    #   [rds]
+    #   pool_min_size = 1
+    #   pool_max_size = 10
+    #   pool_idle_timeout = 300
+    #
+    pool_min_size = configur.getint('rds', 'pool_min_size', fallback=1)
+    pool_max_size = configur.getint('rds', 'pool_max_size', fallback=10)
+    pool_idle_timeout = configur.getint('rds', 'pool_idle_timeout', fallback=300)
 
-s3 = boto3.resource('s3')
-bucket = s3.Bucket(bucketname)
+    #
+    # optional retry tuning for transient database errors, e.g.
+    #   [rds]
+    #   retry_attempts = 3
+    #   retry_base_delay = 0.1
+    #   retry_max_delay = 2.0
+    # (retry_attempts = 1 turns retrying off):
+    #
+    datatier.set_retry_policy(datatier.RetryPolicy(
+      max_attempts=configur.getint('rds', 'retry_attempts', fallback=3),
+      base_delay=configur.getfloat('rds', 'retry_base_delay', fallback=0.1),
+      max_delay=configur.getfloat('rds', 'retry_max_delay', fallback=2.0)))
 
-#
-# now let's connect to our RDS MySQL server:
-#
-endpoint = configur.get('rds', 'endpoint')
-portnum = int(configur.get('rds', 'port_number'))
-username = configur.get('rds', 'user_name')
-pwd = configur.get('rds', 'user_pwd')
-dbname = configur.get('rds', 'db_name')
+    self.dbPool = datatier.Pool(self.endpoint, portnum, username, pwd, dbname,
+                                min_size=pool_min_size,
+                                max_size=pool_max_size,
+                                idle_timeout=pool_idle_timeout)
 
-dbConn = datatier.get_dbConn(endpoint, portnum, username, pwd, dbname)
+    #
+    # optional cache of query results, e.g.
+    #   [rds]
+    #   query_cache_ttl = 5
+    #   query_cache_max_size = 16MB
+    # (off unless a ttl is given; writes by other processes are
+    # seen once the ttl runs out):
+    #
+    query_cache_ttl = configur.getfloat('rds', 'query_cache_ttl', fallback=0)
+    if query_cache_ttl > 0:
+      max_bytes = awsutil.parse_size(configur.get('rds', 'query_cache_max_size', fallback='16MB'))
+      datatier.set_query_cache(datatier.QueryCache(query_cache_ttl, max_bytes))
+
+  @property
+  def bucket(self):
+    """
+    The S3 boto bucket object, created on first use
+    """
+    with self._s3_lock:
+      if self._bucket is None:
+        #
+        # gain access to our S3 bucket, through the process-wide
+        # S3 resource (connection pool size, retries, timeouts and
+        # the optional endpoint_url of a local S3 stand-in such as
+        # moto_server or MinIO come from the [s3] section):
+        #
+        s3_profile = 's3readwrite'
+
+        s3 = awsutil.get_s3_resource(self.configur, profile_name=s3_profile)
+        self._bucket = s3.Bucket(self.bucketname)
+
+      return self._bucket
+
+  @property
+  def s3_client(self):
+    """
+    The low-level boto3 S3 client behind the bucket; unlike the
+    bucket object it is safe to share across threads
+    """
+    return self.bucket.meta.client
+
+  @property
+  def transfer_config(self):
+    """
+    Upload tuning (multipart threshold/chunk size, concurrency)
+    """
+    with self._s3_lock:
+      if self._transfer_config is None:
+        self._transfer_config = awsutil.get_transfer_config(self.configur)
+      return self._transfer_config
+
+  @property
+  def transfer(self):
+    """
+    Reusable S3Transfer if [s3] reuse_threads is set, else None
+    """
+    with self._s3_lock:
+      if self._transfer is None and \
+         self.configur.getboolean('s3', 'reuse_threads', fallback=False):
+        self._transfer = awsutil.make_transfer(self.bucket, self.transfer_config)
+      return self._transfer
+
+  def close(self):
+    self.dbPool.close()
+
+    if self.metrics_file:
+      try:
+        metrics.write_prometheus(self.metrics_file)
+      except Exception as e:
+        logging.error("main.Session.close() failed to write metrics:")
+        logging.error(e)
+
+    if self.metrics_summary:
+      print()
+      print(metrics.summary())
 
-if dbConn is None:
-  print('**ERROR: unable to connect to database, exiting')
-  sys.exit(0)
 
+###################################################################
 #
-# main processing loop:
+# run_menu_command
 #
-cmd = prompt()
+def run_menu_command(session, dbConn, cmd):
+  """
+  Runs one command chosen from the interactive menu
+  
+  Parameters
+  ----------
+  session: the Session,
+  dbConn: open connection to MySQL server,
+  cmd: command number
+  
+  Returns
+  -------
+  nothing
+  """
 
-while cmd != 0:
   if cmd == 1:
-    stats(bucketname, bucket, endpoint, dbConn)
+    stats(session.bucketname, lambda: session.bucket, session.endpoint, dbConn, manifest=session.inventory_manifest)
   elif cmd == 2: 
     users(dbConn)
   elif cmd == 3: 
     assets(dbConn)
   elif cmd == 4: 
-    download(dbConn, bucket)
+    download(dbConn, session.bucket, cache=session.cache)
   elif cmd == 5: 
-    download(dbConn, bucket, True)
+    download(dbConn, session.bucket, True, cache=session.cache)
   elif cmd == 6: 
-     upload(dbConn, bucket) 
+     upload(dbConn, session.bucket, session.transfer_config, session.transfer,
+            rendition_sizes=session.rendition_sizes) 
   elif cmd == 7: 
     add_user(dbConn)
+  elif cmd == 8:
+    stats(session.bucketname, lambda: session.bucket, session.endpoint, dbConn, exact=True)
+  elif cmd == 9:
+    bulk_upload(dbConn, session.bucket, session.transfer_config, session.bulk_upload_workers,
+                rendition_sizes=session.rendition_sizes)
+  elif cmd == 10:
+    batch_download(dbConn, session.bucket, session.cache, session.batch_download_workers)
+  elif cmd == 11:
+    download_url(dbConn, session.bucket, ttl=session.presign_ttl)
+  elif cmd == 12:
+    upload_url(dbConn, session.bucket, ttl=session.presign_ttl)
+  elif cmd == 13:
+    view(dbConn, session.bucket, size=session.view_size, cache=session.cache)
   #
   #
   # TODO
@@ -501,11 +2234,313 @@ while cmd != 0:
   #
   else:
     print("** Unknown command, try again...")
+
+
+###################################################################
+#
+# run_cli_command
+#
+def run_cli_command(session, dbConn, args):
+  """
+  Runs one command given on the command line (or in a batch file)
+  
+  Parameters
+  ----------
+  session: the Session,
+  dbConn: open connection to MySQL server,
+  args: parsed arguments (see build_parser)
+  
+  Returns
+  -------
+  True if successful, False if not
+  """
+
+  if args.command == 'stats':
+    return stats(session.bucketname, lambda: session.bucket, session.endpoint, dbConn,
+                 exact=args.exact, manifest=session.inventory_manifest,
+                 per_user=args.per_user, per_folder=args.per_folder)
+  elif args.command == 'users':
+    return users(dbConn, args.page_size, args.after)
+  elif args.command == 'assets':
+    return assets(dbConn, args.page_size, args.after)
+  elif args.command == 'download':
+    ok = True
+    for assetid in args.assetids:
+      ok = download(dbConn, session.bucket, args.display, cache=session.cache, assetid=assetid) and ok
+    return ok
+  elif args.command == 'batch-download':
+    return batch_download(dbConn, session.bucket, session.cache, session.batch_download_workers,
+                          ids=" ".join(args.ids), folder=args.dir)
+  elif args.command == 'upload':
+    ok = True
+    for path in args.paths:
+      if os.path.isfile(path):
+        ok = upload(dbConn, session.bucket, session.transfer_config, session.transfer,
+                    filename=path, userid=args.user,
+                    rendition_sizes=session.rendition_sizes) and ok
+      else:  # directory or glob pattern
+        ok = bulk_upload(dbConn, session.bucket, session.transfer_config, session.bulk_upload_workers,
+                         pattern=path, userid=args.user,
+                         rendition_sizes=session.rendition_sizes) and ok
+    return ok
+  elif args.command == 'add-user':
+    return add_user(dbConn, args.email, args.last, args.first)
+  elif args.command == 'view':
+    return view(dbConn, session.bucket, args.assetid, args.size or session.view_size, session.cache)
+  elif args.command == 'download-url':
+    ok = True
+    for assetid in args.assetids:
+      ok = download_url(dbConn, session.bucket, assetid, args.ttl or session.presign_ttl) and ok
+    return ok
+  elif args.command == 'upload-url':
+    return upload_url(dbConn, session.bucket, args.user, args.name,
+                      args.ttl or session.presign_ttl, wait=False)
+  elif args.command == 'record-upload':
+    return record_upload(dbConn, session.bucket, args.user, args.name, args.key)
+  else:
+    print(f"** Unknown command '{args.command}'")
+    return False
+
+
+###################################################################
+#
+# build_parser
+#
+def build_parser():
+  """
+  Builds the command line parser. With no command the program runs
+  the interactive menu; otherwise it runs the command(s) and exits
+  with status 0 if they all succeeded and 1 if not.
+  
+  Parameters
+  ----------
+  None
+  
+  Returns
+  -------
+  an argparse.ArgumentParser
+  """
+
+  parser = argparse.ArgumentParser(prog='photoapp',
+                                   description='Photo storage and viewing using AWS S3 and RDS.')
+  parser.add_argument('--config', help='config file (default: photoapp-config.ini; asked for if interactive)')
+
+  commands = parser.add_subparsers(dest='command')
+
+  cmd = commands.add_parser('stats', help='bucket and database stats')
+  cmd.add_argument('--exact', action='store_true', help='list the bucket for an exact S3 object count')
+  cmd.add_argument('--per-user', action='store_true', help="also show each user's asset count and bytes")
+  cmd.add_argument('--per-folder', action='store_true',
+                   help="list the bucket and show each user folder's object count and bytes")
+
+  for name in ['users', 'assets']:
+    cmd = commands.add_parser(name, help=f'list {name}, newest first')
+    cmd.add_argument('--page-size', type=int, default=0, help='rows per page (default: all rows)')
+    cmd.add_argument('--after', type=int, help='show the page after this key')
+
+  cmd = commands.add_parser('download', help='download assets by id, saved under their original names')
+  cmd.add_argument('assetids', nargs='+')
+  cmd.add_argument('--display', action='store_true', help='show each image after downloading')
+
+  cmd = commands.add_parser('batch-download', help='download assets concurrently as <assetid>_<name>')
+  cmd.add_argument('ids', nargs='+', help='asset ids, ranges such as 5-9, or u<userid>')
+  cmd.add_argument('--dir', default='.', help='directory to save into')
+
+  cmd = commands.add_parser('upload', help='upload files, directories or glob patterns for a user')
+  cmd.add_argument('paths', nargs='+')
+  cmd.add_argument('--user', required=True, help='user id to upload for')
+
+  cmd = commands.add_parser('add-user', help='add a new user')
+  cmd.add_argument('--email', required=True)
+  cmd.add_argument('--last', required=True, help='last (family) name')
+  cmd.add_argument('--first', required=True, help='first name')
+
+  cmd = commands.add_parser('view', help='display an asset from its preview rendition, without saving it')
+  cmd.add_argument('assetid')
+  cmd.add_argument('--size', type=int, help='smallest acceptable longest side in pixels')
+
+  cmd = commands.add_parser('download-url', help='print presigned URLs to download assets directly from S3')
+  cmd.add_argument('assetids', nargs='+')
+  cmd.add_argument('--ttl', type=int, help='seconds the URLs stay valid')
+
+  cmd = commands.add_parser('upload-url', help='print a presigned URL to upload an asset directly to S3')
+  cmd.add_argument('--user', required=True, help='user id to upload for')
+  cmd.add_argument('--name', required=True, help='original filename of the asset')
+  cmd.add_argument('--ttl', type=int, help='seconds the URL stays valid')
+
+  cmd = commands.add_parser('record-upload', help='record an asset uploaded through upload-url')
+  cmd.add_argument('--user', required=True, help='user id the asset belongs to')
+  cmd.add_argument('--name', required=True, help='original filename of the asset')
+  cmd.add_argument('--key', required=True, help='S3 key printed by upload-url')
+
+  cmd = commands.add_parser('batch', help='run commands read one per line from a file ("-" for stdin)')
+  cmd.add_argument('file')
+
+  return parser
+
+
+###################################################################
+#
+# run_batch
+#
+def run_batch(session, parser, filename):
+  """
+  Runs a file of commands (one per line, in the same form as on the
+  command line, e.g. "download 12 13") in a single session, so the
+  connection pool and S3 client are set up only once
+  
+  Parameters
+  ----------
+  session: the Session,
+  parser: the command line parser,
+  filename: file of commands, or "-" for stdin
+  
+  Returns
+  -------
+  True if every command succeeded, False if not
+  """
+
+  f = sys.stdin if filename == '-' else open(filename)
+  ok = True
+
+  try:
+    for line in f:
+      words = shlex.split(line, comments=True)
+      if len(words) == 0:
+        continue
+
+      try:
+        args = parser.parse_args(words)
+      except SystemExit:  # argparse already printed the problem
+        ok = False
+        continue
+
+      if args.command is None or args.command == 'batch':
+        print(f"** Invalid batch command '{line.strip()}'")
+        ok = False
+        continue
+
+      with session.dbPool.connection() as dbConn:
+        if dbConn is None:
+          print('**ERROR: unable to connect to database')
+          ok = False
+        else:
+          ok = run_cli_command(session, dbConn, args) and ok
+
+  finally:
+    if f is not sys.stdin:
+      f.close()
+
+  return ok
+
+
+###################################################################
+#
+# interactive
+#
+def interactive(session):
+  """
+  Runs the interactive menu until the user enters 0
+  
+  Parameters
+  ----------
+  session: the Session
+  
+  Returns
+  -------
+  nothing
+  """
+
+  #
+  # main processing loop; each command borrows a connection
+  # from the pool and returns it when done:
   #
   cmd = prompt()
 
+  while cmd != 0:
+    dbConn = session.dbPool.checkout()
+
+    if dbConn is None:
+      print('**ERROR: unable to connect to database, try again...')
+    else:
+      run_menu_command(session, dbConn, cmd)
+    #
+    session.dbPool.checkin(dbConn)
+    cmd = prompt()
+
+
+#########################################################################
+# main
 #
-# done
-#
-print()
-print('** done **')
+def main(argv):
+  parser = build_parser()
+  args = parser.parse_args(argv)
+
+  is_interactive = args.command is None
+
+  if is_interactive:
+    print('** Welcome to PhotoApp **')
+    print()
+
+  # eliminate traceback so we just get error message:
+  sys.tracebacklimit = 0
+
+  #
+  # what config file should we use for this session?
+  #
+  config_file = 'photoapp-config.ini'
+
+  if args.config is not None:
+    config_file = args.config
+  elif is_interactive:
+    print("What config file to use for this session?")
+    print("Press ENTER to use default (photoapp-config.ini),")
+    print("otherwise enter name of config file>")
+    s = input()
+
+    if s == "":  # use default
+      pass  # already set
+    else:
+      config_file = s
+
+  #
+  # does config file exist?
+  #
+  if not pathlib.Path(config_file).is_file():
+    print("**ERROR: config file '", config_file, "' does not exist, exiting")
+    return 0 if is_interactive else 1
+
+  session = Session(config_file)
+
+  dbConn = session.dbPool.checkout()
+
+  if dbConn is None:
+    print('**ERROR: unable to connect to database, exiting')
+    return 0 if is_interactive else 1
+
+  try:
+    if is_interactive:
+      session.dbPool.checkin(dbConn)
+      interactive(session)
+      #
+      # done
+      #
+      print()
+      print('** done **')
+      return 0
+
+    if args.command == 'batch':
+      session.dbPool.checkin(dbConn)
+      ok = run_batch(session, parser, args.file)
+    else:
+      ok = run_cli_command(session, dbConn, args)
+      session.dbPool.checkin(dbConn)
+
+    return 0 if ok else 1
+
+  finally:
+    session.close()
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,391 @@
+#
+# metrics.py
+#
+# Lightweight in-process instrumentation: per-operation latency
+# histograms plus counts of calls, errors, bytes transferred and
+# rows touched, and plain event counters (e.g. retries).
+# Functions are instrumented with the timed() decorator, blocks
+# of code with the measure() context manager, events with
+# increment().
+# The collected numbers can be exported in the Prometheus text
+# exposition format (for scraping, or a node_exporter textfile)
+# or printed as a human-readable summary.
+#
+# Usage:
+#
+#   @metrics.timed("datatier.retrieve_all_rows", failed=metrics.is_none,
+#                  rows=lambda result, *args, **kwargs: len(result or []))
+#   def retrieve_all_rows(dbConn, sql, parameters=[]):
+#     ...
+#
+#   with metrics.measure("server.get_asset") as m:
+#     ...
+#     m.add_bytes(n)
+#
+
+import bisect
+import functools
+import os
+import threading
+import time
+import contextlib
+
+
+#
+# latency histogram bucket upper bounds, in seconds:
+#
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+###################################################################
+#
+# Operation
+#
+# Everything recorded about one named operation. Updated only
+# while holding the owning Registry's lock.
+#
+class Operation:
+  def __init__(self, name):
+    self.name = name
+    self.bucket_counts = [0] * (len(BUCKETS) + 1)  # last is +Inf
+    self.count = 0
+    self.seconds = 0.0
+    self.errors = 0
+    self.bytes = 0
+    self.rows = 0
+
+  def quantile(self, q):
+    """
+    Estimates the q-quantile (0..1) of the latency by linear
+    interpolation within the histogram bucket it falls in, the
+    way Prometheus' histogram_quantile() does
+
+    Returns
+    -------
+    seconds, or None if nothing has been recorded
+    """
+    if self.count == 0:
+      return None
+
+    rank = q * self.count
+    seen = 0
+    for (i, n) in enumerate(self.bucket_counts):
+      if n > 0 and seen + n >= rank:
+        lower = BUCKETS[i - 1] if i > 0 else 0.0
+        upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+        return lower + (upper - lower) * ((rank - seen) / n)
+      seen += n
+    return BUCKETS[-1]
+
+
+###################################################################
+#
+# Observation
+#
+# Handed out by measure() so the measured block can report what
+# it moved, or that it failed without raising.
+#
+class Observation:
+  def __init__(self):
+    self.bytes = 0
+    self.rows = 0
+    self.failed = False
+
+  def add_bytes(self, n):
+    self.bytes += n
+
+  def add_rows(self, n):
+    self.rows += n
+
+  def fail(self):
+    self.failed = True
+
+
+###################################################################
+#
+# Registry
+#
+class Registry:
+  """
+  Thread-safe collection of per-operation metrics
+
+  Parameters
+  ----------
+  prefix : prefix of the exported Prometheus metric names
+  """
+
+  def __init__(self, prefix="photoapp"):
+    self.prefix = prefix
+    self.enabled = True
+    self._operations = {}
+    self._events = {}
+    self._lock = threading.Lock()
+
+  def record(self, name, seconds, failed=False, nbytes=0, rows=0):
+    """
+    Records one completed call of an operation
+    """
+    if not self.enabled:
+      return
+
+    i = bisect.bisect_left(BUCKETS, seconds)
+
+    with self._lock:
+      op = self._operations.get(name)
+      if op is None:
+        op = self._operations[name] = Operation(name)
+      op.bucket_counts[i] += 1
+      op.count += 1
+      op.seconds += seconds
+      if failed:
+        op.errors += 1
+      op.bytes += nbytes
+      op.rows += rows
+
+  def increment(self, event, n=1):
+    """
+    Adds n to the named event counter
+    """
+    if not self.enabled:
+      return
+
+    with self._lock:
+      self._events[event] = self._events.get(event, 0) + n
+
+  def events(self):
+    """
+    Returns a copy of the event counters, as a dictionary
+    """
+    with self._lock:
+      return dict(sorted(self._events.items()))
+
+  def snapshot(self):
+    """
+    Returns a copy of the recorded operations, sorted by name
+    """
+    with self._lock:
+      ops = []
+      for name in sorted(self._operations):
+        op = self._operations[name]
+        copy = Operation(name)
+        copy.__dict__.update(op.__dict__)
+        copy.bucket_counts = list(op.bucket_counts)
+        ops.append(copy)
+      return ops
+
+  def reset(self):
+    with self._lock:
+      self._operations = {}
+      self._events = {}
+
+  def prometheus(self):
+    """
+    Returns the metrics in the Prometheus text exposition format
+    """
+    p = self.prefix
+    ops = self.snapshot()
+    lines = []
+
+    lines.append(f"# HELP {p}_operation_seconds Latency of each operation.")
+    lines.append(f"# TYPE {p}_operation_seconds histogram")
+    for op in ops:
+      label = f'operation="{op.name}"'
+      cumulative = 0
+      for (bound, n) in zip(BUCKETS, op.bucket_counts):
+        cumulative += n
+        lines.append(f'{p}_operation_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+      lines.append(f'{p}_operation_seconds_bucket{{{label},le="+Inf"}} {op.count}')
+      lines.append(f"{p}_operation_seconds_sum{{{label}}} {op.seconds:.6f}")
+      lines.append(f"{p}_operation_seconds_count{{{label}}} {op.count}")
+
+    for (metric, attr, help_text) in [
+        ("operation_errors_total", "errors", "Failed calls of each operation."),
+        ("operation_bytes_total", "bytes", "Bytes transferred by each operation."),
+        ("operation_rows_total", "rows", "Database rows returned or modified by each operation.")]:
+      lines.append(f"# HELP {p}_{metric} {help_text}")
+      lines.append(f"# TYPE {p}_{metric} counter")
+      for op in ops:
+        lines.append(f'{p}_{metric}{{operation="{op.name}"}} {getattr(op, attr)}')
+
+    lines.append(f"# HELP {p}_events_total Occurrences of each counted event.")
+    lines.append(f"# TYPE {p}_events_total counter")
+    for (event, n) in self.events().items():
+      lines.append(f'{p}_events_total{{event="{event}"}} {n}')
+
+    return "\n".join(lines) + "\n"
+
+  def summary(self):
+    """
+    Returns a table of the metrics for printing, one operation
+    per line
+    """
+    ops = self.snapshot()
+    events = self.events()
+    if len(ops) == 0 and len(events) == 0:
+      return "(no operations recorded)"
+
+    def ms(seconds):
+      return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+    width = max([len("operation")] + [len(op.name) for op in ops] + [len(e) for e in events])
+    lines = [f"{'operation':<{width}} {'calls':>7} {'errors':>6} {'mean ms':>9} "
+             f"{'p50 ms':>9} {'p99 ms':>9} {'bytes':>14} {'rows':>10}"]
+    for op in ops:
+      lines.append(f"{op.name:<{width}} {op.count:>7} {op.errors:>6} "
+                   f"{ms(op.seconds / op.count):>9} {ms(op.quantile(0.5)):>9} "
+                   f"{ms(op.quantile(0.99)):>9} {op.bytes:>14,} {op.rows:>10,}")
+    if events:
+      lines.append("")
+      lines.append(f"{'event':<{width}} {'count':>7}")
+    for (event, n) in events.items():
+      lines.append(f"{event:<{width}} {n:>7}")
+    return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+
+###################################################################
+#
+# is_none / is_false / is_negative
+#
+# Common failed= tests, matching the repo's error conventions.
+#
+def is_none(result, *args, **kwargs):
+  return result is None
+
+
+def is_false(result, *args, **kwargs):
+  return result is False
+
+
+def is_negative(result, *args, **kwargs):
+  return result is None or result < 0
+
+
+###################################################################
+#
+# timed
+#
+def timed(operation, failed=None, rows=None, nbytes=None, registry=None):
+  """
+  Decorator that records each call of the function as one
+  observation of the named operation. A call that raises counts
+  as an error (and the exception propagates).
+
+  Parameters
+  ----------
+  operation : name to record under,
+  failed : optional function (result, *args, **kwargs) => True if
+    the call failed without raising (e.g. returned None),
+  rows : optional function (result, *args, **kwargs) => # of rows,
+  nbytes : optional function (result, *args, **kwargs) => # of bytes,
+  registry : Registry to record into (default: REGISTRY)
+
+  The result functions are called with the result followed by the
+  decorated function's own arguments, and only if it didn't fail.
+  """
+
+  def decorate(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      reg = registry or REGISTRY
+      if not reg.enabled:
+        return func(*args, **kwargs)
+
+      start = time.perf_counter()
+      try:
+        result = func(*args, **kwargs)
+      except BaseException:
+        reg.record(operation, time.perf_counter() - start, failed=True)
+        raise
+      elapsed = time.perf_counter() - start
+
+      bad = failed is not None and failed(result, *args, **kwargs)
+      n_rows = 0
+      n_bytes = 0
+      if not bad:
+        try:
+          n_rows = rows(result, *args, **kwargs) if rows else 0
+          n_bytes = nbytes(result, *args, **kwargs) if nbytes else 0
+        except Exception:
+          pass  # metrics must never break the operation
+
+      reg.record(operation, elapsed, failed=bad, nbytes=n_bytes, rows=n_rows)
+      return result
+
+    return wrapper
+
+  return decorate
+
+
+###################################################################
+#
+# measure
+#
+@contextlib.contextmanager
+def measure(operation, registry=None):
+  """
+  Context manager that records the enclosed block as one
+  observation of the named operation; yields an Observation for
+  reporting bytes, rows, or a failure. Raising counts as an error.
+
+  Parameters
+  ----------
+  operation : name to record under,
+  registry : Registry to record into (default: REGISTRY)
+  """
+  reg = registry or REGISTRY
+  observation = Observation()
+  start = time.perf_counter()
+  try:
+    yield observation
+  except BaseException:
+    observation.fail()
+    raise
+  finally:
+    reg.record(operation, time.perf_counter() - start,
+               failed=observation.failed,
+               nbytes=observation.bytes,
+               rows=observation.rows)
+
+
+###################################################################
+#
+# increment / prometheus / summary / write_prometheus
+#
+def prometheus():
+  """
+  Returns the default registry's metrics in Prometheus text format
+  """
+  return REGISTRY.prometheus()
+
+
+def increment(event, n=1):
+  """
+  Adds n to the named event counter in the default registry
+  """
+  REGISTRY.increment(event, n)
+
+
+def summary():
+  """
+  Returns the default registry's metrics as a printable table
+  """
+  return REGISTRY.summary()
+
+
+def write_prometheus(filename):
+  """
+  Writes the default registry's metrics in Prometheus text format
+  to a file, atomically (for node_exporter's textfile collector)
+
+  Parameters
+  ----------
+  filename : file to write
+  """
+  tmp = f"{filename}.{os.getpid()}.tmp"
+  with open(tmp, "w") as f:
+    f.write(prometheus())
+  os.replace(tmp, filename)
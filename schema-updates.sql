@@ -0,0 +1,73 @@
+-- Schema additions on top of the base 'photoapp' database
+-- (users and assets tables).
+USE photoapp;
+
+-- Maintained counters, e.g. 's3objects:<bucket name>' holds the
+-- # of objects in that bucket so stats needn't list the bucket.
+CREATE TABLE IF NOT EXISTS counters
+(
+    name   VARCHAR(128) NOT NULL,
+    value  BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (name)
+);
+
+-- Log of changes to the S3 object counts, so a count taken at an
+-- earlier time (an S3 Inventory report) can be brought up to date
+-- with the changes since. Entries a reconciliation accounts for
+-- are deleted.
+CREATE TABLE IF NOT EXISTS counterlog
+(
+    name   VARCHAR(128) NOT NULL,
+    delta  BIGINT NOT NULL,
+    at     TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    INDEX counterlog_name_at (name, at)
+);
+
+-- Downscaled renditions of each asset (longest side <= size
+-- pixels), stored in S3 next to the original as
+-- <folder>/<file>_<size>.jpg.
+CREATE TABLE IF NOT EXISTS renditions
+(
+    assetid    INT NOT NULL,
+    size       INT NOT NULL,
+    bucketkey  VARCHAR(128) NOT NULL,
+    bytes      INT NOT NULL,
+    PRIMARY KEY (assetid, size),
+    FOREIGN KEY (assetid) REFERENCES assets(assetid)
+);
+
+-- Content hash (SHA-256, hex) of each asset, so a user's uploads of
+-- content they already have in S3 can reuse the existing object
+-- (never another user's, so objects stay in their owner's folder).
+-- Several of a user's assets may then share one bucketkey; index it
+-- for rendition lookups. Run once (MySQL has no ADD COLUMN IF NOT
+-- EXISTS).
+ALTER TABLE assets
+    ADD COLUMN contenthash CHAR(64) NULL,
+    ADD INDEX assets_user_contenthash (userid, contenthash),
+    ADD INDEX assets_bucketkey (bucketkey);
+
+-- Size of each asset in bytes, so the aggregates below can be
+-- rebuilt from assets (stats --exact). Assets recorded before this
+-- column existed have no size and count as 0 bytes. Run once.
+ALTER TABLE assets
+    ADD COLUMN bytes BIGINT NULL;
+
+-- Per-user aggregates, kept in step as assets are recorded (in the
+-- same transaction) so stats needn't scan assets: # of assets and
+-- their total size.
+CREATE TABLE IF NOT EXISTS userstats
+(
+    userid      INT NOT NULL,
+    numassets   BIGINT NOT NULL DEFAULT 0,
+    totalbytes  BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (userid),
+    FOREIGN KEY (userid) REFERENCES users(userid)
+);
+
+-- Seed counts for assets recorded before userstats existed. Run
+-- once.
+INSERT INTO userstats (userid, numassets, totalbytes)
+SELECT userid, COUNT(*), COALESCE(SUM(bytes), 0) FROM assets GROUP BY userid
+ON DUPLICATE KEY UPDATE numassets = VALUES(numassets),
+                        totalbytes = VALUES(totalbytes);
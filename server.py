@@ -0,0 +1,534 @@
+#
+# server.py
+#
+# HTTP API for photoapp, so many clients can be served from one
+# warm process instead of one interactive program per user.
+# Built on the standard library's threading HTTP server; request
+# threads borrow connections from one shared datatier pool (only
+# while talking to the database, not while streaming bodies)
+# and use one shared (thread-safe) boto3 S3 client.
+# Uploads and downloads are streamed through in chunks, so files
+# are never held in memory whole. Uploads are hashed on the way
+# through and go through the same content deduplication, preview
+# renditions and per-user stats as the command-line upload.
+#
+# Endpoints:
+#
+#   GET  /metrics                    Prometheus metrics of this process
+#   GET  /stats                      bucket and database counts
+#   GET  /users?page_size=&after=    one page of users, newest first
+#   GET  /users?page_size=0          all users, streamed as JSON lines
+#   POST /users                      {"email", "lastname", "firstname"}
+#   GET  /assets?page_size=&after=   one page of assets, newest first
+#   GET  /assets?page_size=0         all assets, streamed as JSON lines
+#   GET  /assets/<assetid>           the asset's bytes
+#   POST /users/<userid>/assets?name=<filename>
+#                                    upload the request body as an asset
+#
+# Usage:
+#
+#   python server.py [--config photoapp-config.ini] [--host H] [--port P]
+#
+
+import datatier
+import metrics
+import main as photoapp
+
+import argparse
+import contextlib
+import hashlib
+import http.server
+import itertools
+import json
+import logging
+import pathlib
+import sys
+import tempfile
+import urllib.parse
+import uuid
+
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 16 * 1024 * 1024  # uploads kept in memory for renditions, larger ones on disk
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class DatabaseUnavailable(Exception):
+  pass
+
+
+class ResponseAborted(Exception):
+  pass
+
+
+###################################################################
+#
+# BodyReader
+#
+# File-like wrapper that lets boto3 read exactly Content-Length
+# bytes of a request body, in whatever chunk sizes it likes. The
+# bytes are hashed (SHA-256) as they pass, and optionally copied
+# to a file, e.g. to make renditions from once the upload is done.
+#
+class BodyReader:
+  def __init__(self, rfile, length, copy=None):
+    self.rfile = rfile
+    self.remaining = length
+    self.copy = copy
+    self.sha256 = hashlib.sha256()
+    self.bytes_read = 0
+
+  def read(self, size=-1):
+    if self.remaining <= 0:
+      return b""
+    if size is None or size < 0 or size > self.remaining:
+      size = self.remaining
+    data = self.rfile.read(size)
+    self.remaining -= len(data)
+    self.bytes_read += len(data)
+    self.sha256.update(data)
+    if self.copy is not None:
+      self.copy.write(data)
+    return data
+
+
+###################################################################
+#
+# PhotoAppHandler
+#
+class PhotoAppHandler(http.server.BaseHTTPRequestHandler):
+  """
+  Handles one HTTP request; the shared Session is attached to the
+  server object as server.session
+  """
+
+  protocol_version = "HTTP/1.1"
+
+  #
+  # helpers:
+  #
+  def send_json(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def send_error_json(self, status, message):
+    self.send_json(status, {"error": message})
+
+  def send_chunk(self, data):
+    self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+  def stream_json_lines(self, rows, to_dict):
+    #
+    # chunked transfer encoding, one JSON object per line. The
+    # first row is fetched before the 200 goes out, so a failing
+    # query still gets a proper error response; a failure later on
+    # aborts the stream without the final zero-length chunk, so
+    # the client sees it as truncated rather than complete:
+    #
+    rows = iter(rows)
+    first = list(itertools.islice(rows, 1))
+
+    self.send_response(200)
+    self.send_header("Content-Type", "application/x-ndjson")
+    self.send_header("Transfer-Encoding", "chunked")
+    self.end_headers()
+
+    batch = []
+    try:
+      for row in itertools.chain(first, rows):
+        batch.append(json.dumps(to_dict(row)) + "\n")
+        if len(batch) == 1000:
+          self.send_chunk("".join(batch).encode())
+          batch = []
+    except Exception as e:
+      raise ResponseAborted(str(e)) from e
+    if batch:
+      self.send_chunk("".join(batch).encode())
+    self.wfile.write(b"0\r\n\r\n")
+
+  def route(self):
+    parsed = urllib.parse.urlsplit(self.path)
+    parts = [p for p in parsed.path.split("/") if p]
+    query = dict(urllib.parse.parse_qsl(parsed.query))
+    return (parts, query)
+
+  def page_args(self, query):
+    page_size = int(query.get("page_size", DEFAULT_PAGE_SIZE))
+    if page_size < 0 or page_size > MAX_PAGE_SIZE:
+      raise ValueError(f"page_size must be between 0 and {MAX_PAGE_SIZE}")
+    after = query.get("after")
+    return (page_size, int(after) if after is not None else None)
+
+  @contextlib.contextmanager
+  def database(self):
+    with self.server.session.dbPool.connection() as dbConn:
+      if dbConn is None:
+        raise DatabaseUnavailable()
+      yield dbConn
+
+  def log_message(self, format, *args):
+    logging.info("%s - %s", self.address_string(), format % args)
+
+  #
+  # dispatch:
+  #
+  def do_GET(self):
+    self.dispatch({
+      ("metrics",): self.get_metrics,
+      ("stats",): self.get_stats,
+      ("users",): self.get_users,
+      ("assets",): self.get_assets,
+      ("assets", "*"): self.get_asset
+    })
+
+  def do_POST(self):
+    self.dispatch({
+      ("users",): self.post_user,
+      ("users", "*", "assets"): self.post_asset
+    })
+
+  def dispatch(self, routes):
+    (parts, query) = self.route()
+    self.body_read = False  # one handler object serves every request on a connection
+
+    handler = None
+    for (pattern, candidate) in routes.items():
+      if len(pattern) == len(parts) and \
+         all(p == "*" or p == part for (p, part) in zip(pattern, parts)):
+        handler = candidate
+        break
+
+    if handler is None:
+      self.close_unread_body()
+      self.send_error_json(404, "no such endpoint")
+      return
+
+    try:
+      with metrics.measure(f"server.{handler.__name__}"):
+        handler(parts, query)
+
+    except DatabaseUnavailable:
+      self.close_unread_body()
+      self.send_error_json(503, "unable to connect to database")
+    except ResponseAborted as e:
+      logging.error("server: %s %s aborted mid-response:", self.command, self.path)
+      logging.error(e)
+      self.close_connection = True  # no final chunk: the client sees a truncated body
+    except ValueError as e:
+      self.close_unread_body()
+      self.send_error_json(400, str(e))
+    except Exception as e:
+      logging.error("server: %s %s failed:", self.command, self.path)
+      logging.error(e)
+      self.close_connection = True
+      try:
+        self.send_error_json(500, "internal error")
+      except Exception:
+        pass  # response already started, nothing more we can do
+
+  #
+  # endpoints:
+  #
+  def get_metrics(self, parts, query):
+    data = metrics.prometheus().encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def get_stats(self, parts, query):
+    session = self.server.session
+
+    with self.database() as dbConn:
+      row = photoapp.retrieve_stats(dbConn, session.bucketname)
+
+    if row is None:
+      self.send_error_json(500, "failed to retrieve database counts")
+      return
+
+    self.send_json(200, {
+      "bucket": session.bucketname,
+      "s3_objects": row[2],
+      "users": row[0],
+      "assets": row[1],
+      "total_bytes": int(row[3])
+    })
+
+  def get_listing(self, query, table, keycol, to_dict):
+    (page_size, after) = self.page_args(query)
+
+    if page_size == 0:
+      sql = f"SELECT * FROM {table} ORDER BY {keycol} DESC;"
+      with self.database() as dbConn:
+        self.stream_json_lines(datatier.iter_rows(dbConn, sql), to_dict)
+      return
+
+    with self.database() as dbConn:
+      rows = datatier.retrieve_page(dbConn, table, keycol, after, page_size)
+    if rows is None:
+      self.send_error_json(500, f"failed to retrieve {table}")
+      return
+
+    body = {table: [to_dict(row) for row in rows]}
+    if len(rows) == page_size:
+      body["next_after"] = rows[-1][0]
+    self.send_json(200, body)
+
+  def get_users(self, parts, query):
+    self.get_listing(query, "users", "userid", lambda row: {
+      "userid": row[0], "email": row[1], "lastname": row[2],
+      "firstname": row[3], "bucketfolder": row[4]
+    })
+
+  def get_assets(self, parts, query):
+    self.get_listing(query, "assets", "assetid", lambda row: {
+      "assetid": row[0], "userid": row[1], "assetname": row[2],
+      "bucketkey": row[3]
+    })
+
+  def get_asset(self, parts, query):
+    session = self.server.session
+    assetid = int(parts[1])
+
+    with self.database() as dbConn:
+      row = datatier.retrieve_one_row(dbConn, """
+        SELECT assetname, bucketkey FROM assets WHERE assetid = %s;
+        """, [assetid])
+    if row is None:
+      self.send_error_json(500, "failed to retrieve asset")
+      return
+    if row == ():
+      self.send_error_json(404, "no such asset")
+      return
+
+    (assetname, bucketkey) = row
+    response = session.s3_client.get_object(Bucket=session.bucketname, Key=bucketkey)
+
+    filename = pathlib.PurePath(assetname).name.replace('"', '')
+    self.send_response(200)
+    self.send_header("Content-Type", response.get("ContentType", "application/octet-stream"))
+    self.send_header("Content-Length", str(response["ContentLength"]))
+    self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+    self.end_headers()
+
+    body = response["Body"]
+    try:
+      for chunk in body.iter_chunks(CHUNK_SIZE):
+        self.wfile.write(chunk)
+    finally:
+      body.close()
+
+  def content_length(self):
+    """
+    The request's Content-Length, or None if it has none; raises
+    ValueError if it isn't a non-negative integer
+    """
+    if "Content-Length" not in self.headers:
+      return None
+    try:
+      length = int(self.headers["Content-Length"])
+    except ValueError:
+      length = -1
+    if length < 0:
+      raise ValueError("invalid Content-Length")
+    return length
+
+  def close_unread_body(self):
+    #
+    # an error response to a request whose body may not have been
+    # read: with keep-alive the leftover bytes would be parsed as
+    # the next request, so close the connection instead:
+    #
+    if self.command == "POST" and not self.body_read:
+      self.close_connection = True
+
+  def read_json_body(self):
+    length = self.content_length() or 0
+    data = self.rfile.read(length)
+    self.body_read = True
+    try:
+      return json.loads(data or b"{}")
+    except json.JSONDecodeError:
+      raise ValueError("request body is not valid JSON")
+
+  def post_user(self, parts, query):
+    body = self.read_json_body()
+
+    missing = [k for k in ["email", "lastname", "firstname"] if not body.get(k)]
+    if missing:
+      raise ValueError(f"missing {', '.join(missing)}")
+
+    folder = str(uuid.uuid4())
+    with self.database() as dbConn:
+      userid = datatier.insert_returning_id(dbConn, """
+        INSERT INTO users (email, lastname, firstname, bucketfolder)
+        VALUES (%s, %s, %s, %s)
+        """, [body["email"], body["lastname"], body["firstname"], folder])
+
+      if userid != -1:
+        photoapp.add_to_counter(dbConn, "users", 1)
+
+    if userid == -1:
+      self.send_error_json(500, "failed to insert user")
+      return
+
+    self.send_json(201, {"userid": userid, "bucketfolder": folder})
+
+  def post_asset(self, parts, query):
+    session = self.server.session
+
+    length = self.content_length()
+    if length is None:
+      self.close_unread_body()
+      self.send_error_json(411, "Content-Length required")
+      return
+
+    try:
+      userid = int(parts[1])
+    except ValueError:
+      raise ValueError(f"invalid user id '{parts[1]}'")
+
+    assetname = query.get("name")
+    if not assetname:
+      raise ValueError("missing ?name=<original filename>")
+
+    with self.database() as dbConn:
+      row = datatier.retrieve_one_row(dbConn, """
+        SELECT bucketfolder FROM users WHERE userid = %s;
+        """, [userid])
+    if row is None or row == ():
+      self.close_unread_body()
+      self.send_error_json(404, "no such user")
+      return
+
+    bucketkey = f"{row[0]}/{uuid.uuid4()}.jpg"
+
+    #
+    # a copy for the renditions, in memory unless it's large:
+    #
+    if len(session.rendition_sizes) > 0:
+      copy = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    else:
+      copy = None
+
+    with contextlib.ExitStack() as cleanup:
+      if copy is not None:
+        cleanup.enter_context(copy)
+
+      #
+      # stream the request body straight into S3 (multipart above
+      # the configured threshold), hashing it on the way; the hash
+      # is only known at the end, so contents the user already has
+      # are uploaded and then deleted again:
+      #
+      body = BodyReader(self.rfile, length, copy)
+      session.s3_client.upload_fileobj(body,
+                                       session.bucketname,
+                                       bucketkey,
+                                       ExtraArgs={
+                                         'ACL': 'public-read',
+                                         'ContentType': 'image/jpeg'
+                                       },
+                                       Config=session.transfer_config)
+      content_hash = body.sha256.hexdigest()
+
+      #
+      # a client that disconnects mid-body looks like the end of
+      # the body to upload_fileobj; don't keep a truncated object:
+      #
+      if body.bytes_read != length:
+        session.s3_client.delete_object(Bucket=session.bucketname, Key=bucketkey)
+        raise ValueError(f"request body ended after {body.bytes_read} of {length} bytes")
+      self.body_read = True
+
+      with self.database() as dbConn:
+        existing = photoapp.find_content(dbConn, userid, content_hash)
+        if existing is None:
+          self.send_error_json(500, "failed to look up content hash")
+          return
+
+        duplicate = existing != ()
+        if duplicate:
+          session.s3_client.delete_object(Bucket=session.bucketname, Key=bucketkey)
+          bucketkey = existing[0]
+
+        statements = [("""
+          INSERT INTO assets (userid, assetname, bucketkey, contenthash, bytes)
+          VALUES (%s, %s, %s, %s, %s)
+          """, [userid, assetname, bucketkey, content_hash, body.bytes_read])]
+        statements += photoapp.userstats_statements(userid, 1, body.bytes_read)
+        if not duplicate:
+          statements += photoapp.object_count_statements(session.bucketname, 1)
+
+        results = datatier.perform_transaction(dbConn, statements)
+        if results is None:
+          self.send_error_json(500, "failed to insert asset")
+          return
+        assetid = results[0][1]
+
+        num_renditions = 0
+        if not duplicate and copy is not None:
+          copy.seek(0)
+          num_renditions = photoapp.store_renditions(dbConn, session.bucket,
+                                                     [(assetid, bucketkey, copy)],
+                                                     session.rendition_sizes)
+
+    self.send_json(201, {"assetid": assetid, "bucketkey": bucketkey, "bytes": body.bytes_read,
+                         "duplicate": duplicate, "renditions": max(num_renditions, 0)})
+
+
+###################################################################
+#
+# serve
+#
+def serve(config_file, host, port):
+  """
+  Runs the HTTP server until interrupted
+
+  Parameters
+  ----------
+  config_file : name of the config file to use,
+  host : interface to listen on,
+  port : port to listen on
+
+  Returns
+  -------
+  nothing
+  """
+
+  session = photoapp.Session(config_file)
+
+  httpd = http.server.ThreadingHTTPServer((host, port), PhotoAppHandler)
+  httpd.daemon_threads = True
+  httpd.session = session
+
+  print(f"** PhotoApp API listening on http://{host}:{port}")
+
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    httpd.server_close()
+    session.close()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="PhotoApp HTTP API server")
+  parser.add_argument("--config", default="photoapp-config.ini", help="config file")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  args = parser.parse_args()
+
+  if not pathlib.Path(args.config).is_file():
+    print("**ERROR: config file '", args.config, "' does not exist, exiting")
+    sys.exit(1)
+
+  logging.basicConfig(level=logging.INFO)
+  serve(args.config, args.host, args.port)